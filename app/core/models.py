@@ -41,10 +41,40 @@ class SessionEnvFile(BaseModel):
     session_id: str
     context_id: str
     env_file: str | None = None  # holds base64 encoded env file, maybe not needed
-    file_id: str | None = None   # holds GridFS file ID
+    file_id: str | None = None   # holds GridFS file ID (environments stored before chunked snapshots)
+    snapshot_id: str | None = None  # hash of the chunk manifest of the current snapshot
+    version: int | None = None      # version of the current snapshot
+    size: int | None = None
     tenant_id: str = "default"
 
 
+class EnvChunk(BaseModel):
+    sha256: str
+    size: int
+
+
+class EnvChunkHashes(BaseModel):
+    chunks: list[str]  # SHA-256 of each content-defined chunk, in file order
+
+
+class EnvSnapshot(BaseModel):
+    session_id: str
+    snapshot_id: str | None = None
+    version: int | None = None
+    size: int = 0
+    chunks: list[EnvChunk] = []
+
+
+class EnvSnapshotVersion(BaseModel):
+    session_id: str
+    version: int
+    snapshot_id: str
+    size: int
+    code_snippet_id: str | None = None  # the code snippet the environment was saved after
+    restored_from: int | None = None    # set when this version is a restore of an earlier one
+    created_at: datetime
+
+
 class AnalysisResponse(BaseModel):
   session_id: str
   response_inner: ChatMessage # the inner dialogue of the assistant
@@ -58,3 +88,24 @@ class AnalysisSessionSummary(BaseModel):
     context_id: str
     title: str | None = None
     description: str | None = None
+
+
+class EnvUploadPart(BaseModel):
+    part_number: int
+    sha256: str
+    size: int
+
+
+class EnvUpload(BaseModel):
+    upload_id: str
+    session_id: str
+    part_size: int  # suggested part size, the last part may be smaller
+    parts: dict[str, EnvChunk] = {}  # received parts (sha256, size) by part number
+    status: Literal["open", "completing"]
+    code_snippet_id: str | None = None
+    created_at: datetime
+    updated_at: datetime
+
+
+class EnvUploadComplete(BaseModel):
+    parts: list[str]  # SHA-256 of parts 1..n, in order
@@ -6,9 +6,9 @@ import uuid
 from typing import Literal
 
 # functions ------------------------------------------
-def suggest_code(tenant_id: str, session_id: str, code: str, language: str):
+async def suggest_code(tenant_id: str, session_id: str, code: str, language: str):
   analysis_collection = tenant_collections.get_collection(tenant_id, "analysis")
-  analysis_object = analysis_collection.find_one({"session_id": session_id}, {"_id": 0})
+  analysis_object = await analysis_collection.find_one({"session_id": session_id}, {"_id": 0})
   
   if not analysis_object:
     raise ValueError(f"Analysis object not found for session {session_id}")
@@ -30,7 +30,7 @@ def suggest_code(tenant_id: str, session_id: str, code: str, language: str):
     )
   )
   
-  analysis_collection.update_one(
+  await analysis_collection.update_one(
     {"session_id": session_id},
     {"$push": {"code_snippets": new_code_suggestion.model_dump(exclude_none=True)}}
   )
@@ -38,9 +38,9 @@ def suggest_code(tenant_id: str, session_id: str, code: str, language: str):
   return "code suggestion submitted successfully"
 
 
-def run_code(tenant_id: str, session_id: str, code: str, language: str):
+async def run_code(tenant_id: str, session_id: str, code: str, language: str):
   analysis_collection = tenant_collections.get_collection(tenant_id, "analysis")
-  analysis_object = analysis_collection.find_one({"session_id": session_id}, {"_id": 0})
+  analysis_object = await analysis_collection.find_one({"session_id": session_id}, {"_id": 0})
   
   if not analysis_object:
     raise ValueError(f"Analysis object not found for session {session_id}")
@@ -62,7 +62,7 @@ def run_code(tenant_id: str, session_id: str, code: str, language: str):
     )
   )
   
-  analysis_collection.update_one(
+  await analysis_collection.update_one(
     {"session_id": session_id},
     {"$push": {"code_snippets": new_code_execution.model_dump(exclude_none=True)}}
   )
@@ -70,9 +70,9 @@ def run_code(tenant_id: str, session_id: str, code: str, language: str):
   return "code execution submitted successfully"
 
 
-def send_user_message(tenant_id: str, session_id: str, message: str):
+async def send_user_message(tenant_id: str, session_id: str, message: str):
   analysis_collection = tenant_collections.get_collection(tenant_id, "analysis")
-  analysis_object = analysis_collection.find_one({"session_id": session_id}, {"_id": 0})
+  analysis_object = await analysis_collection.find_one({"session_id": session_id}, {"_id": 0})
   
   if not analysis_object:
     raise ValueError(f"Analysis object not found for session {session_id}")
@@ -84,7 +84,7 @@ def send_user_message(tenant_id: str, session_id: str, message: str):
     timestamp=datetime.now()
   )
 
-  analysis_collection.update_one(
+  await analysis_collection.update_one(
     {"session_id": session_id},
     {"$push": {"messages": new_user_message.model_dump(exclude_none=True)}}
   )
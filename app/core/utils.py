@@ -0,0 +1,170 @@
+import os
+import re
+import asyncio
+import hashlib
+import numpy as np
+import zstandard
+from typing import AsyncIterator, Iterator, List
+
+
+# content-defined chunking ---------------------------------------------------
+# Chunk boundaries are placed where a rolling hash over the last CDC_WINDOW bytes matches a mask,
+# so an edit only changes the chunks around it and every other chunk keeps its hash.
+# The gear table is seeded so every process (and any client reimplementing it) cuts at the same places.
+CDC_MIN_SIZE = 256 * 1024
+CDC_AVG_SIZE = 1024 * 1024 # must be a power of 2
+CDC_MAX_SIZE = 4 * 1024 * 1024
+CDC_WINDOW = 64
+CDC_GEAR = np.random.default_rng(20250101).integers(0, 2**63, size=256, dtype=np.uint64)
+
+
+def hash_chunk(data: bytes) -> str:
+  return hashlib.sha256(data).hexdigest()
+
+
+def find_chunk_cut(
+    data,
+    min_size: int = CDC_MIN_SIZE,
+    avg_size: int = CDC_AVG_SIZE,
+    max_size: int = CDC_MAX_SIZE,
+    window: int = CDC_WINDOW
+) -> int:
+  # length of the first chunk in data (data is assumed to start at a chunk boundary)
+  if len(data) <= min_size:
+    return len(data)
+
+  # windowed sum of gear values, vectorised through a cumulative sum (uint64 wraps, which is fine for a hash).
+  # Scanned in blocks of ~avg_size so a typical chunk only hashes about its own length
+  mask = np.uint64(avg_size - 1)
+  limit = min(len(data), max_size)
+  block_start = min_size - window
+  while block_start + window < limit:
+    block_end = min(block_start + window + avg_size, limit)
+    scan = np.frombuffer(data, dtype=np.uint8, count=block_end - block_start, offset=block_start)
+    cumulative = np.cumsum(CDC_GEAR[scan], dtype=np.uint64)
+    window_hash = cumulative[window:] - cumulative[:-window]
+
+    matches = np.flatnonzero((window_hash & mask) == 0)
+    if len(matches):
+      return block_start + window + int(matches[0]) + 1
+    block_start = block_end - window
+  return limit
+
+
+def iter_content_defined_chunks(data: bytes, **kwargs) -> Iterator[bytes]:
+  view = memoryview(data)
+  while len(view):
+    cut = find_chunk_cut(view, **kwargs)
+    yield bytes(view[:cut])
+    view = view[cut:]
+
+
+async def aiter_content_defined_chunks(stream: AsyncIterator[bytes], max_size: int = CDC_MAX_SIZE, **kwargs) -> AsyncIterator[bytes]:
+  # same as iter_content_defined_chunks but over an async byte stream (e.g. a request body), buffering at most ~max_size.
+  # The boundary search runs in a thread so large uploads don't block the event loop
+  buffer = bytearray()
+  async for data in stream:
+    buffer.extend(data)
+    while len(buffer) >= max_size:
+      cut = await asyncio.to_thread(find_chunk_cut, buffer, max_size=max_size, **kwargs)
+      yield bytes(buffer[:cut])
+      del buffer[:cut]
+  for chunk in iter_content_defined_chunks(bytes(buffer), max_size=max_size, **kwargs):
+    yield chunk
+
+
+# compression ----------------------------------------------------------------
+# Each chunk is compressed as its own zstd frame. Concatenated frames are a valid zstd stream,
+# so a chunked file can be served compressed without recompressing it
+ZSTD_LEVEL = int(os.getenv("ENV_ZSTD_LEVEL", 3))
+
+
+def compress_chunk(data: bytes, level: int = ZSTD_LEVEL) -> bytes:
+  return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def decompress_chunk(data: bytes) -> bytes:
+  return zstandard.ZstdDecompressor().decompress(data)
+
+
+# code output digests --------------------------------------------------------
+# Code outputs are shown to the LLM as a digest: repeated lines and long tracebacks are collapsed,
+# overlong lines cut and, if it's still too long, only the head and tail are kept
+CODE_OUTPUT_MAX_BYTES = int(os.getenv("CODE_OUTPUT_MAX_BYTES", 8000))
+CODE_OUTPUT_MAX_LINE_CHARS = 500
+TRACEBACK_FRAME_PATTERN = re.compile(r'^\s*File ".*", line \d+')
+TRACEBACK_KEEP_FRAMES = (2, 3) # frames kept at the start and end of a long traceback
+
+
+def collapse_repeated_lines(lines: List[str]) -> List[str]:
+  collapsed = []
+  i = 0
+  while i < len(lines):
+    j = i
+    while j + 1 < len(lines) and lines[j + 1] == lines[i]:
+      j += 1
+    collapsed.append(lines[i])
+    if j > i:
+      collapsed.append(f"[... previous line repeated {j - i} more times ...]")
+    i = j + 1
+  return collapsed
+
+
+def collapse_tracebacks(lines: List[str]) -> List[str]:
+  # a Python traceback frame is a 'File "...", line n' line followed by its indented source lines
+  frames, collapsed = [], []
+
+  def flush():
+    keep_start, keep_end = TRACEBACK_KEEP_FRAMES
+    if len(frames) > keep_start + keep_end:
+      kept = frames[:keep_start] + [[f"  [... {len(frames) - keep_start - keep_end} frames omitted ...]"]] + frames[-keep_end:]
+    else:
+      kept = frames
+    collapsed.extend(line for frame in kept for line in frame)
+    frames.clear()
+
+  for line in lines:
+    if TRACEBACK_FRAME_PATTERN.match(line):
+      frames.append([line])
+    elif frames and line.startswith("    "):
+      frames[-1].append(line)
+    else:
+      flush()
+      collapsed.append(line)
+  flush()
+  return collapsed
+
+
+def digest_code_output(output: str, max_bytes: int = CODE_OUTPUT_MAX_BYTES) -> str:
+  """
+  Compact a code output for the LLM, keeping it under max_bytes (UTF-8)
+  Returns: The output unchanged if it's short enough, otherwise its digest
+  """
+  if len(output.encode()) <= max_bytes:
+    return output
+
+  lines = [
+    line if len(line) <= CODE_OUTPUT_MAX_LINE_CHARS else line[:CODE_OUTPUT_MAX_LINE_CHARS] + f" [... {len(line) - CODE_OUTPUT_MAX_LINE_CHARS} characters omitted]"
+    for line in output.splitlines()
+  ]
+  lines = collapse_tracebacks(collapse_repeated_lines(lines))
+  if len("\n".join(lines).encode()) <= max_bytes:
+    return "\n".join(lines)
+
+  # keep as many head and tail lines as fit, a third of the budget for the head
+  head, tail = [], []
+  head_bytes, tail_bytes = 0, 0
+  for line in lines:
+    if head_bytes + len(line.encode()) + 1 > max_bytes // 3:
+      break
+    head.append(line)
+    head_bytes += len(line.encode()) + 1
+  for line in reversed(lines[len(head):]):
+    if head_bytes + tail_bytes + len(line.encode()) + 1 > max_bytes - 100: # room for the marker
+      break
+    tail.insert(0, line)
+    tail_bytes += len(line.encode()) + 1
+
+  omitted = lines[len(head):len(lines) - len(tail)]
+  marker = f"[... {len(omitted)} lines ({len(chr(10).join(omitted).encode())} bytes) omitted ...]"
+  return "\n".join(head + [marker] + tail)
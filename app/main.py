@@ -1,5 +1,6 @@
 from fastapi import FastAPI
 import os
+import asyncio
 import uvicorn
 from contextlib import asynccontextmanager
 from typing import Annotated
@@ -12,14 +13,21 @@ from magenta.core.security import (
   Token, User, ACCESS_TOKEN_EXPIRE_MINUTES
 )
 from magenta.core import (
-    logger, mongo_client, engine,
-    tenant_collections, get_db,
+    logger, mongo_client, engine, async_engine,
+    tenant_collections, tenant_middleware, get_db,
     create_postgres_extensions, load_all_functions_in_db, cleanup_mongo
 )
 from magenta.services import load_prompts_from_files
 from magenta.routes.chats import chats_router
+from magenta.routes.tenants import tenants_router
+from magenta.routes.usage import usage_router
 from app.routes.analysis import analysis_router
 from app.routes.environments import environments_router
+from app.routes.maintenance import maintenance_router
+from magenta.core.metrics import metrics_middleware, metrics_endpoint
+from magenta.core.tracing import setup_tracing, shutdown_tracing, tracing_middleware
+from magenta.core.logging_setup import flush_logs
+from app.services.garbage_collection import garbage_collector_loop, ENV_GC_INTERVAL_SECONDS
 from app.core.tools import analysis_function_dictionary, analysis_function_tool_definitions
 
 
@@ -31,8 +39,13 @@ async def lifespan(app: FastAPI):
     logger.info("Application server started.")
     
     # Startup logic
-    tenant_collections.add_collection_type("analysis")
-    tenant_collections.add_collection_type("environments")
+    await tenant_collections.refresh_tenants()
+    tenant_watcher = asyncio.create_task(tenant_collections.watch_tenants()) # pick up tenants created by other workers
+    await tenant_collections.add_collection_type("analysis", create_indexes=False)
+    await tenant_collections.add_collection_type("environments", create_indexes=False)
+    await tenant_collections.add_collection_type("environment_snapshots", create_indexes=False)
+    await tenant_collections.add_collection_type("environment_uploads", create_indexes=False)
+    await tenant_collections.ensure_indexes() # once, for the magenta and the app collection types
     await create_postgres_extensions(get_db)
     await load_prompts_from_files(tenant_collections.get_collections_list("prompts"), dir="data/prompts")
     await create_initial_users(users_collection, dir="data/users")
@@ -44,22 +57,37 @@ async def lifespan(app: FastAPI):
     )
     await cleanup_mongo(tenant_collections.get_collections_list("analysis"),[{"context_id":"test_context"}])
     await cleanup_mongo(tenant_collections.get_collections_list("environments"),[{"context_id":"test_session"}])
+    garbage_collector = asyncio.create_task(garbage_collector_loop()) if ENV_GC_INTERVAL_SECONDS > 0 else None
 
     yield
     
     # Shutdown logic
+    tenant_watcher.cancel()
+    if garbage_collector:
+        garbage_collector.cancel()
     mongo_client.close()
     engine.dispose()
+    await async_engine.dispose()
+    shutdown_tracing()
     logger.info("Application server stopped.")
+    await flush_logs()
 
 
+setup_tracing("radian")
 app = FastAPI(lifespan=lifespan)
+app.middleware("http")(tenant_middleware) # innermost, loads the tenant of the request into the cache
+app.middleware("http")(metrics_middleware)
+app.middleware("http")(tracing_middleware) # outermost, so the request span covers everything
+app.add_route("/metrics", metrics_endpoint, include_in_schema=False)
 
 
 # Include magenta routers
 app.include_router(analysis_router)
 app.include_router(environments_router)
+app.include_router(maintenance_router)
 app.include_router(chats_router)
+app.include_router(tenants_router)
+app.include_router(usage_router)
 
 
 @app.get("/")
@@ -77,7 +105,7 @@ async def healthcheck():
 async def login_for_access_token(
 	form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
 ) -> Token:
-	user = authenticate_user(users_collection, form_data.username, form_data.password)
+	user = await authenticate_user(users_collection, form_data.username, form_data.password)
 	if not user:
 		raise HTTPException(
 			status_code=status.HTTP_401_UNAUTHORIZED,
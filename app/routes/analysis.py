@@ -1,8 +1,11 @@
+import os
 from typing import List, Optional, Literal, Union, Dict
 from fastapi import APIRouter, Query, HTTPException, BackgroundTasks
 from app.core.models import AnalysisSession, CodeSnippet, CodeResponse, CodePair, CodePairMessage, AnalysisSessionSummary, SessionEnvFile
 from app.core.tools import analysis_function_dictionary
-from magenta.routes.chats import create_chat, delete_chat, send_chat, get_chat_message_status, get_chat_status
+from app.core.utils import digest_code_output
+from magenta.routes.chats import create_chat, delete_chat, send_chat, get_chat_message_status, get_chat_message_statuses, get_chat_status
+from magenta.routes.chats import limit_agent_turn # the limiter state chat_service and the chat endpoints use
 from magenta.core.config import tenant_collections, logger
 from magenta.core.models import ChatMessage, Task
 from magenta.services.chat_service import process_chat
@@ -11,6 +14,8 @@ import uuid
 from pydantic import BaseModel
 from app.routes.environments import create_environment
 
+CODE_OBSERVATION_LLM_MODEL = os.getenv("CODE_OBSERVATION_LLM_MODEL") # "provider:model" for turns reacting to code output, e.g. a faster model
+
 
 analysis_router = APIRouter(prefix="/analysis", tags=["analysis"])
 
@@ -29,7 +34,7 @@ async def list_analysis_sessions(
   if context_id:
     query["context_id"] = context_id
 
-  analysis_sessions = analysis_collection.find(query, {"_id": 0})
+  analysis_sessions = await analysis_collection.find(query, {"_id": 0}).to_list(length=None)
 
   analysis_objects = [AnalysisSession(**analysis_session) for analysis_session in analysis_sessions]
   
@@ -69,7 +74,7 @@ async def create_analysis_session(
     description=description
   )
   
-  analysis_collection.insert_one(analysis_session.model_dump(exclude_none=True))
+  await analysis_collection.insert_one(analysis_session.model_dump(exclude_none=True))
   logger.info(f"Inserted analysis session {analysis_session}")
 
   # Create empty environment
@@ -83,7 +88,7 @@ async def create_analysis_session(
 async def get_analysis_session(session_id: str, tenant_id: str = "default"):
   analysis_collection = tenant_collections.get_collection(tenant_id, "analysis")
 
-  analysis_session = analysis_collection.find_one({"session_id": session_id}, {"_id": 0})
+  analysis_session = await analysis_collection.find_one({"session_id": session_id}, {"_id": 0})
   if not analysis_session:
     raise HTTPException(status_code=404, detail="Analysis session not found")
   
@@ -95,7 +100,7 @@ async def get_analysis_session(session_id: str, tenant_id: str = "default"):
 async def delete_analysis_session(session_id: str, tenant_id: str = "default"):
   analysis_collection = tenant_collections.get_collection(tenant_id, "analysis")
 
-  analysis_collection.delete_one({"session_id": session_id})
+  await analysis_collection.delete_one({"session_id": session_id})
   await delete_chat(session_id, tenant_id)
 
   return {"status": "success"}
@@ -110,7 +115,7 @@ async def get_messages_from_analysis_session(
 ):
 	analysis_collection = tenant_collections.get_collection(tenant_id, "analysis")
 
-	messages = analysis_collection.find_one({"session_id": session_id}, {"messages": 1, "_id": 0})
+	messages = await analysis_collection.find_one({"session_id": session_id}, {"messages": 1, "_id": 0})
 	if not messages or "messages" not in messages:
 		raise HTTPException(status_code=404, detail="No messages found")
 	
@@ -137,6 +142,7 @@ async def add_message_to_analysis_session(
   tenant_id: str = "default",
   dry_run: bool = False
 ):
+  await limit_agent_turn(tenant_id, session_id) # 429 when the tenant or the session is over its rate
   analysis_collection = tenant_collections.get_collection(tenant_id, "analysis")
 
   message_to_process = "[USER MESSAGE]\n\n" + message # add a prefix to the message to indicate to the LLM that this is a user message
@@ -154,10 +160,12 @@ async def add_message_to_analysis_session(
     json_mode=False,
     tool_choice="auto",
     function_dictionary=analysis_function_dictionary,
+    tenant_id=tenant_id,
     chats_collection=tenant_collections.get_collection(tenant_id, "chats"),
     prompts_collection=tenant_collections.get_collection(tenant_id, "prompts"),
     documents_collection=tenant_collections.get_collection(tenant_id, "documents"),
-    tools_collection=tenant_collections.get_collection(tenant_id, "tools")
+    tools_collection=tenant_collections.get_collection(tenant_id, "tools"),
+    usage_collection=tenant_collections.get_collection(tenant_id, "llm_usage")
   )
   
   message_object = ChatMessage(
@@ -167,7 +175,7 @@ async def add_message_to_analysis_session(
     timestamp=datetime.now()
   )
 
-  analysis_collection.update_one(
+  await analysis_collection.update_one(
     {"session_id": session_id},
     {"$push": {"messages": message_object.model_dump(exclude_none=True)}}
   )
@@ -189,15 +197,11 @@ async def get_analysis_session_message_statuses(
       return {latest_status["task_id"]: latest_status}
     return {}
 
-  # Get status for each message ID
-  result = {}
-  for message_id in message_ids:
-    try:
-      message_status = await get_chat_message_status(session_id, message_id, tenant_id)
-      if status is None or message_status["status"] == status:
-        result[message_id] = message_status
-    except HTTPException:
-      continue
+  # Get statuses for all message IDs in one query
+  try:
+    result = await get_chat_message_statuses(session_id, message_ids, status, tenant_id)
+  except HTTPException:
+    result = {}
     
   return result
 
@@ -205,10 +209,10 @@ async def get_analysis_session_message_statuses(
 @analysis_router.get("/{session_id}/messages/{message_id}", response_model=ChatMessage)
 async def get_message_from_analysis_session(session_id: str, message_id: str, tenant_id: str = "default"):
   analysis_collection = tenant_collections.get_collection(tenant_id, "analysis")
-  if not analysis_collection.count_documents({"session_id": session_id}):
+  if not await analysis_collection.count_documents({"session_id": session_id}):
     raise HTTPException(status_code=404, detail="Analysis session not found")
 
-  message = analysis_collection.find_one({"session_id": session_id, "messages.message_id": message_id}, {"_id": 0})
+  message = await analysis_collection.find_one({"session_id": session_id, "messages.message_id": message_id}, {"_id": 0})
   if not message:
     raise HTTPException(status_code=404, detail="Message not found")
   
@@ -225,7 +229,7 @@ async def get_code_from_analysis_session(
 ):
 	analysis_collection = tenant_collections.get_collection(tenant_id, "analysis")
 
-	code_snippets = analysis_collection.find_one({"session_id": session_id}, {"code_snippets": 1, "_id": 0})
+	code_snippets = await analysis_collection.find_one({"session_id": session_id}, {"code_snippets": 1, "_id": 0})
 	if not code_snippets or "code_snippets" not in code_snippets:
 		raise HTTPException(status_code=404, detail="No code snippets found")
 	
@@ -252,12 +256,14 @@ async def add_code_to_analysis_session(
   tenant_id: str = "default",
   dry_run: bool = False
 ):
+  await limit_agent_turn(tenant_id, session_id)
   analysis_collection = tenant_collections.get_collection(tenant_id, "analysis")
 
   message_to_process = "[CODE]\n\n[INPUT]\n\n```" + code.input.code_snippet + "```\n\n"
 
   if code.output:
-    message_to_process += "[OUTPUT]\n\n```" + code.output.response + "```\n\n"
+    # the LLM gets a digest of long outputs, the full output is kept in the code history
+    message_to_process += "[OUTPUT]\n\n```" + digest_code_output(code.output.response) + "```\n\n"
 
   code_message_id = str(uuid.uuid4())
 
@@ -271,10 +277,13 @@ async def add_code_to_analysis_session(
     json_mode=False,
     tool_choice="auto",
     function_dictionary=analysis_function_dictionary,
+    tenant_id=tenant_id,
+    llm_model=CODE_OBSERVATION_LLM_MODEL, # None keeps the prompt's model
     chats_collection=tenant_collections.get_collection(tenant_id, "chats"),
     prompts_collection=tenant_collections.get_collection(tenant_id, "prompts"),
     documents_collection=tenant_collections.get_collection(tenant_id, "documents"),
-    tools_collection=tenant_collections.get_collection(tenant_id, "tools")
+    tools_collection=tenant_collections.get_collection(tenant_id, "tools"),
+    usage_collection=tenant_collections.get_collection(tenant_id, "llm_usage")
   )
 
   code_message_object = CodePairMessage(
@@ -286,7 +295,7 @@ async def add_code_to_analysis_session(
     code_pair=code
   )
 
-  analysis_collection.update_one(
+  await analysis_collection.update_one(
     {"session_id": session_id}, 
     {"$push": {"code_snippets": code_message_object.model_dump(exclude_none=True)}}
   )
@@ -297,10 +306,10 @@ async def add_code_to_analysis_session(
 @analysis_router.get("/{session_id}/code/{message_id}", response_model=CodePairMessage)
 async def get_code_from_analysis_session(session_id: str, message_id: str, tenant_id: str = "default"):
   analysis_collection = tenant_collections.get_collection(tenant_id, "analysis")
-  if not analysis_collection.count_documents({"session_id": session_id}):
+  if not await analysis_collection.count_documents({"session_id": session_id}):
     raise HTTPException(status_code=404, detail="Analysis session not found")
 
-  code_message = analysis_collection.find_one({"session_id": session_id, "code_snippets.message_id": message_id}, {"_id": 0})
+  code_message = await analysis_collection.find_one({"session_id": session_id, "code_snippets.message_id": message_id}, {"_id": 0})
   if not code_message:
     raise HTTPException(status_code=404, detail="Code message not found")
   
@@ -327,7 +336,7 @@ async def update_analysis_session(
   if not update_fields:
     raise HTTPException(status_code=400, detail="No fields to update provided")
 
-  result = analysis_collection.find_one_and_update(
+  result = await analysis_collection.find_one_and_update(
     {"session_id": session_id},
     {"$set": update_fields},
     return_document=True,
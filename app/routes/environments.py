@@ -1,11 +1,23 @@
-from typing import Dict, Optional
-from fastapi import APIRouter, HTTPException, BackgroundTasks
-from app.core.models import SessionEnvFile
-from app.services.analysis_services import upload_file_to_gridfs, get_file_from_gridfs
+from typing import Dict, List, Optional
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from app.core.models import (
+  SessionEnvFile, EnvChunkHashes, EnvSnapshot, EnvSnapshotVersion,
+  EnvUpload, EnvUploadPart, EnvUploadComplete
+)
+from app.core.utils import CDC_MAX_SIZE
+from app.services.environment_services import (
+  upload_file_to_gridfs, upload_stream_to_gridfs, get_file_from_gridfs,
+  open_file_from_gridfs, parse_range_header, accepts_encoding, get_gridfs_bucket,
+  find_missing_chunks, store_chunk, commit_snapshot, validate_chunk_hash,
+  find_snapshot, restore_snapshot
+)
+from app.services.upload_services import (
+  initiate_upload, get_upload, upload_part, complete_upload, abort_upload
+)
 from magenta.core.config import tenant_collections
 from base64 import b64decode
-import re
-from gridfs import GridFS
+from binascii import Error as Base64Error
 from magenta.core.config import logger
 
 
@@ -16,12 +28,12 @@ environments_router = APIRouter(prefix="/environments", tags=["environments"])
 async def get_environment(session_id: str, tenant_id: str = "default"):
   # First verify the analysis session exists and get its context_id
   analysis_collection = tenant_collections.get_collection(tenant_id, "analysis")
-  analysis_session = analysis_collection.find_one({"session_id": session_id})
+  analysis_session = await analysis_collection.find_one({"session_id": session_id})
   if not analysis_session:
     raise HTTPException(status_code=404, detail="Analysis session not found")
   
   env_collection = tenant_collections.get_collection(tenant_id, "environments")
-  env_file = env_collection.find_one({"session_id": session_id}, {"_id": 0})
+  env_file = await env_collection.find_one({"session_id": session_id}, {"_id": 0})
   
   if not env_file:
     raise HTTPException(status_code=404, detail="Environment file not found")
@@ -38,44 +50,39 @@ async def get_environment(session_id: str, tenant_id: str = "default"):
   return SessionEnvFile(**env_file)
 
 
-def is_valid_base64(s: str) -> bool:
-    # Check if string is valid base64 format
-    pattern = r'^[A-Za-z0-9+/]*={0,2}$'
-    if not re.match(pattern, s):
-        return False
-    
-    # Check if padding is correct
+def decode_base64(s: str) -> Optional[bytes]:
+    # Decode strict base64 (alphabet and padding checked), None if invalid. Decoded once and reused for the upload
     if len(s) % 4:
-        return False
-    
+        return None
     try:
-        b64decode(s)
-        return True
-    except Exception:
-        return False
+        return b64decode(s, validate=True)
+    except (Base64Error, ValueError):
+        return None
 
 
 @environments_router.post("/{session_id}", response_model=SessionEnvFile)
 async def create_environment(
   session_id: str,
   env_file: SessionEnvFile,
-  background_tasks: BackgroundTasks,
   tenant_id: str = "default"
 ):
   # Verify the analysis session exists and get its context_id
   analysis_collection = tenant_collections.get_collection(tenant_id, "analysis")
-  analysis_session = analysis_collection.find_one({"session_id": session_id})
+  analysis_session = await analysis_collection.find_one({"session_id": session_id})
   if not analysis_session:
     raise HTTPException(status_code=404, detail="Analysis session not found")
   
   # Verify the base64 encoding
-  if env_file.env_file and not is_valid_base64(env_file.env_file):
-    raise HTTPException(status_code=400, detail="Invalid base64 encoding")
+  file_bytes = None
+  if env_file.env_file:
+    file_bytes = decode_base64(env_file.env_file)
+    if file_bytes is None:
+      raise HTTPException(status_code=400, detail="Invalid base64 encoding")
   
   env_collection = tenant_collections.get_collection(tenant_id, "environments")
   
   # Check if environment already exists
-  if env_collection.find_one({"session_id": session_id}):
+  if await env_collection.find_one({"session_id": session_id}):
     raise HTTPException(status_code=400, detail="Environment file already exists for this session")
   
   # Create initial document without the file content
@@ -84,16 +91,12 @@ async def create_environment(
     "context_id": analysis_session["context_id"],
     "tenant_id": tenant_id
   }
-  env_collection.insert_one(env_data)
+  await env_collection.insert_one(env_data)
   
-  # Schedule file upload in background if file content exists
-  if env_file.env_file:
-    background_tasks.add_task(
-      upload_file_to_gridfs,
-      session_id,
-      env_file.env_file,
-      tenant_id
-    )
+  # Store the file before responding, so the new version is returned and upload errors reach the client
+  if file_bytes is not None:
+    snapshot = await upload_file_to_gridfs(session_id, file_bytes, tenant_id)
+    env_data.update(snapshot_id=snapshot["snapshot_id"], version=snapshot["version"], size=snapshot["size"])
   
   return SessionEnvFile(**env_data)
 
@@ -102,18 +105,20 @@ async def create_environment(
 async def update_environment(
   session_id: str,
   env_file: SessionEnvFile,
-  background_tasks: BackgroundTasks,
   tenant_id: str = "default"
 ):
   # Verify the analysis session exists and get its context_id
   analysis_collection = tenant_collections.get_collection(tenant_id, "analysis")
-  analysis_session = analysis_collection.find_one({"session_id": session_id})
+  analysis_session = await analysis_collection.find_one({"session_id": session_id})
   if not analysis_session:
     raise HTTPException(status_code=404, detail="Analysis session not found")
   
   # Verify the base64 encoding
-  if env_file.env_file and not is_valid_base64(env_file.env_file):
-    raise HTTPException(status_code=400, detail="Invalid base64 encoding")
+  file_bytes = None
+  if env_file.env_file:
+    file_bytes = decode_base64(env_file.env_file)
+    if file_bytes is None:
+      raise HTTPException(status_code=400, detail="Invalid base64 encoding")
   
   env_collection = tenant_collections.get_collection(tenant_id, "environments")
   
@@ -123,7 +128,7 @@ async def update_environment(
     "tenant_id": tenant_id
   }
   
-  result = env_collection.find_one_and_update(
+  result = await env_collection.find_one_and_update(
     {"session_id": session_id},
     {"$set": update_fields},
     return_document=True,
@@ -136,37 +141,274 @@ async def update_environment(
   if "file_id" in result:
     result["file_id"] = str(result["file_id"])
 
-  # Schedule file upload in background if file content exists
-  if env_file.env_file:
-    background_tasks.add_task(
-      upload_file_to_gridfs,
-      session_id,
-      env_file.env_file,
-      tenant_id
-    )
+  # Store the file before responding, so the new version is returned and upload errors reach the client
+  if file_bytes is not None:
+    snapshot = await upload_file_to_gridfs(session_id, file_bytes, tenant_id)
+    result.update(snapshot_id=snapshot["snapshot_id"], version=snapshot["version"], size=snapshot["size"])
   
   return SessionEnvFile(**result)
 
 
+@environments_router.put("/{session_id}/file", response_model=SessionEnvFile)
+async def upload_environment_file(
+  session_id: str,
+  request: Request,
+  code_snippet_id: Optional[str] = None,
+  tenant_id: str = "default"
+):
+  # Binary (application/octet-stream) upload, streamed straight into GridFS
+  analysis_collection = tenant_collections.get_collection(tenant_id, "analysis")
+  analysis_session = await analysis_collection.find_one({"session_id": session_id})
+  if not analysis_session:
+    raise HTTPException(status_code=404, detail="Analysis session not found")
+
+  env_collection = tenant_collections.get_collection(tenant_id, "environments")
+  await env_collection.update_one(
+    {"session_id": session_id},
+    {"$set": {"context_id": analysis_session["context_id"], "tenant_id": tenant_id}},
+    upsert=True
+  )
+
+  snapshot = await upload_stream_to_gridfs(session_id, request.stream(), tenant_id, code_snippet_id=code_snippet_id)
+
+  return SessionEnvFile(
+    session_id=session_id,
+    context_id=analysis_session["context_id"],
+    tenant_id=tenant_id,
+    snapshot_id=snapshot["snapshot_id"],
+    version=snapshot["version"],
+    size=snapshot["size"]
+  )
+
+
+@environments_router.get("/{session_id}/file")
+async def download_environment_file(
+  session_id: str,
+  request: Request,
+  version: Optional[int] = None,
+  tenant_id: str = "default"
+):
+  # Binary download streamed from GridFS, supports single byte ranges. Earlier snapshots by version
+  env_file = await open_file_from_gridfs(session_id, tenant_id, version=version)
+  if env_file is None:
+    raise HTTPException(status_code=404, detail="Environment file not found")
+
+  # Clients that send Accept-Encoding: zstd get the stored compressed chunks as they are.
+  # Ranges apply to the uncompressed file only, so they are not combined with an encoding
+  range_header = request.headers.get("range")
+  if env_file.chunks and not range_header and accepts_encoding(request.headers.get("accept-encoding", ""), "zstd"):
+    return StreamingResponse(
+      env_file.iter_zstd(),
+      media_type="application/octet-stream",
+      headers={"Content-Encoding": "zstd", "Vary": "Accept-Encoding", "Accept-Ranges": "bytes"}
+    )
+
+  file_size = env_file.length
+  headers = {"Accept-Ranges": "bytes", "Vary": "Accept-Encoding"}
+  start, end, status_code = 0, file_size - 1, 200
+
+  if range_header:
+    try:
+      byte_range = parse_range_header(range_header, file_size)
+    except ValueError:
+      byte_range = (start, end) # malformed ranges are ignored
+    else:
+      if byte_range is None:
+        raise HTTPException(
+          status_code=416, 
+          detail="Requested range not satisfiable",
+          headers={"Content-Range": f"bytes */{file_size}"}
+        )
+      start, end = byte_range
+      headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+      status_code = 206
+
+  headers["Content-Length"] = str(end - start + 1)
+  return StreamingResponse(
+    env_file.iter_range(start, end),
+    status_code=status_code,
+    media_type="application/octet-stream",
+    headers=headers
+  )
+
+
+# Chunked snapshot upload: the client cuts the file with app.core.utils.iter_content_defined_chunks,
+# asks which chunks are missing, uploads only those and then commits the list of hashes as the new snapshot
+
+@environments_router.post("/{session_id}/chunks/missing", response_model=EnvChunkHashes)
+async def get_missing_chunks(session_id: str, chunk_hashes: EnvChunkHashes, tenant_id: str = "default"):
+  analysis_collection = tenant_collections.get_collection(tenant_id, "analysis")
+  if not await analysis_collection.count_documents({"session_id": session_id}, limit=1):
+    raise HTTPException(status_code=404, detail="Analysis session not found")
+
+  return EnvChunkHashes(chunks=await find_missing_chunks(chunk_hashes.chunks, tenant_id))
+
+
+@environments_router.put("/{session_id}/chunks/{sha256}", response_model=Dict[str, str])
+async def upload_environment_chunk(
+  session_id: str,
+  sha256: str,
+  request: Request,
+  tenant_id: str = "default"
+):
+  validate_chunk_hash(sha256)
+  analysis_collection = tenant_collections.get_collection(tenant_id, "analysis")
+  if not await analysis_collection.count_documents({"session_id": session_id}, limit=1):
+    raise HTTPException(status_code=404, detail="Analysis session not found")
+
+  data = await request.body()
+  if len(data) > CDC_MAX_SIZE:
+    raise HTTPException(status_code=413, detail=f"Chunks can be at most {CDC_MAX_SIZE} bytes")
+
+  await store_chunk(data, tenant_id, sha256=sha256)
+  return {"sha256": sha256}
+
+
+@environments_router.put("/{session_id}/snapshot", response_model=EnvSnapshot)
+async def commit_environment_snapshot(
+  session_id: str,
+  chunk_hashes: EnvChunkHashes,
+  code_snippet_id: Optional[str] = None,
+  tenant_id: str = "default"
+):
+  analysis_collection = tenant_collections.get_collection(tenant_id, "analysis")
+  analysis_session = await analysis_collection.find_one({"session_id": session_id})
+  if not analysis_session:
+    raise HTTPException(status_code=404, detail="Analysis session not found")
+
+  env_collection = tenant_collections.get_collection(tenant_id, "environments")
+  await env_collection.update_one(
+    {"session_id": session_id},
+    {"$set": {"context_id": analysis_session["context_id"], "tenant_id": tenant_id}},
+    upsert=True
+  )
+
+  snapshot = await commit_snapshot(session_id, chunk_hashes.chunks, tenant_id, code_snippet_id=code_snippet_id)
+  return EnvSnapshot(**snapshot)
+
+
+@environments_router.get("/{session_id}/snapshot", response_model=EnvSnapshot)
+async def get_environment_snapshot(session_id: str, version: Optional[int] = None, tenant_id: str = "default"):
+  # the chunk manifest of the current (or an earlier) snapshot, lets clients skip chunks they know the server has
+  if version is not None:
+    env = await find_snapshot(session_id, tenant_id, version=version)
+  else:
+    env_collection = tenant_collections.get_collection(tenant_id, "environments")
+    env = await env_collection.find_one(
+      {"session_id": session_id},
+      {"_id": 0, "session_id": 1, "snapshot_id": 1, "version": 1, "size": 1, "chunks": 1}
+    )
+  if not env:
+    raise HTTPException(status_code=404, detail="Environment file not found")
+
+  return EnvSnapshot(**env)
+
+
+@environments_router.get("/{session_id}/versions", response_model=List[EnvSnapshotVersion])
+async def get_environment_versions(session_id: str, tenant_id: str = "default"):
+  # snapshot history of the session, newest first
+  snapshots_collection = tenant_collections.get_collection(tenant_id, "environment_snapshots")
+  versions = await snapshots_collection.find(
+    {"session_id": session_id},
+    {"_id": 0, "chunks": 0}
+  ).sort("version", -1).to_list(length=None)
+  if not versions:
+    raise HTTPException(status_code=404, detail="Environment file not found")
+
+  return versions
+
+
+@environments_router.post("/{session_id}/restore", response_model=EnvSnapshotVersion)
+async def restore_environment(
+  session_id: str,
+  version: Optional[int] = None,
+  code_snippet_id: Optional[str] = None,
+  tenant_id: str = "default"
+):
+  # make an earlier snapshot current again, by version or by the code snippet it was saved after
+  if version is None and code_snippet_id is None:
+    raise HTTPException(status_code=400, detail="Either version or code_snippet_id is required")
+
+  return await restore_snapshot(session_id, tenant_id, version=version, code_snippet_id=code_snippet_id)
+
+
+# Resumable uploads: initiate, PUT parts (any order, in parallel, retry what failed), complete
+
+@environments_router.post("/{session_id}/uploads", response_model=EnvUpload)
+async def initiate_environment_upload(
+  session_id: str,
+  code_snippet_id: Optional[str] = None,
+  tenant_id: str = "default"
+):
+  analysis_collection = tenant_collections.get_collection(tenant_id, "analysis")
+  analysis_session = await analysis_collection.find_one({"session_id": session_id})
+  if not analysis_session:
+    raise HTTPException(status_code=404, detail="Analysis session not found")
+
+  env_collection = tenant_collections.get_collection(tenant_id, "environments")
+  await env_collection.update_one(
+    {"session_id": session_id},
+    {"$set": {"context_id": analysis_session["context_id"], "tenant_id": tenant_id}},
+    upsert=True
+  )
+
+  return await initiate_upload(session_id, tenant_id, code_snippet_id=code_snippet_id)
+
+
+@environments_router.get("/{session_id}/uploads/{upload_id}", response_model=EnvUpload)
+async def get_environment_upload(session_id: str, upload_id: str, tenant_id: str = "default"):
+  # lists the parts received so far, so an interrupted client knows what to resend
+  return await get_upload(session_id, upload_id, tenant_id)
+
+
+@environments_router.put("/{session_id}/uploads/{upload_id}/parts/{part_number}", response_model=EnvUploadPart)
+async def upload_environment_part(
+  session_id: str,
+  upload_id: str,
+  part_number: int,
+  sha256: str,
+  request: Request,
+  tenant_id: str = "default"
+):
+  return await upload_part(session_id, upload_id, part_number, request.stream(), sha256, tenant_id)
+
+
+@environments_router.post("/{session_id}/uploads/{upload_id}/complete", response_model=EnvSnapshot)
+async def complete_environment_upload(
+  session_id: str,
+  upload_id: str,
+  upload_complete: EnvUploadComplete,
+  tenant_id: str = "default"
+):
+  return await complete_upload(session_id, upload_id, upload_complete.parts, tenant_id)
+
+
+@environments_router.delete("/{session_id}/uploads/{upload_id}", response_model=Dict[str, str])
+async def abort_environment_upload(session_id: str, upload_id: str, tenant_id: str = "default"):
+  await abort_upload(session_id, upload_id, tenant_id)
+  return {"status": "success"}
+
+
 @environments_router.delete("/{session_id}", response_model=Dict[str, str])
 async def delete_environment(session_id: str, tenant_id: str = "default"):
   env_collection = tenant_collections.get_collection(tenant_id, "environments")
   
   # First get the environment to check for file_id
-  env = env_collection.find_one({"session_id": session_id})
+  env = await env_collection.find_one({"session_id": session_id})
   if not env:
     raise HTTPException(status_code=404, detail="Environment file not found")
   
-  # Delete GridFS file if it exists
+  # Delete GridFS file if it exists. Snapshot chunks may be shared with other sessions so they stay
   if "file_id" in env:
-    db = tenant_collections.mongo_client[tenant_id]
-    fs = GridFS(db)
+    fs = get_gridfs_bucket(tenant_id)
     try:
-      fs.delete(env["file_id"])
+      await fs.delete(env["file_id"])
     except Exception as e:
       logger.error(f"Error deleting GridFS file for session {session_id}: {e}")
     
-  # Delete the environment document
-  env_collection.delete_one({"session_id": session_id})
+  # Delete the environment document and its snapshot history
+  await env_collection.delete_one({"session_id": session_id})
+  snapshots_collection = tenant_collections.get_collection(tenant_id, "environment_snapshots")
+  await snapshots_collection.delete_many({"session_id": session_id})
     
   return {"status": "success"}
@@ -0,0 +1,33 @@
+from typing import List, Optional
+from fastapi import APIRouter, HTTPException, Query
+from app.services.garbage_collection import run_garbage_collection, collect_orphaned_vector_tables, ENV_GC_BATCH_SIZE, ENV_GC_MAX_BATCHES
+
+
+maintenance_router = APIRouter(prefix="/maintenance", tags=["maintenance"])
+
+
+@maintenance_router.post("/gc", response_model=dict)
+async def collect_garbage(
+  dry_run: bool = True,
+  tenant_id: Optional[str] = None,
+  batch_size: int = Query(ENV_GC_BATCH_SIZE, gt=0, le=5000),
+  max_batches: int = Query(ENV_GC_MAX_BATCHES, gt=0)
+):
+  # report (and with dry_run=false remove) orphaned environments, GridFS files and vectors
+  return await run_garbage_collection(
+    tenant_ids=[tenant_id] if tenant_id else None,
+    dry_run=dry_run,
+    batch_size=batch_size,
+    max_batches=max_batches
+  )
+
+
+@maintenance_router.post("/gc/vector_tables", response_model=dict)
+async def collect_vector_tables(
+  dry_run: bool = True,
+  tables: Optional[List[str]] = Query(None)
+):
+  # report the vector tables of removed tenants, with dry_run=false drop the listed ones
+  if not dry_run and not tables:
+    raise HTTPException(status_code=400, detail="List the tables to drop, from a dry run report")
+  return await collect_orphaned_vector_tables(tables=tables, dry_run=dry_run)
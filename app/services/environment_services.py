@@ -0,0 +1,469 @@
+import re
+import os
+import asyncio
+from datetime import datetime, timezone
+from typing import AsyncIterator, List, Optional, Tuple
+from base64 import b64encode
+from fastapi import HTTPException
+from gridfs.errors import FileExists
+from pymongo import ReturnDocument, DESCENDING
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from magenta.core.config import tenant_collections, logger
+from magenta.core.tracing import traced
+from app.core.utils import hash_chunk, aiter_content_defined_chunks, compress_chunk, decompress_chunk
+
+ENV_FILE_CHUNK_SIZE = 1024 * 1024 # GridFS chunk size and streaming read size for environment files
+SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+ENV_SNAPSHOT_RETENTION = int(os.getenv("ENV_SNAPSHOT_RETENTION", 20)) # versions kept per session
+
+
+def get_gridfs_bucket(tenant_id: str = "default") -> AsyncIOMotorGridFSBucket:
+  db = tenant_collections.mongo_client[tenant_id]
+  return AsyncIOMotorGridFSBucket(db, chunk_size_bytes=ENV_FILE_CHUNK_SIZE)
+
+
+def get_files_collection(tenant_id: str = "default"):
+  # the fs.files collection behind the GridFS bucket, used for cheap existence/size lookups
+  return tenant_collections.mongo_client[tenant_id]["fs.files"]
+
+
+def validate_chunk_hash(sha256: str) -> str:
+  if not SHA256_PATTERN.fullmatch(sha256):
+    raise HTTPException(status_code=400, detail=f"Invalid chunk hash: {sha256}")
+  return sha256
+
+
+@traced(tenant_id="tenant.id")
+async def find_missing_chunks(
+  hashes: List[str],
+  tenant_id: str = "default"
+) -> List[str]:
+  """
+  Check which chunk hashes are not yet stored for the tenant. Known chunks are marked as used,
+  so the garbage collector leaves them alone until the client has committed its snapshot
+  Returns: The unknown hashes, in the order given
+  """
+  for sha256 in hashes:
+    validate_chunk_hash(sha256)
+  files_collection = get_files_collection(tenant_id)
+  known = set(await files_collection.distinct("_id", {"_id": {"$in": list(set(hashes))}}))
+  if known:
+    await files_collection.update_many(
+      {"_id": {"$in": list(known)}},
+      {"$set": {"metadata.last_used": datetime.now(timezone.utc)}}
+    )
+  return [sha256 for sha256 in dict.fromkeys(hashes) if sha256 not in known]
+
+
+@traced(tenant_id="tenant.id")
+async def store_chunk(
+  data: bytes,
+  tenant_id: str = "default",
+  sha256: Optional[str] = None
+) -> str:
+  """
+  Store a content chunk as a GridFS file whose ID is its SHA-256, skipping chunks that already exist
+  Chunks are shared by every snapshot and session of the tenant. They are zstd compressed unless that
+  doesn't make them smaller, the codec and uncompressed size are kept in the file metadata
+  Returns: The chunk hash
+  Raises: HTTPException 400 if sha256 is given and doesn't match the data
+  """
+  actual_sha256 = hash_chunk(data)
+  if sha256 is not None and sha256 != actual_sha256:
+    raise HTTPException(status_code=400, detail=f"Chunk content does not match hash {sha256}")
+
+  existing = await get_files_collection(tenant_id).update_one(
+    {"_id": actual_sha256},
+    {"$set": {"metadata.last_used": datetime.now(timezone.utc)}}
+  )
+  if existing.matched_count:
+    return actual_sha256
+
+  compressed = await asyncio.to_thread(compress_chunk, data)
+  payload, codec = (compressed, "zstd") if len(compressed) < len(data) else (data, "identity")
+
+  try:
+    await get_gridfs_bucket(tenant_id).upload_from_stream_with_id(
+      actual_sha256,
+      f"chunk_{actual_sha256}",
+      payload,
+      metadata={"kind": "env_chunk", "codec": codec, "size": len(data)}
+    )
+  except FileExists:
+    pass # uploaded concurrently by another snapshot, same content
+  return actual_sha256
+
+
+async def get_latest_code_snippet_id(session_id: str, tenant_id: str = "default") -> Optional[str]:
+  # the code snippet the environment was most likely saved after (the notebook auto-saves after each cell)
+  analysis_collection = tenant_collections.get_collection(tenant_id, "analysis")
+  results = await analysis_collection.aggregate([
+    {"$match": {"session_id": session_id}},
+    {"$project": {"_id": 0, "message_id": {"$arrayElemAt": ["$code_snippets.message_id", -1]}}}
+  ]).to_list(length=1)
+  return results[0].get("message_id") if results else None
+
+
+@traced(session_id="session.id", tenant_id="tenant.id")
+async def record_snapshot(
+  session_id: str,
+  snapshot: dict,
+  tenant_id: str = "default",
+  code_snippet_id: Optional[str] = None,
+  restored_from: Optional[int] = None
+) -> dict:
+  """
+  Add a snapshot (snapshot_id, chunks, size) to the history of the session as its next version and
+  point the environment at it. The pointer only ever moves forward, so a slow upload finishing after
+  a newer one doesn't replace it
+  Returns: The snapshot record
+  """
+  env_collection = tenant_collections.get_collection(tenant_id, "environments")
+  snapshots_collection = tenant_collections.get_collection(tenant_id, "environment_snapshots")
+
+  env = await env_collection.find_one_and_update(
+    {"session_id": session_id},
+    {"$inc": {"latest_version": 1}},
+    projection={"latest_version": 1},
+    upsert=True,
+    return_document=ReturnDocument.AFTER
+  )
+  version = env["latest_version"]
+
+  record = {
+    "session_id": session_id,
+    "version": version,
+    "snapshot_id": snapshot["snapshot_id"],
+    "chunks": snapshot["chunks"],
+    "size": snapshot["size"],
+    "code_snippet_id": code_snippet_id,
+    "restored_from": restored_from,
+    "created_at": datetime.now(timezone.utc)
+  }
+  await snapshots_collection.insert_one(record)
+  record.pop("_id", None)
+
+  previous = await env_collection.find_one_and_update(
+    {"session_id": session_id, "$or": [{"version": {"$exists": False}}, {"version": {"$lt": version}}]},
+    {
+      "$set": {
+        "snapshot_id": snapshot["snapshot_id"],
+        "chunks": snapshot["chunks"],
+        "size": snapshot["size"],
+        "version": version
+      },
+      "$unset": {"file_id": ""}
+    }
+  )
+  # environments stored before chunking kept a single GridFS file, it's not shared so it can go
+  if previous and "file_id" in previous:
+    try:
+      await get_gridfs_bucket(tenant_id).delete(previous["file_id"])
+    except Exception as e:
+      logger.error(f"Error deleting old GridFS file for session {session_id}: {e}")
+
+  await prune_snapshots(session_id, version, tenant_id)
+  return record
+
+
+async def prune_snapshots(session_id: str, latest_version: int, tenant_id: str = "default") -> int:
+  """
+  Apply the retention policy: keep the last ENV_SNAPSHOT_RETENTION versions of a session.
+  Chunks no snapshot references anymore are left to the garbage collector
+  Returns: The number of versions removed
+  """
+  snapshots_collection = tenant_collections.get_collection(tenant_id, "environment_snapshots")
+  result = await snapshots_collection.delete_many(
+    {"session_id": session_id, "version": {"$lte": latest_version - ENV_SNAPSHOT_RETENTION}}
+  )
+  return result.deleted_count
+
+
+@traced(session_id="session.id", tenant_id="tenant.id")
+async def commit_snapshot(
+  session_id: str,
+  hashes: List[str],
+  tenant_id: str = "default",
+  code_snippet_id: Optional[str] = None
+) -> dict:
+  """
+  Make the snapshot made of the given (already stored) chunks the next version of the session environment
+  Without a code_snippet_id the snapshot is attached to the latest code snippet of the analysis session
+  Returns: The snapshot record
+  Raises: HTTPException 400 if any chunk is unknown
+  """
+  for sha256 in hashes:
+    validate_chunk_hash(sha256)
+  # uncompressed sizes, chunks stored before compression only have the GridFS length
+  lengths = {
+    file["_id"]: file.get("metadata", {}).get("size", file["length"])
+    async for file in get_files_collection(tenant_id).find(
+      {"_id": {"$in": list(set(hashes))}},
+      {"length": 1, "metadata.size": 1}
+    )
+  }
+  missing = [sha256 for sha256 in hashes if sha256 not in lengths]
+  if missing:
+    raise HTTPException(status_code=400, detail=f"Unknown chunks: {', '.join(missing[:10])}")
+
+  chunks = [{"sha256": sha256, "size": lengths[sha256]} for sha256 in hashes]
+  snapshot = {
+    "snapshot_id": hash_chunk("".join(hashes).encode()),
+    "chunks": chunks,
+    "size": sum(chunk["size"] for chunk in chunks)
+  }
+
+  if code_snippet_id is None:
+    code_snippet_id = await get_latest_code_snippet_id(session_id, tenant_id)
+  return await record_snapshot(session_id, snapshot, tenant_id, code_snippet_id=code_snippet_id)
+
+
+async def find_snapshot(
+  session_id: str,
+  tenant_id: str = "default",
+  version: Optional[int] = None,
+  code_snippet_id: Optional[str] = None
+) -> Optional[dict]:
+  """
+  Look up a snapshot of the session by version, or the latest one taken after the given code snippet
+  Returns: The snapshot record, or None if it doesn't exist (anymore)
+  """
+  snapshots_collection = tenant_collections.get_collection(tenant_id, "environment_snapshots")
+  query = {"session_id": session_id}
+  if version is not None:
+    query["version"] = version
+  if code_snippet_id is not None:
+    query["code_snippet_id"] = code_snippet_id
+  return await snapshots_collection.find_one(query, {"_id": 0}, sort=[("version", DESCENDING)])
+
+
+@traced(session_id="session.id", tenant_id="tenant.id")
+async def restore_snapshot(
+  session_id: str,
+  tenant_id: str = "default",
+  version: Optional[int] = None,
+  code_snippet_id: Optional[str] = None
+) -> dict:
+  """
+  Restore an earlier snapshot by recording it again as the newest version. No data is copied,
+  the new version points at the same chunks
+  Returns: The new snapshot record
+  Raises: HTTPException 404 if there's no such snapshot
+  """
+  snapshot = await find_snapshot(session_id, tenant_id, version=version, code_snippet_id=code_snippet_id)
+  if not snapshot:
+    raise HTTPException(status_code=404, detail="Snapshot not found")
+
+  return await record_snapshot(
+    session_id,
+    snapshot,
+    tenant_id,
+    code_snippet_id=snapshot["code_snippet_id"],
+    restored_from=snapshot["version"]
+  )
+
+
+@traced(session_id="session.id", tenant_id="tenant.id")
+async def upload_stream_to_gridfs(
+  session_id: str,
+  chunks: AsyncIterator[bytes],
+  tenant_id: str = "default",
+  code_snippet_id: Optional[str] = None
+) -> dict:
+  """
+  Store an environment file streamed from the client as a chunked snapshot,
+  only chunks the tenant doesn't have yet are written
+  Returns: The snapshot record
+  """
+  try:
+    hashes = []
+    async for chunk in aiter_content_defined_chunks(chunks):
+      hashes.append(await store_chunk(chunk, tenant_id))
+    return await commit_snapshot(session_id, hashes, tenant_id, code_snippet_id=code_snippet_id)
+
+  except HTTPException:
+    raise
+  except Exception as e:
+    logger.error(f"Error uploading file to GridFS for session {session_id}: {e}")
+    raise HTTPException(status_code=500, detail=f"Error uploading file: {str(e)}")
+
+
+@traced(session_id="session.id", tenant_id="tenant.id")
+async def upload_file_to_gridfs(
+  session_id: str,
+  file_content: bytes,
+  tenant_id: str = "default"
+) -> dict:
+  """
+  Upload an (already decoded) environment file as a chunked snapshot
+  Returns: The snapshot record
+  """
+  async def single_chunk():
+    yield file_content
+
+  return await upload_stream_to_gridfs(session_id, single_chunk(), tenant_id)
+
+
+@traced()
+async def iter_gridfs_file(
+  grid_out,
+  start: int = 0,
+  end: Optional[int] = None
+) -> AsyncIterator[bytes]:
+  """
+  Yield the bytes start..end (inclusive) of a GridFS file one chunk at a time
+  """
+  if end is None:
+    end = grid_out.length - 1
+  remaining = end - start + 1
+  grid_out.seek(start)
+  while remaining > 0:
+    chunk = await grid_out.readchunk()
+    if not chunk:
+      break
+    chunk = chunk[:remaining]
+    remaining -= len(chunk)
+    yield chunk
+
+
+class EnvironmentFile:
+  """
+  Read access to the current environment of a session, either a chunked snapshot
+  or a single GridFS file (environments stored before snapshots were chunked)
+  """
+  def __init__(self, fs: AsyncIOMotorGridFSBucket, chunks: Optional[List[dict]] = None, grid_out=None):
+    self.fs = fs
+    self.chunks = chunks
+    self.grid_out = grid_out
+    self.length = sum(chunk["size"] for chunk in chunks) if chunks is not None else grid_out.length
+
+  async def read_chunk(self, sha256: str, decompress: bool = True) -> Tuple[bytes, str]:
+    # a stored chunk and its codec ("zstd" or "identity"), decompressed unless asked otherwise
+    grid_out = await self.fs.open_download_stream(sha256)
+    data = await grid_out.read()
+    codec = (grid_out.metadata or {}).get("codec", "identity")
+    if codec == "zstd" and decompress:
+      return await asyncio.to_thread(decompress_chunk, data), "identity"
+    return data, codec
+
+  async def iter_range(self, start: int = 0, end: Optional[int] = None) -> AsyncIterator[bytes]:
+    # yield the bytes start..end (inclusive), reading only the chunks that overlap the range
+    if end is None:
+      end = self.length - 1
+    if self.chunks is None:
+      async for data in iter_gridfs_file(self.grid_out, start, end):
+        yield data
+      return
+
+    offset = 0
+    for chunk in self.chunks:
+      chunk_start, chunk_end = offset, offset + chunk["size"] - 1
+      offset += chunk["size"]
+      if chunk_end < start or chunk["size"] == 0:
+        continue
+      if chunk_start > end:
+        break
+      data, _ = await self.read_chunk(chunk["sha256"])
+      yield data[max(start - chunk_start, 0):min(end, chunk_end) - chunk_start + 1]
+
+  async def iter_zstd(self) -> AsyncIterator[bytes]:
+    # the whole file as a zstd stream: stored frames as they are, chunks stored uncompressed get compressed here
+    for chunk in self.chunks:
+      data, codec = await self.read_chunk(chunk["sha256"], decompress=False)
+      if codec != "zstd":
+        data = await asyncio.to_thread(compress_chunk, data)
+      yield data
+
+  async def read(self) -> bytes:
+    return b"".join([data async for data in self.iter_range()])
+
+
+@traced(session_id="session.id", tenant_id="tenant.id")
+async def open_file_from_gridfs(
+  session_id: str,
+  tenant_id: str = "default",
+  version: Optional[int] = None
+) -> Optional[EnvironmentFile]:
+  """
+  Open the environment file of a session (or one of its earlier versions) for reading
+  Returns: An EnvironmentFile, or None if the session has no file
+  """
+  try:
+    fs = get_gridfs_bucket(tenant_id)
+    if version is not None:
+      env_file = await find_snapshot(session_id, tenant_id, version=version)
+    else:
+      env_collection = tenant_collections.get_collection(tenant_id, "environments")
+      env_file = await env_collection.find_one({"session_id": session_id}, {"file_id": 1, "chunks": 1})
+
+    if not env_file:
+      return None
+    if "chunks" in env_file:
+      return EnvironmentFile(fs, chunks=env_file["chunks"])
+    if "file_id" in env_file:
+      return EnvironmentFile(fs, grid_out=await fs.open_download_stream(env_file["file_id"]))
+    return None
+
+  except Exception as e:
+    logger.error(f"Error retrieving file from GridFS for session {session_id}: {e}")
+    raise HTTPException(status_code=500, detail=f"Error retrieving file: {str(e)}")
+
+
+@traced(session_id="session.id", tenant_id="tenant.id")
+async def get_file_from_gridfs(
+  session_id: str,
+  tenant_id: str = "default"
+) -> str:
+  """
+  Retrieve an environment file and return it as base64
+  Returns: The file content as a base64 encoded string
+  """
+  env_file = await open_file_from_gridfs(session_id, tenant_id)
+  if env_file is None:
+    return None
+  content = await env_file.read()
+  return b64encode(content).decode()
+
+
+def accepts_encoding(accept_encoding: str, encoding: str) -> bool:
+  """
+  Check whether an Accept-Encoding header allows the given content coding (q=0 means refused)
+  """
+  for coding in accept_encoding.split(","):
+    name, _, params = coding.strip().partition(";")
+    if name.strip().lower() != encoding:
+      continue
+    for param in params.split(";"):
+      key, _, value = param.strip().partition("=")
+      if key.strip() == "q":
+        try:
+          return float(value) > 0
+        except ValueError:
+          return False
+    return True
+  return False
+
+
+def parse_range_header(range_header: str, file_size: int) -> Optional[Tuple[int, int]]:
+  """
+  Parse a single 'bytes=start-end' Range header against a file of file_size bytes
+  Returns: (start, end) inclusive, or None if the range can't be satisfied
+  Raises: ValueError if the header is malformed (callers should then ignore it)
+  """
+  unit, _, byte_range = range_header.partition("=")
+  if unit.strip() != "bytes" or "," in byte_range:
+    raise ValueError(f"Unsupported range: {range_header}")
+
+  start_str, _, end_str = byte_range.strip().partition("-")
+  if start_str == "":
+    # suffix range: the last n bytes
+    suffix_length = int(end_str)
+    if suffix_length == 0 or file_size == 0:
+      return None
+    return max(file_size - suffix_length, 0), file_size - 1
+
+  start = int(start_str)
+  end = int(end_str) if end_str else file_size - 1
+  if start > end or start >= file_size:
+    return None
+  return start, min(end, file_size - 1)
@@ -0,0 +1,278 @@
+import os
+import asyncio
+from datetime import datetime, timezone, timedelta
+from typing import Any, List, Optional, Tuple
+from bson import ObjectId
+from magenta.core.config import tenant_collections, logger
+from magenta.services.garbage_collection import collect_orphaned_vectors, drop_orphaned_vector_tables
+from app.services.environment_services import get_gridfs_bucket, get_files_collection
+
+# Garbage collection of environment storage and vectors. Every collector scans one bounded batch
+# (in key order, resuming after the last one) and removes what nothing references anymore.
+# Files younger than the grace period are left alone, they may belong to an upload in progress
+ENV_GC_INTERVAL_SECONDS = int(os.getenv("ENV_GC_INTERVAL_SECONDS", 3600)) # 0 disables the background collector
+ENV_GC_DRY_RUN = os.getenv("ENV_GC_DRY_RUN", "true").lower() in ("1", "true") # the background collector only reports unless set to false
+ENV_GC_GRACE_SECONDS = int(os.getenv("ENV_GC_GRACE_SECONDS", 3600))
+ENV_GC_BATCH_SIZE = int(os.getenv("ENV_GC_BATCH_SIZE", 200))
+ENV_GC_MAX_BATCHES = int(os.getenv("ENV_GC_MAX_BATCHES", 50)) # per collector and tenant in one run
+
+BatchResult = Tuple[int, int, Optional[Any]] # (items collected, bytes reclaimed, _id to resume after or None when done)
+
+
+def get_grace_cutoff() -> datetime:
+  return datetime.now(timezone.utc) - timedelta(seconds=ENV_GC_GRACE_SECONDS)
+
+
+async def scan_batch(collection, query: dict, projection: dict, batch_size: int, after=None) -> List[dict]:
+  if after is not None:
+    query = {**query, "_id": {"$gt": after}}
+  return await collection.find(query, projection).sort("_id", 1).limit(batch_size).to_list(length=batch_size)
+
+
+def next_after(batch: List[dict], batch_size: int):
+  return batch[-1]["_id"] if len(batch) == batch_size else None
+
+
+async def delete_gridfs_files(tenant_id: str, files: List[dict], dry_run: bool) -> Tuple[int, int]:
+  if not dry_run:
+    fs = get_gridfs_bucket(tenant_id)
+    for file in files:
+      await fs.delete(file["_id"])
+  return len(files), sum(file.get("length", 0) for file in files)
+
+
+async def collect_orphaned_environments(tenant_id: str, dry_run: bool, batch_size: int, after=None) -> BatchResult:
+  # environment documents whose analysis session was deleted, with their snapshot history and legacy file
+  env_collection = tenant_collections.get_collection(tenant_id, "environments")
+  batch = await scan_batch(env_collection, {}, {"session_id": 1, "file_id": 1}, batch_size, after)
+  session_ids = [env["session_id"] for env in batch]
+  existing = set(await tenant_collections.get_collection(tenant_id, "analysis").distinct(
+    "session_id", {"session_id": {"$in": session_ids}}
+  ))
+  orphaned = [env for env in batch if env["session_id"] not in existing]
+
+  size = 0
+  legacy_file_ids = [env["file_id"] for env in orphaned if "file_id" in env]
+  if legacy_file_ids:
+    legacy_files = await get_files_collection(tenant_id).find({"_id": {"$in": legacy_file_ids}}, {"length": 1}).to_list(length=None)
+    size += (await delete_gridfs_files(tenant_id, legacy_files, dry_run))[1]
+
+  if orphaned and not dry_run:
+    orphaned_session_ids = [env["session_id"] for env in orphaned]
+    await tenant_collections.get_collection(tenant_id, "environment_snapshots").delete_many({"session_id": {"$in": orphaned_session_ids}})
+    await env_collection.delete_many({"_id": {"$in": [env["_id"] for env in orphaned]}})
+  return len(orphaned), size, next_after(batch, batch_size)
+
+
+async def collect_orphaned_snapshots(tenant_id: str, dry_run: bool, batch_size: int, after=None) -> BatchResult:
+  # snapshot history records left behind by an environment that no longer exists
+  snapshots_collection = tenant_collections.get_collection(tenant_id, "environment_snapshots")
+  batch = await scan_batch(snapshots_collection, {}, {"session_id": 1}, batch_size, after)
+  existing = set(await tenant_collections.get_collection(tenant_id, "environments").distinct(
+    "session_id", {"session_id": {"$in": list({snapshot["session_id"] for snapshot in batch})}}
+  ))
+  orphaned = [snapshot["_id"] for snapshot in batch if snapshot["session_id"] not in existing]
+  if orphaned and not dry_run:
+    await snapshots_collection.delete_many({"_id": {"$in": orphaned}})
+  return len(orphaned), 0, next_after(batch, batch_size)
+
+
+async def collect_unreferenced_chunks(tenant_id: str, dry_run: bool, batch_size: int, after=None) -> BatchResult:
+  # content chunks no current environment or retained snapshot points at
+  cutoff = get_grace_cutoff()
+  batch = await scan_batch(
+    get_files_collection(tenant_id),
+    {
+      "metadata.kind": "env_chunk",
+      "uploadDate": {"$lt": cutoff},
+      "$or": [{"metadata.last_used": {"$exists": False}}, {"metadata.last_used": {"$lt": cutoff}}]
+    },
+    {"length": 1},
+    batch_size,
+    after
+  )
+  hashes = [file["_id"] for file in batch]
+  referenced = set()
+  for collection_name in ["environments", "environment_snapshots"]:
+    referenced.update(await tenant_collections.get_collection(tenant_id, collection_name).distinct(
+      "chunks.sha256", {"chunks.sha256": {"$in": hashes}}
+    ))
+  count, size = await delete_gridfs_files(tenant_id, [file for file in batch if file["_id"] not in referenced], dry_run)
+  return count, size, next_after(batch, batch_size)
+
+
+async def collect_abandoned_upload_parts(tenant_id: str, dry_run: bool, batch_size: int, after=None) -> BatchResult:
+  # parts of resumable uploads that expired or were never completed
+  batch = await scan_batch(
+    get_files_collection(tenant_id),
+    {"metadata.kind": "env_upload_part", "uploadDate": {"$lt": get_grace_cutoff()}},
+    {"length": 1, "metadata.upload_id": 1},
+    batch_size,
+    after
+  )
+  existing = set(await tenant_collections.get_collection(tenant_id, "environment_uploads").distinct(
+    "upload_id", {"upload_id": {"$in": list({file["metadata"]["upload_id"] for file in batch})}}
+  ))
+  count, size = await delete_gridfs_files(
+    tenant_id, [file for file in batch if file["metadata"]["upload_id"] not in existing], dry_run
+  )
+  return count, size, next_after(batch, batch_size)
+
+
+async def collect_unreferenced_env_files(tenant_id: str, dry_run: bool, batch_size: int, after=None) -> BatchResult:
+  # single-file environments (stored before chunked snapshots) that no environment points at anymore
+  batch = await scan_batch(
+    get_files_collection(tenant_id),
+    {"metadata.kind": {"$exists": False}, "filename": {"$regex": "^env_"}, "uploadDate": {"$lt": get_grace_cutoff()}},
+    {"length": 1},
+    batch_size,
+    after
+  )
+  referenced = set(await tenant_collections.get_collection(tenant_id, "environments").distinct(
+    "file_id", {"file_id": {"$in": [file["_id"] for file in batch]}}
+  ))
+  count, size = await delete_gridfs_files(tenant_id, [file for file in batch if file["_id"] not in referenced], dry_run)
+  return count, size, next_after(batch, batch_size)
+
+
+PART_FILES_ID_RANGE = {"$gte": "part_", "$lt": "part`"} # upload part ids ("part_<upload_id>_<n>_<attempt>"), "`" sorts right after "_"
+FIRST_OBJECT_ID = ObjectId("0" * 24)
+
+
+async def collect_orphaned_gridfs_chunks(tenant_id: str, dry_run: bool, batch_size: int, after=None) -> BatchResult:
+  """
+  GridFS chunks without a files document, left by uploads that failed before GridFS could clean up.
+  Only files whose ID shows they can't still be in progress are collected: parts of uploads that no
+  longer exist and ObjectIds older than the grace period. Content chunks are written in one go and skipped.
+  The scan walks the files_id ranges of those two kinds on GridFS' (files_id, n) index, part ids
+  first, and reads only index keys
+  """
+  chunks_collection = tenant_collections.mongo_client[tenant_id]["fs.chunks"]
+  cutoff = get_grace_cutoff()
+  scanning_parts = after is None or isinstance(after, str)
+  if scanning_parts:
+    files_id_range = {**PART_FILES_ID_RANGE, **({"$gt": after} if after is not None else {})}
+  else:
+    files_id_range = {"$gt": after, "$lt": ObjectId.from_datetime(cutoff)}
+  batch = await chunks_collection.find(
+    {"files_id": files_id_range, "n": 0}, {"_id": 0, "files_id": 1}
+  ).sort("files_id", 1).hint([("files_id", 1), ("n", 1)]).limit(batch_size).to_list(length=batch_size)
+  files_ids = [chunk["files_id"] for chunk in batch]
+  existing = set(await get_files_collection(tenant_id).distinct("_id", {"_id": {"$in": files_ids}}))
+
+  candidates = [files_id for files_id in files_ids if files_id not in existing]
+  part_upload_ids = {files_id: files_id.split("_")[1] for files_id in candidates if isinstance(files_id, str)}
+  open_uploads = set(await tenant_collections.get_collection(tenant_id, "environment_uploads").distinct(
+    "upload_id", {"upload_id": {"$in": list(part_upload_ids.values())}}
+  ))
+  orphaned = [
+    files_id for files_id in candidates
+    if isinstance(files_id, ObjectId) or part_upload_ids[files_id] not in open_uploads
+  ]
+
+  size = 0
+  if orphaned:
+    sizes = await chunks_collection.aggregate([
+      {"$match": {"files_id": {"$in": orphaned}}},
+      {"$group": {"_id": None, "bytes": {"$sum": {"$binarySize": "$data"}}}}
+    ]).to_list(length=1)
+    size = sizes[0]["bytes"] if sizes else 0
+    if not dry_run:
+      await chunks_collection.delete_many({"files_id": {"$in": orphaned}})
+
+  if len(batch) == batch_size:
+    after = files_ids[-1]
+  else:
+    after = FIRST_OBJECT_ID if scanning_parts else None # the part ids are done, continue with the ObjectIds
+  return len(orphaned), size, after
+
+
+async def collect_orphaned_vector_rows(tenant_id: str, dry_run: bool, batch_size: int, after=None) -> BatchResult:
+  # vector rows (Postgres) of documents that no longer exist, paged by document id
+  report = await collect_orphaned_vectors(
+    tenant_id, tenant_collections.get_collection(tenant_id, "documents"), dry_run=dry_run, batch_size=batch_size, after=after
+  )
+  return report["count"], report["bytes"], report["after"]
+
+
+# in dependency order: dropping environments releases their chunks in the same run
+GARBAGE_COLLECTORS = {
+  "environments": collect_orphaned_environments,
+  "snapshots": collect_orphaned_snapshots,
+  "chunks": collect_unreferenced_chunks,
+  "upload_parts": collect_abandoned_upload_parts,
+  "env_files": collect_unreferenced_env_files,
+  "gridfs_chunks": collect_orphaned_gridfs_chunks,
+  "vectors": collect_orphaned_vector_rows
+}
+
+
+async def collect_tenant_garbage(
+  tenant_id: str,
+  dry_run: bool = False,
+  batch_size: int = ENV_GC_BATCH_SIZE,
+  max_batches: int = ENV_GC_MAX_BATCHES
+) -> dict:
+  """
+  Run every collector for one tenant, at most max_batches batches of batch_size each
+  Returns: {collector: {"count": items, "bytes": reclaimed bytes, "complete": whether the scan finished}}
+  """
+  report = {}
+  for name, collector in GARBAGE_COLLECTORS.items():
+    count, size, after = 0, 0, None
+    for _ in range(max_batches):
+      batch_count, batch_size_bytes, after = await collector(tenant_id, dry_run, batch_size, after)
+      count += batch_count
+      size += batch_size_bytes
+      if after is None:
+        break
+      await asyncio.sleep(0) # let requests through between batches
+    report[name] = {"count": count, "bytes": size, "complete": after is None}
+  return report
+
+
+async def run_garbage_collection(
+  tenant_ids: Optional[List[str]] = None,
+  dry_run: bool = False,
+  batch_size: int = ENV_GC_BATCH_SIZE,
+  max_batches: int = ENV_GC_MAX_BATCHES
+) -> dict:
+  """
+  Collect garbage for the given tenants, or for all tenants
+  Returns: A report with per tenant and collector counts and the total of reclaimed bytes
+  """
+  if tenant_ids is None:
+    tenant_ids = [tenant.tenant_id for tenant in await tenant_collections.refresh_tenants()]
+  report = {"dry_run": dry_run, "tenants": {}, "bytes": 0}
+
+  for tenant_id in tenant_ids:
+    try:
+      tenant_report = await collect_tenant_garbage(tenant_id, dry_run, batch_size, max_batches)
+    except Exception as e:
+      logger.error(f"Error collecting garbage for tenant {tenant_id}: {e}")
+      continue
+    report["tenants"][tenant_id] = tenant_report
+    report["bytes"] += sum(collected["bytes"] for collected in tenant_report.values())
+
+  logger.info(f"Garbage collection {'(dry run) ' if dry_run else ''}reclaimed {report['bytes']} bytes")
+  return report
+
+
+async def collect_orphaned_vector_tables(tables: Optional[List[str]] = None, dry_run: bool = True) -> dict:
+  """
+  Report the vector tables of removed tenants, or drop the listed ones (only run on request, never scheduled).
+  The tenants are read from Mongo first: the tenant cache of this worker may not know every tenant yet
+  Returns: {"dry_run", "count": tables, "bytes": table + index bytes, "tables": table names}
+  """
+  tenant_ids = [tenant.tenant_id for tenant in await tenant_collections.refresh_tenants()]
+  report = await drop_orphaned_vector_tables(tenant_ids + ["default"], tables=tables, dry_run=dry_run)
+  return {"dry_run": dry_run, **report}
+
+
+async def garbage_collector_loop(interval: int = ENV_GC_INTERVAL_SECONDS, dry_run: bool = ENV_GC_DRY_RUN):
+  while True:
+    await asyncio.sleep(interval)
+    try:
+      await run_garbage_collection(dry_run=dry_run)
+    except Exception as e:
+      logger.error(f"Error in garbage collector: {e}")
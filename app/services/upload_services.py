@@ -0,0 +1,207 @@
+import os
+import uuid
+import hashlib
+from datetime import datetime, timezone
+from typing import AsyncIterator, List, Optional
+from fastapi import HTTPException
+from gridfs.errors import NoFile
+from pymongo import ReturnDocument
+from magenta.core.config import tenant_collections, logger
+from magenta.core.tracing import traced
+from app.services.environment_services import get_gridfs_bucket, upload_stream_to_gridfs, validate_chunk_hash
+
+# Resumable environment uploads: the client initiates an upload, sends the file in numbered parts
+# (in any order, in parallel, retrying only the parts that failed) and completes it. Parts are staged
+# as GridFS files and turned into a chunked snapshot on completion. Unfinished uploads expire after
+# ENV_UPLOAD_EXPIRY_SECONDS without activity (TTL index), their parts are then removed by the garbage collector
+ENV_UPLOAD_PART_SIZE = int(os.getenv("ENV_UPLOAD_PART_SIZE", 8 * 1024 * 1024)) # suggested part size
+ENV_UPLOAD_MAX_PART_SIZE = 64 * 1024 * 1024
+
+
+def get_part_file_id(upload_id: str, part_number: int, attempt: Optional[str] = None) -> str:
+  # every attempt at a part gets its own file, so a retry never overwrites the part it replaces
+  return f"part_{upload_id}_{part_number}" + (f"_{attempt}" if attempt else "")
+
+
+def get_part_file_ids(upload: dict) -> List[str]:
+  return [
+    part.get("file_id") or get_part_file_id(upload["upload_id"], int(part_number))
+    for part_number, part in upload["parts"].items()
+  ]
+
+
+async def get_upload(session_id: str, upload_id: str, tenant_id: str = "default") -> dict:
+  uploads_collection = tenant_collections.get_collection(tenant_id, "environment_uploads")
+  upload = await uploads_collection.find_one({"upload_id": upload_id, "session_id": session_id}, {"_id": 0})
+  if not upload:
+    raise HTTPException(status_code=404, detail="Upload not found")
+  return upload
+
+
+async def initiate_upload(
+  session_id: str,
+  tenant_id: str = "default",
+  code_snippet_id: Optional[str] = None
+) -> dict:
+  """
+  Start a resumable upload for the environment of a session
+  Returns: The upload document (upload_id, part_size, ...)
+  """
+  uploads_collection = tenant_collections.get_collection(tenant_id, "environment_uploads")
+  now = datetime.now(timezone.utc)
+  upload = {
+    "upload_id": uuid.uuid4().hex,
+    "session_id": session_id,
+    "part_size": ENV_UPLOAD_PART_SIZE,
+    "parts": {},
+    "status": "open",
+    "code_snippet_id": code_snippet_id,
+    "created_at": now,
+    "updated_at": now
+  }
+  await uploads_collection.insert_one(upload)
+  upload.pop("_id", None)
+  return upload
+
+
+@traced(session_id="session.id", upload_id="upload.id", tenant_id="tenant.id")
+async def upload_part(
+  session_id: str,
+  upload_id: str,
+  part_number: int,
+  data: AsyncIterator[bytes],
+  sha256: str,
+  tenant_id: str = "default"
+) -> dict:
+  """
+  Stream one part of an upload into GridFS, checking it against its SHA-256.
+  Uploading a part again replaces it, so failed parts can simply be retried. The new part is written
+  first and only recorded while the upload is still open, the part it replaces is removed afterwards
+  Returns: The part record (sha256, size)
+  Raises: HTTPException 400 on a checksum mismatch, 409 if the upload is no longer open
+  """
+  validate_chunk_hash(sha256)
+  if part_number < 1:
+    raise HTTPException(status_code=400, detail="Part numbers start at 1")
+  upload = await get_upload(session_id, upload_id, tenant_id)
+  if upload["status"] != "open":
+    raise HTTPException(status_code=409, detail=f"Upload is {upload['status']}")
+
+  fs = get_gridfs_bucket(tenant_id)
+  file_id = get_part_file_id(upload_id, part_number, uuid.uuid4().hex)
+  digest, size = hashlib.sha256(), 0
+  grid_in = fs.open_upload_stream_with_id(
+    file_id,
+    file_id,
+    metadata={"kind": "env_upload_part", "upload_id": upload_id, "part_number": part_number}
+  )
+  try:
+    async for chunk in data:
+      size += len(chunk)
+      if size > ENV_UPLOAD_MAX_PART_SIZE:
+        raise HTTPException(status_code=413, detail=f"Parts can be at most {ENV_UPLOAD_MAX_PART_SIZE} bytes")
+      digest.update(chunk)
+      await grid_in.write(chunk)
+    if digest.hexdigest() != sha256:
+      raise HTTPException(status_code=400, detail=f"Part {part_number} does not match its checksum")
+    await grid_in.close()
+  except Exception:
+    await grid_in.abort()
+    raise
+
+  part = {"sha256": sha256, "size": size, "file_id": file_id}
+  uploads_collection = tenant_collections.get_collection(tenant_id, "environment_uploads")
+  previous = await uploads_collection.find_one_and_update(
+    {"upload_id": upload_id, "status": "open"},
+    {"$set": {f"parts.{part_number}": part, "updated_at": datetime.now(timezone.utc)}},
+    projection={"_id": 0, f"parts.{part_number}": 1},
+    return_document=ReturnDocument.BEFORE
+  )
+  if previous is None:
+    # completed, aborted or expired while the part was streaming
+    await delete_part_files(tenant_id, [file_id])
+    raise HTTPException(status_code=409, detail="Upload is no longer open")
+
+  replaced = previous.get("parts", {}).get(str(part_number))
+  if replaced:
+    await delete_part_files(tenant_id, [replaced.get("file_id") or get_part_file_id(upload_id, part_number)])
+  return {"part_number": part_number, "sha256": sha256, "size": size}
+
+
+async def delete_part_files(tenant_id: str, file_ids: List[str]):
+  fs = get_gridfs_bucket(tenant_id)
+  for file_id in file_ids:
+    try:
+      await fs.delete(file_id)
+    except NoFile:
+      pass
+
+
+async def delete_upload_parts(upload: dict, tenant_id: str = "default"):
+  await delete_part_files(tenant_id, get_part_file_ids(upload))
+
+
+@traced(session_id="session.id", upload_id="upload.id", tenant_id="tenant.id")
+async def complete_upload(
+  session_id: str,
+  upload_id: str,
+  part_hashes: List[str],
+  tenant_id: str = "default"
+) -> dict:
+  """
+  Assemble parts 1..n (their hashes given in order, as the client sent them) into the next environment snapshot
+  Returns: The snapshot record
+  Raises: HTTPException 400 if parts are missing or differ, 409 if the upload is already being completed
+  """
+  def find_missing(upload: dict) -> List[str]:
+    return [
+      str(part_number) for part_number, sha256 in enumerate(part_hashes, start=1)
+      if upload["parts"].get(str(part_number), {}).get("sha256") != sha256
+    ]
+
+  upload = await get_upload(session_id, upload_id, tenant_id)
+  if missing := find_missing(upload):
+    raise HTTPException(status_code=400, detail=f"Missing or different parts: {', '.join(missing[:20])}")
+
+  # parts are only recorded while the upload is open, from here on they can't change
+  uploads_collection = tenant_collections.get_collection(tenant_id, "environment_uploads")
+  upload = await uploads_collection.find_one_and_update(
+    {"upload_id": upload_id, "status": "open"},
+    {"$set": {"status": "completing", "updated_at": datetime.now(timezone.utc)}},
+    projection={"_id": 0},
+    return_document=ReturnDocument.AFTER
+  )
+  if not upload:
+    raise HTTPException(status_code=409, detail="Upload is already being completed")
+  if missing := find_missing(upload): # a part was replaced since the check above
+    await uploads_collection.update_one({"upload_id": upload_id}, {"$set": {"status": "open"}})
+    raise HTTPException(status_code=400, detail=f"Missing or different parts: {', '.join(missing[:20])}")
+
+  fs = get_gridfs_bucket(tenant_id)
+
+  async def read_parts():
+    for part_number in range(1, len(part_hashes) + 1):
+      part = upload["parts"][str(part_number)]
+      grid_out = await fs.open_download_stream(part.get("file_id") or get_part_file_id(upload_id, part_number))
+      while chunk := await grid_out.readchunk():
+        yield chunk
+
+  try:
+    snapshot = await upload_stream_to_gridfs(
+      session_id, read_parts(), tenant_id, code_snippet_id=upload.get("code_snippet_id")
+    )
+  except Exception:
+    await uploads_collection.update_one({"upload_id": upload_id}, {"$set": {"status": "open"}}) # can be completed again
+    raise
+
+  await delete_upload_parts(upload, tenant_id)
+  await uploads_collection.delete_one({"upload_id": upload_id})
+  logger.info(f"Completed upload {upload_id} for session {session_id} ({len(part_hashes)} parts)")
+  return snapshot
+
+
+async def abort_upload(session_id: str, upload_id: str, tenant_id: str = "default"):
+  upload = await get_upload(session_id, upload_id, tenant_id)
+  await delete_upload_parts(upload, tenant_id)
+  uploads_collection = tenant_collections.get_collection(tenant_id, "environment_uploads")
+  await uploads_collection.delete_one({"upload_id": upload_id})
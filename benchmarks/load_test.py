@@ -0,0 +1,326 @@
+"""
+Load test of the analysis API: N simulated notebook users doing what the Shiny app does
+
+Every user creates an analysis session and then, until the test ends,
+- sends chat messages and polls their status at the app's cadence (every 0.5s for 10s, every 1s up to 30s, then every 3s)
+  before fetching the new messages
+- submits code executions, polls for new assistant code every 5s and for new messages every 10s
+- saves its environment (a mostly unchanged blob, like a real R session between saves)
+
+Run against a server that uses the fake LLM (LLM_PROVIDER=fake, see magenta/services/fake_llm.py) and local databases:
+
+  python -m benchmarks.load_test --base-url http://localhost:8000 --users 20 --duration 120
+  python -m benchmarks.load_test --in-process --users 20 --duration 120   # starts app.main:app with LLM_PROVIDER=fake
+
+Reports p50/p95/p99 latency per endpoint. --save-baseline writes the report to commit,
+--baseline compares against it and exits with 1 if a percentile got slower than the tolerance allows
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+import statistics
+from collections import defaultdict
+from typing import Dict, List, Optional
+import httpx
+
+
+STATUS_POLL_INTERVALS = [(10, 0.5), (30, 1.0), (float("inf"), 3.0)] # (seconds since sent, polling interval)
+CODE_POLL_INTERVAL = 5.0
+MESSAGES_POLL_INTERVAL = 10.0
+PERCENTILES = (50, 95, 99)
+DONE_STATUSES = ("completed", "failed")
+
+
+class Recorder:
+  # latencies in seconds per endpoint, plus errors and turns refused by the rate limits (429)
+  def __init__(self):
+    self.latencies: Dict[str, List[float]] = defaultdict(list)
+    self.errors: Dict[str, int] = defaultdict(int)
+    self.rate_limited: Dict[str, int] = defaultdict(int)
+
+  async def request(self, client: httpx.AsyncClient, method: str, name: str, url: str, **kwargs) -> Optional[httpx.Response]:
+    start = time.perf_counter()
+    try:
+      response = await client.request(method, url, **kwargs)
+    except httpx.HTTPError:
+      self.errors[name] += 1
+      return None
+    self.latencies[name].append(time.perf_counter() - start)
+    if response.status_code == 429:
+      self.rate_limited[name] += 1
+    elif response.status_code >= 400:
+      self.errors[name] += 1
+    return response
+
+  def record(self, name: str, seconds: float):
+    self.latencies[name].append(seconds)
+
+  def report(self, duration: float) -> dict:
+    endpoints = {}
+    for name in sorted(set(self.latencies) | set(self.errors)):
+      latencies = sorted(self.latencies.get(name, []))
+      endpoints[name] = {
+        "count": len(latencies),
+        "errors": self.errors.get(name, 0),
+        "rate_limited": self.rate_limited.get(name, 0),
+        "rps": round(len(latencies) / duration, 2),
+        **{f"p{p}_ms": round(percentile(latencies, p) * 1000, 1) for p in PERCENTILES},
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 1) if latencies else None
+      }
+    return endpoints
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+  # nearest rank on sorted values
+  if not values:
+    return float("nan")
+  return values[max(math.ceil(p / 100 * len(values)), 1) - 1]
+
+
+def status_poll_interval(elapsed: float) -> float:
+  return next(interval for limit, interval in STATUS_POLL_INTERVALS if elapsed < limit)
+
+
+class NotebookUser:
+  def __init__(self, user_number: int, client: httpx.AsyncClient, recorder: Recorder, args):
+    self.client = client
+    self.recorder = recorder
+    self.args = args
+    self.rng = random.Random(args.seed + user_number)
+    self.tenant = {"tenant_id": args.tenant_id}
+    self.session_id = None
+    self.last_code_id = None
+    self.last_message_id = None
+    self.environment = bytearray(self.rng.randbytes(args.env_size))
+
+  async def request(self, method: str, name: str, url: str, **kwargs):
+    kwargs["params"] = {**self.tenant, **kwargs.get("params", {})}
+    return await self.recorder.request(self.client, method, name, url, **kwargs)
+
+  async def think(self, mean: float):
+    await asyncio.sleep(self.rng.expovariate(1 / mean))
+
+  async def start(self):
+    response = await self.request(
+      "POST", "POST /analysis/", "/analysis/", params={"context_id": "load_test", "sysprompt_id": self.args.sysprompt_id}
+    )
+    if response is None or response.status_code != 200:
+      raise RuntimeError(f"Could not create an analysis session: {response.text if response is not None else 'no response'}")
+    self.session_id = response.json()["session_id"]
+
+  async def stop(self):
+    await self.request("DELETE", "DELETE /environments/{id}", f"/environments/{self.session_id}")
+    await self.request("DELETE", "DELETE /analysis/{id}", f"/analysis/{self.session_id}")
+
+  async def send_message(self):
+    sent = time.perf_counter()
+    response = await self.request(
+      "POST", "POST /analysis/{id}/messages", f"/analysis/{self.session_id}/messages",
+      params={"message": f"Please summarize variable x{self.rng.randint(1, 100)}"}
+    )
+    if response is None or response.status_code != 200:
+      return
+    task_id = response.json()["task_id"]
+
+    while (elapsed := time.perf_counter() - sent) < self.args.turn_timeout:
+      await asyncio.sleep(status_poll_interval(elapsed))
+      response = await self.request(
+        "GET", "GET /analysis/{id}/messages/status", f"/analysis/{self.session_id}/messages/status",
+        params={"message_ids": [task_id]}
+      )
+      status = (response.json().get(task_id) or {}).get("status") if response is not None and response.status_code == 200 else None
+      if status in DONE_STATUSES:
+        self.recorder.record("chat turn (send to completed)", time.perf_counter() - sent)
+        break
+    await self.load_messages({"since_message_id": self.last_message_id} if self.last_message_id else {})
+
+  async def load_messages(self, params: dict):
+    response = await self.request("GET", "GET /analysis/{id}/messages", f"/analysis/{self.session_id}/messages", params=params)
+    if response is not None and response.status_code == 200 and response.json():
+      self.last_message_id = response.json()[-1]["message_id"]
+
+  async def submit_code(self):
+    code_pair = {
+      "input": {"type": "execution", "language": "R", "code_snippet": f"x <- rnorm({self.rng.randint(10, 1000)})\nsummary(x)"},
+      "output": {"response": "\n".join(f"[{i}] {self.rng.random():.4f}" for i in range(self.rng.randint(5, 200))), "status": "success"}
+    }
+    response = await self.request("POST", "POST /analysis/{id}/code", f"/analysis/{self.session_id}/code", json=code_pair)
+    if response is not None and response.status_code == 200:
+      self.last_code_id = response.json()["task_id"]
+
+  async def poll_code(self):
+    # like the app, only once there is code to poll after
+    if self.last_code_id is None:
+      return
+    response = await self.request(
+      "GET", "GET /analysis/{id}/code", f"/analysis/{self.session_id}/code", params={"since_message_id": self.last_code_id}
+    )
+    if response is not None and response.status_code == 200 and response.json():
+      self.last_code_id = response.json()[-1]["message_id"]
+
+  async def save_environment(self):
+    # change a small region, most content-defined chunks stay the same between saves
+    offset = self.rng.randrange(0, max(len(self.environment) - 1024, 1))
+    self.environment[offset:offset + 1024] = self.rng.randbytes(1024)
+    await self.request(
+      "PUT", "PUT /environments/{id}/file", f"/environments/{self.session_id}/file",
+      content=bytes(self.environment), headers={"Content-Type": "application/octet-stream"}
+    )
+
+  async def poll(self, interval: float, func, deadline: float):
+    while time.perf_counter() < deadline:
+      await asyncio.sleep(interval)
+      await func()
+
+  async def act(self, deadline: float):
+    # the user's own actions, with exponential think times in between
+    actions = [(self.send_message, self.args.message_weight), (self.submit_code, self.args.code_weight), (self.save_environment, self.args.env_weight)]
+    while time.perf_counter() < deadline:
+      await self.think(self.args.think_time)
+      action = self.rng.choices([action for action, _ in actions], weights=[weight for _, weight in actions])[0]
+      await action()
+
+  async def run(self, deadline: float):
+    await self.start()
+    try:
+      await asyncio.gather(
+        self.act(deadline),
+        self.poll(CODE_POLL_INTERVAL, self.poll_code, deadline),
+        self.poll(MESSAGES_POLL_INTERVAL, lambda: self.load_messages({"since_message_id": self.last_message_id} if self.last_message_id else {}), deadline)
+      )
+    finally:
+      await self.stop()
+
+
+async def run_load_test(args) -> dict:
+  recorder = Recorder()
+  limits = httpx.Limits(max_connections=args.users * 4, max_keepalive_connections=args.users * 4)
+  async with httpx.AsyncClient(base_url=args.base_url, timeout=args.request_timeout, limits=limits) as client:
+    started = time.perf_counter()
+    users = []
+    for i in range(args.users):
+      users.append(asyncio.create_task(NotebookUser(i, client, recorder, args).run(started + args.ramp_up + args.duration)))
+      await asyncio.sleep(args.ramp_up / max(args.users, 1))
+    results = await asyncio.gather(*users, return_exceptions=True)
+    duration = time.perf_counter() - started
+
+  failed = [result for result in results if isinstance(result, Exception)]
+  for error in failed[:5]:
+    print(f"User failed: {error!r}", file=sys.stderr)
+  return {
+    "users": args.users,
+    "duration_seconds": round(duration, 1),
+    "failed_users": len(failed),
+    "endpoints": recorder.report(duration)
+  }
+
+
+def compare_to_baseline(report: dict, baseline: dict, tolerance: float) -> List[str]:
+  """
+  Percentiles that got slower than baseline * (1 + tolerance), and endpoints with new errors
+  """
+  regressions = []
+  for name, base in baseline["endpoints"].items():
+    current = report["endpoints"].get(name)
+    if current is None:
+      continue
+    for p in PERCENTILES:
+      key = f"p{p}_ms"
+      if base.get(key) and current.get(key) and current[key] > base[key] * (1 + tolerance):
+        regressions.append(f"{name} {key}: {current[key]} ms (baseline {base[key]} ms)")
+    if current["errors"] > base.get("errors", 0):
+      regressions.append(f"{name} errors: {current['errors']} (baseline {base.get('errors', 0)})")
+  return regressions
+
+
+def print_report(report: dict):
+  print(f"\n{report['users']} users, {report['duration_seconds']} s, {report['failed_users']} failed users")
+  print(f"{'endpoint':<45} {'count':>7} {'err':>5} {'429':>5} {'rps':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+  for name, stats in report["endpoints"].items():
+    print(
+      f"{name:<45} {stats['count']:>7} {stats['errors']:>5} {stats.get('rate_limited', 0):>5} {stats['rps']:>7} "
+      f"{stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9}"
+    )
+
+
+async def serve_in_process(port: int):
+  # the app with the fake LLM, in this event loop
+  os.environ.setdefault("LLM_PROVIDER", "fake")
+  import uvicorn
+  from app.main import app
+
+  server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+  task = asyncio.create_task(server.serve())
+  while not server.started:
+    if task.done():
+      task.result()
+    await asyncio.sleep(0.1)
+  return server, task
+
+
+async def main(args) -> int:
+  server = None
+  if args.in_process:
+    server, server_task = await serve_in_process(args.port)
+    args.base_url = f"http://127.0.0.1:{args.port}"
+
+  try:
+    report = await run_load_test(args)
+  finally:
+    if server is not None:
+      server.should_exit = True
+      await server_task
+
+  print_report(report)
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(report, f, indent=2)
+  if args.save_baseline:
+    with open(args.save_baseline, "w") as f:
+      json.dump(report, f, indent=2)
+    print(f"Baseline written to {args.save_baseline}")
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      regressions = compare_to_baseline(report, json.load(f), args.tolerance)
+    if regressions:
+      print("\nRegressions against the baseline:")
+      for regression in regressions:
+        print(f"  {regression}")
+      return 1
+    print("\nNo regressions against the baseline.")
+  return 0
+
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(description="Load test of the analysis API with simulated notebook users")
+  parser.add_argument("--base-url", default=os.getenv("LOAD_TEST_BASE_URL", "http://localhost:8000"))
+  parser.add_argument("--in-process", action="store_true", help="start app.main:app with the fake LLM instead of using --base-url")
+  parser.add_argument("--port", type=int, default=8765, help="port of the in-process server")
+  parser.add_argument("--users", type=int, default=10)
+  parser.add_argument("--duration", type=float, default=60, help="seconds after ramp up")
+  parser.add_argument("--ramp-up", type=float, default=10, help="seconds over which users start")
+  parser.add_argument("--think-time", type=float, default=8, help="mean seconds between a user's actions")
+  parser.add_argument("--message-weight", type=float, default=3)
+  parser.add_argument("--code-weight", type=float, default=5)
+  parser.add_argument("--env-weight", type=float, default=1)
+  parser.add_argument("--env-size", type=int, default=2 * 1024 * 1024, help="bytes of the simulated environment")
+  parser.add_argument("--turn-timeout", type=float, default=120, help="seconds to wait for a chat turn")
+  parser.add_argument("--request-timeout", type=float, default=60)
+  parser.add_argument("--tenant-id", default="default")
+  parser.add_argument("--sysprompt-id", default="radian0")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--output", help="write the report as JSON")
+  parser.add_argument("--save-baseline", help="write the report as the new baseline")
+  parser.add_argument("--baseline", help="baseline report to compare against")
+  parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against the baseline (0.25 = 25%%)")
+  return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+  sys.exit(asyncio.run(main(parse_args())))
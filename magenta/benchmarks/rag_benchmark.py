@@ -0,0 +1,267 @@
+"""
+Micro-benchmarks of the RAG ingestion and search hot paths over synthetic corpora of increasing size
+
+  python -m benchmarks.rag_benchmark --pages 1,100,10000 --output benchmarks/results/rag.json
+  python -m benchmarks.rag_benchmark --pages 1,100 --compare benchmarks/results/rag.json
+
+Stages: read_pdf_text, chunk_text_paragraphs, chunk_text_simple, embedding, insert_into_postgres and
+perform_postgre_search_async. The database stages write to throwaway tables (benchmark_rag_<pages>) and are
+skipped with --no-db. Embeddings come from a deterministic hashing embedder with the dimension of the vector
+tables, plus the spaCy model when one is installed (--spacy-model).
+Results are stored like pytest-benchmark's JSON (per benchmark: group, params, stats) for trend comparison
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import asyncio
+import inspect
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime, timezone
+from typing import Callable, List, Optional
+import fitz
+import numpy as np
+
+from core.config import logger, engine, AsyncSessionLocal
+from core.utils import read_pdf_text, chunk_text_paragraphs, chunk_text_simple, embed_text_spacy
+from services.document_service import insert_into_postgres, perform_postgre_search_async
+from sqlalchemy import text
+
+
+EMBEDDING_DIMENSION = 300 # Vector(300) in core.utils
+PAGE_LINES = 45
+LINE_CHARS = 90
+VOCABULARY_SIZE = 5000
+CHUNK_SIZE = 1000 # process_document's default
+SEARCH_QUERIES = 50
+
+
+class HashedDoc:
+  def __init__(self, vector):
+    self.vector = vector
+
+
+class HashingEmbedder:
+  """
+  Stand-in for the spaCy model (embed_text_spacy only needs model(text).vector):
+  feature hashing of the words into a unit vector, deterministic across processes
+  """
+  def __init__(self, dimension: int = EMBEDDING_DIMENSION):
+    self.dimension = dimension
+
+  def __call__(self, text: str) -> HashedDoc:
+    vector = np.zeros(self.dimension, dtype=np.float32)
+    for word in text.lower().split():
+      h = zlib.crc32(word.encode())
+      vector[h % self.dimension] += 1.0 if h & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    return HashedDoc(vector / norm if norm else vector)
+
+
+def make_vocabulary(rng: random.Random) -> List[str]:
+  letters = "etaoinshrdlcumwfgypbvkjxqz"
+  weights = [26 - i for i in range(len(letters))]
+  return ["".join(rng.choices(letters, weights=weights, k=rng.randint(2, 10))) for _ in range(VOCABULARY_SIZE)]
+
+
+def make_page(rng: random.Random, vocabulary: List[str]) -> str:
+  # paragraphs of sentences wrapped into lines, with blank lines between paragraphs
+  lines, line = [], ""
+  while len(lines) < PAGE_LINES:
+    sentence = " ".join(rng.choices(vocabulary, k=rng.randint(6, 20))).capitalize() + "."
+    for word in sentence.split():
+      if len(line) + len(word) + 1 > LINE_CHARS:
+        lines.append(line)
+        line = ""
+      line = f"{line} {word}" if line else word
+    if rng.random() < 0.25:
+      lines += [line, ""]
+      line = ""
+  return "\n".join(lines[:PAGE_LINES])
+
+
+def make_pdf(pages: int, directory: str, seed: int) -> str:
+  path = os.path.join(directory, f"corpus_{pages}_{seed}.pdf")
+  if os.path.exists(path):
+    return path
+  rng = random.Random(seed)
+  vocabulary = make_vocabulary(rng)
+  doc = fitz.open()
+  for _ in range(pages):
+    page = doc.new_page()
+    page.insert_text((36, 36), make_page(rng, vocabulary), fontsize=7)
+  doc.save(path)
+  doc.close()
+  return path
+
+
+async def measure(func: Callable, rounds: int, warmup: int = 0) -> List[float]:
+  # seconds per round, for plain and async functions
+  times = []
+  for i in range(warmup + rounds):
+    start = time.perf_counter()
+    result = func()
+    if inspect.isawaitable(result):
+      await result
+    if i >= warmup:
+      times.append(time.perf_counter() - start)
+  return times
+
+
+def summarize(times: List[float]) -> dict:
+  return {
+    "rounds": len(times),
+    "min": min(times),
+    "max": max(times),
+    "mean": statistics.fmean(times),
+    "median": statistics.median(times),
+    "stddev": statistics.stdev(times) if len(times) > 1 else 0.0,
+    "ops": 1 / statistics.fmean(times) if statistics.fmean(times) else None
+  }
+
+
+class BenchmarkRun:
+  def __init__(self):
+    self.benchmarks = []
+
+  async def bench(self, name: str, group: str, corpus_pages: int, func: Callable, rounds: int, warmup: int = 0, **extra_info) -> dict:
+    stats = summarize(await measure(func, rounds, warmup))
+    # throughputs per second from the counts given in extra_info (pages, chunks, bytes)
+    extra_info.update({f"{unit}_per_second": round(count / stats["mean"], 1) for unit, count in list(extra_info.items()) if stats["mean"]})
+    benchmark = {
+      "name": f"{name}[{corpus_pages}]", "group": group, "params": {"pages": corpus_pages}, "stats": stats, "extra_info": extra_info
+    }
+    self.benchmarks.append(benchmark)
+    logger.info(f"{benchmark['name']}: mean {stats['mean'] * 1000:.2f} ms over {stats['rounds']} rounds")
+    return benchmark
+
+
+async def drop_table(table_name: str):
+  def drop():
+    with engine.begin() as conn:
+      conn.execute(text(f'DROP TABLE IF EXISTS "{table_name}" CASCADE'))
+  await asyncio.to_thread(drop)
+
+
+async def benchmark_corpus(run: BenchmarkRun, pages: int, args, embedders: dict):
+  rounds = args.rounds if pages <= 100 else 1
+  path = make_pdf(pages, args.corpus_dir, args.seed)
+  size = os.path.getsize(path)
+
+  await run.bench("read_pdf_text", "ingestion", pages, lambda: read_pdf_text(path), rounds, bytes=size, pages=pages)
+  corpus = read_pdf_text(path)
+  await run.bench(
+    "chunk_text_paragraphs", "ingestion", pages, lambda: chunk_text_paragraphs(corpus, chunk_size=CHUNK_SIZE), rounds,
+    bytes=len(corpus)
+  )
+  await run.bench(
+    "chunk_text_simple", "ingestion", pages, lambda: chunk_text_simple(corpus, chunk_size=CHUNK_SIZE), rounds,
+    bytes=len(corpus)
+  )
+
+  chunks = chunk_text_paragraphs(corpus, chunk_size=CHUNK_SIZE)
+  for embedder_name, model in embedders.items():
+    await run.bench(
+      f"embed_{embedder_name}", "ingestion", pages, lambda: [embed_text_spacy(chunk, model) for chunk in chunks], rounds,
+      chunks=len(chunks)
+    )
+  if args.no_db:
+    return
+
+  model = embedders["hashing"]
+  embeddings = [embed_text_spacy(chunk, model) for chunk in chunks]
+  table_name = f"benchmark_rag_{pages}"
+  await drop_table(table_name)
+  try:
+    async def insert():
+      async with AsyncSessionLocal() as db:
+        await insert_into_postgres(db, "benchmark_document", "benchmark_document", chunks, embeddings, {}, table_name=table_name)
+    # inserting again would only add duplicates, one round per corpus
+    await run.bench("insert_into_postgres", "ingestion", pages, insert, 1, chunks=len(chunks))
+
+    rng = random.Random(args.seed)
+    queries = [" ".join(rng.choice(chunks).split()[:12]) for _ in range(SEARCH_QUERIES)]
+    query_times = []
+    async with AsyncSessionLocal() as db:
+      for query in queries:
+        start = time.perf_counter()
+        await perform_postgre_search_async(query, [], db=db, spacy_model=model, table_name=table_name, similarity_threshold=0.0)
+        query_times.append(time.perf_counter() - start)
+    stats = summarize(query_times)
+    run.benchmarks.append({
+      "name": f"perform_postgre_search[{pages}]", "group": "search", "params": {"pages": pages}, "stats": stats,
+      "extra_info": {"rows": len(chunks), "queries_per_second": round(1 / stats["mean"], 1)}
+    })
+  finally:
+    await drop_table(table_name)
+
+
+def get_commit() -> Optional[str]:
+  try:
+    return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+  except Exception:
+    return None
+
+
+def compare(results: dict, previous: dict):
+  previous_means = {benchmark["name"]: benchmark["stats"]["mean"] for benchmark in previous["benchmarks"]}
+  print(f"\n{'benchmark':<40} {'mean ms':>12} {'previous':>12} {'change':>8}")
+  for benchmark in results["benchmarks"]:
+    mean = benchmark["stats"]["mean"]
+    before = previous_means.get(benchmark["name"])
+    change = f"{(mean / before - 1) * 100:+.1f}%" if before else "new"
+    print(f"{benchmark['name']:<40} {mean * 1000:>12.2f} {before * 1000 if before else float('nan'):>12.2f} {change:>8}")
+
+
+async def main(args) -> dict:
+  embedders = {"hashing": HashingEmbedder()}
+  if args.spacy_model:
+    try:
+      import spacy
+      embedders["spacy"] = spacy.load(args.spacy_model)
+    except Exception as e:
+      logger.warning(f"spaCy model {args.spacy_model} not available, benchmarking the hashing embedder only: {e}")
+
+  os.makedirs(args.corpus_dir, exist_ok=True)
+  run = BenchmarkRun()
+  for pages in args.pages:
+    await benchmark_corpus(run, pages, args, embedders)
+
+  return {
+    "machine_info": {"python": platform.python_version(), "machine": platform.machine(), "processor": platform.processor(), "cpus": os.cpu_count()},
+    "commit_info": {"id": get_commit()},
+    "datetime": datetime.now(timezone.utc).isoformat(),
+    "benchmarks": run.benchmarks
+  }
+
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(description="Micro-benchmarks of RAG ingestion and search")
+  parser.add_argument("--pages", type=lambda value: [int(pages) for pages in value.split(",")], default=[1, 100, 10000])
+  parser.add_argument("--rounds", type=int, default=5, help="rounds per benchmark for corpora up to 100 pages, larger ones run once")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--corpus-dir", default=os.path.join(tempfile.gettempdir(), "rag_benchmark"), help="generated PDFs are cached here")
+  parser.add_argument("--spacy-model", default=None, help="also benchmark this spaCy model, e.g. en_core_web_lg")
+  parser.add_argument("--no-db", action="store_true", help="skip insert_into_postgres and search")
+  parser.add_argument("--output", help="write the results as JSON")
+  parser.add_argument("--compare", help="results JSON of an earlier run to compare means against")
+  return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+  args = parse_args()
+  results = asyncio.run(main(args))
+  if args.output:
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+      json.dump(results, f, indent=2)
+  if args.compare:
+    with open(args.compare) as f:
+      compare(results, json.load(f))
+  sys.exit(0)
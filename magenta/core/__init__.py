@@ -3,8 +3,11 @@ from .config import (
     mongo_client, 
     spacy_model, 
     engine,
+    async_engine,
     tenant_collections,
+    tenant_middleware,
     get_db,
+    get_async_db,
     SLACK_WEBHOOK_URL
 )
 from .security import (
@@ -27,8 +30,11 @@ __all__ = [
     'mongo_client',
     'spacy_model',
     'engine',
+    'async_engine',
     'tenant_collections',
+    'tenant_middleware',
     'get_db',
+    'get_async_db',
     'SLACK_WEBHOOK_URL',
     # from security
     'Token',
@@ -1,21 +1,23 @@
 import os
 # import spacy
 import json
+import time
+import asyncio
+import threading
 from loguru import logger
-from pymongo import MongoClient
-from openai import OpenAI
-from sqlalchemy import create_engine
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure, PyMongoError
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from pgvector.asyncpg import register_vector
 from .models import Tenant
+from .logging_setup import setup_logging
 
 
-# add logger
-logger.add(
-	os.getenv("LOG_FILE", "logs/app.log"),
-	rotation=os.getenv("LOG_ROTATION", "500 MB"),
-	retention=os.getenv("LOG_RETENTION", "10 days"),
-	level=os.getenv("LOG_LEVEL", "INFO")
-)
+# add logger sinks (queued, JSON lines in LOG_FILE)
+setup_logging()
 
 
 # read env vars
@@ -24,9 +26,49 @@ POSTGRES_PORT = os.getenv('POSTGRES_PORT', '5432')
 POSTGRES_DB = os.getenv('POSTGRES_DB', 'magenta')
 POSTGRES_USER = os.getenv('POSTGRES_USER', 'postgres')
 POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD', 'postgres')
+POSTGRES_POOL_SIZE = int(os.getenv('POSTGRES_POOL_SIZE', 10))
+POSTGRES_MAX_OVERFLOW = int(os.getenv('POSTGRES_MAX_OVERFLOW', 20))
+POSTGRES_POOL_RECYCLE = int(os.getenv('POSTGRES_POOL_RECYCLE', 1800)) # seconds
+POSTGRES_POOL_TIMEOUT = int(os.getenv('POSTGRES_POOL_TIMEOUT', 30)) # seconds
 MONGO_HOST = os.getenv('MONGO_HOST', 'localhost')
 MONGO_PORT = int(os.getenv('MONGO_PORT', 27017))
 MONGO_DB = os.getenv('MONGO_DB', 'magenta')
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', 100))
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', 0))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', 5000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv('MONGO_SOCKET_TIMEOUT_MS', 30000))
+TENANT_CACHE_TTL_SECONDS = int(os.getenv('TENANT_CACHE_TTL_SECONDS', 60))
+TENANT_MISS_TTL_SECONDS = int(os.getenv('TENANT_MISS_TTL_SECONDS', 5)) # unknown tenant ids are looked up again after this
+ENV_UPLOAD_EXPIRY_SECONDS = int(os.getenv('ENV_UPLOAD_EXPIRY_SECONDS', 24 * 3600)) # unfinished environment uploads are dropped after this
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 32000)) # prompt tokens per LLM call, prompts can override it
+CONTEXT_RECENT_TURNS = int(os.getenv('CONTEXT_RECENT_TURNS', 6)) # turns always sent verbatim
+CONTEXT_SUMMARY_SHARE = float(os.getenv('CONTEXT_SUMMARY_SHARE', 0.1)) # share of the budget reserved for the summary of older turns
+SUMMARY_KEEP_TURNS = int(os.getenv('SUMMARY_KEEP_TURNS', 20)) # turns older than this are folded into the chat summary
+SUMMARY_MIN_NEW_TURNS = int(os.getenv('SUMMARY_MIN_NEW_TURNS', 10)) # fold in batches of at least this many turns
+LLM_CACHE_TTL_SECONDS = int(os.getenv('LLM_CACHE_TTL_SECONDS', 7 * 24 * 3600)) # cached LLM responses expire after this
+LLM_CACHE_LRU_SIZE = int(os.getenv('LLM_CACHE_LRU_SIZE', 256)) # responses also kept in process
+LLM_USAGE_RETENTION_DAYS = int(os.getenv('LLM_USAGE_RETENTION_DAYS', 180)) # LLM usage ledger entries expire after this
+LLM_PROVIDER = os.getenv('LLM_PROVIDER', 'openai') # openai, anthropic, local, or 'fake' for the scripted local LLM (load tests, offline benchmarks)
+LLM_DEFAULT_MODEL = os.getenv('LLM_DEFAULT_MODEL') # "provider:model" or a model of LLM_PROVIDER, prompts and tenants can override it
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY') # LLM clients are created on first use, a missing key only fails the calls to that provider
+ANTHROPIC_API_KEY = os.getenv('ANTHROPIC_API_KEY')
+LOCAL_LLM_BASE_URL = os.getenv('LOCAL_LLM_BASE_URL') # OpenAI-compatible server (llama.cpp, vLLM), e.g. http://localhost:8080/v1
+LOCAL_LLM_API_KEY = os.getenv('LOCAL_LLM_API_KEY', 'local')
+LOCAL_LLM_MODEL = os.getenv('LOCAL_LLM_MODEL', 'local-model') # model name the local server expects
+TENANT_TURNS_PER_MINUTE = float(os.getenv('TENANT_TURNS_PER_MINUTE', 60)) # agent turns a tenant can start, tenants can override it, 0 disables
+TENANT_TURN_BURST = int(os.getenv('TENANT_TURN_BURST', 20))
+SESSION_TURNS_PER_MINUTE = float(os.getenv('SESSION_TURNS_PER_MINUTE', 12)) # agent turns per analysis session or chat, 0 disables
+SESSION_TURN_BURST = int(os.getenv('SESSION_TURN_BURST', 5))
+LLM_MAX_CONCURRENT_CALLS = int(os.getenv('LLM_MAX_CONCURRENT_CALLS', 16)) # LLM calls in flight per process, shared fairly across tenants, 0 disables
+LLM_MAX_QUEUED_CALLS = int(os.getenv('LLM_MAX_QUEUED_CALLS', 200)) # new turns are refused while more calls than this wait for a slot
+LLM_REQUEST_TIMEOUT_SECONDS = float(os.getenv('LLM_REQUEST_TIMEOUT_SECONDS', 90)) # per LLM request, retried like other transient errors
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 3)) # retries per model before falling back to the next one
+LLM_RETRY_BASE_DELAY = float(os.getenv('LLM_RETRY_BASE_DELAY', 1)) # seconds, doubled per retry with full jitter
+LLM_RETRY_MAX_DELAY = float(os.getenv('LLM_RETRY_MAX_DELAY', 30)) # longer Retry-After waits fall back right away
+LLM_CIRCUIT_FAILURES = int(os.getenv('LLM_CIRCUIT_FAILURES', 5)) # consecutive failures that open a model's circuit
+LLM_CIRCUIT_RESET_SECONDS = float(os.getenv('LLM_CIRCUIT_RESET_SECONDS', 30)) # an open circuit lets a probe call through after this
+LLM_FALLBACK_MODELS = [model for model in os.getenv('LLM_FALLBACK_MODELS', 'openai:gpt-4o-mini').split(',') if model] # "provider:model", tried in order when the primary model fails
 SLACK_WEBHOOK_URL = os.getenv('SLACK_WEBHOOK_URL')
 SECRET_KEY = os.getenv('SECRET_KEY')
 
@@ -35,36 +77,130 @@ SECRET_KEY = os.getenv('SECRET_KEY')
 # spacy_model = spacy.load("en_core_web_lg")
 spacy_model = None
 
-# establish connection to MongoDB
-mongo_client = MongoClient(MONGO_HOST, MONGO_PORT)
+# establish connection to MongoDB (single shared async client for the whole process)
+mongo_client = AsyncIOMotorClient(
+	MONGO_HOST, 
+	MONGO_PORT,
+	maxPoolSize=MONGO_MAX_POOL_SIZE,
+	minPoolSize=MONGO_MIN_POOL_SIZE,
+	serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+	connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+	socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS
+)
 system_db = mongo_client[MONGO_DB]
 tenants_collection = system_db.tenants
 
 
+# indexes for every tenant collection type, keyed by collection name
+TENANT_COLLECTION_INDEXES = {
+	"analysis": [
+		IndexModel([("session_id", ASCENDING)], unique=True, name="session_id_unique"),
+		IndexModel([("context_id", ASCENDING)], name="context_id")
+	],
+	"chats": [
+		IndexModel([("chat_id", ASCENDING)], unique=True, name="chat_id_unique"),
+		IndexModel([("context_id", ASCENDING)], name="context_id")
+	],
+	"environments": [
+		IndexModel([("session_id", ASCENDING)], unique=True, name="session_id_unique"),
+		IndexModel([("chunks.sha256", ASCENDING)], name="chunks_sha256")
+	],
+	"environment_uploads": [
+		IndexModel([("upload_id", ASCENDING)], unique=True, name="upload_id_unique"),
+		IndexModel([("updated_at", ASCENDING)], expireAfterSeconds=ENV_UPLOAD_EXPIRY_SECONDS, name="updated_at_ttl")
+	],
+	"environment_snapshots": [
+		IndexModel([("session_id", ASCENDING), ("version", DESCENDING)], unique=True, name="session_version_unique"),
+		IndexModel([("session_id", ASCENDING), ("code_snippet_id", ASCENDING)], name="session_code_snippet"),
+		IndexModel([("chunks.sha256", ASCENDING)], name="chunks_sha256")
+	],
+	"documents": [
+		IndexModel([("document_id", ASCENDING)], unique=True, name="document_id_unique"),
+		IndexModel([("name", ASCENDING)], name="name")
+	],
+	"tools": [
+		IndexModel([("tool_id", ASCENDING)], unique=True, name="tool_id_unique"),
+		IndexModel([("function.name", ASCENDING)], unique=True, name="function_name_unique")
+	],
+	"llm_usage": [
+		IndexModel([("chat_id", ASCENDING), ("created_at", ASCENDING)], name="chat_created_at"),
+		IndexModel([("prompt_id", ASCENDING), ("created_at", ASCENDING)], name="prompt_created_at"),
+		IndexModel([("created_at", ASCENDING)], expireAfterSeconds=LLM_USAGE_RETENTION_DAYS * 24 * 3600, name="created_at_ttl")
+	],
+	"prompts": [
+		IndexModel([("prompt_id", ASCENDING)], unique=True, name="prompt_id_unique"),
+		IndexModel([("name", ASCENDING)], name="name")
+	]
+}
+
+# indexes for the collections in the system db
+SYSTEM_COLLECTION_INDEXES = {
+	"tenants": [
+		IndexModel([("tenant_id", ASCENDING)], unique=True, name="tenant_id_unique")
+	],
+	"users": [
+		IndexModel([("username", ASCENDING)], unique=True, name="username_unique")
+	],
+	"llm_cache": [
+		IndexModel([("key", ASCENDING)], unique=True, name="key_unique"),
+		IndexModel([("created_at", ASCENDING)], expireAfterSeconds=LLM_CACHE_TTL_SECONDS, name="created_at_ttl")
+	]
+}
+
+
+async def create_collection_indexes(collection, indexes):
+	if not indexes:
+		return []
+	try:
+		return await collection.create_indexes(indexes)
+	except OperationFailure as e:
+		# most likely existing duplicates violating a unique index, don't block startup on it
+		logger.error(f"Error creating indexes on {collection.full_name}: {e}")
+		return []
+
+
 class TenantCollections:
-	def __init__(self, mongo_client, tenant_files_dir=None):
+	# collection handles are resolved lazily on first use and cached; tenant metadata lives in a dict
+	# keyed by tenant_id, filled by refresh_tenants() in the lifespan and kept fresh by watch_tenants().
+	# Lookups on the request path only read the cache, load_tenant() (awaited by tenant_middleware
+	# before the handler runs) fills it from the db on a miss
+	def __init__(self, mongo_client, tenant_files_dir=None, cache_ttl=TENANT_CACHE_TTL_SECONDS, miss_ttl=TENANT_MISS_TTL_SECONDS):
 		self.mongo_client = mongo_client
 		self.tenants_collection = tenants_collection
 		self.tenant_files_dir = tenant_files_dir
-		self.collections = {
-			"tasks": {}, "prompts": {}, 
-			"documents": {}, "chats": {},
-			"tools": {}
-		}
-		self.all_tenants = []
-		self.get_all_tenants()
-		self._register_default_collections()
-
-	def get_all_tenants(self):
+		self.cache_ttl = cache_ttl
+		self.miss_ttl = miss_ttl
+		self.collection_types = ["tasks", "prompts", "documents", "chats", "tools", "llm_usage"]
+		self.collections = {name: {} for name in self.collection_types} # collection_name -> tenant_id -> handle
+		self.tenants = {} # tenant_id -> Tenant
+		self._tenant_object_ids = {} # mongo _id -> tenant_id, needed to resolve delete events
+		self._missing_tenants = {} # tenant_id -> time of the last failed lookup
+		self._lock = threading.RLock()
+		self._set_tenants([], self._load_known_tenants()) # the db tenants are loaded without blocking, by refresh_tenants()
+
+	@property
+	def all_tenants(self):
+		return list(self.tenants.values())
+
+	async def refresh_tenants(self):
 		known_tenants = self._load_known_tenants()
-		db_tenants = list(self.tenants_collection.find())
-		defined_tenants_obj = []
-		for tenant in db_tenants:
-			tenant = Tenant(**tenant)
-			defined_tenants_obj.append(tenant)
-		self.all_tenants = defined_tenants_obj + known_tenants
+		db_tenants = await self.tenants_collection.find().to_list(length=None)
+		self._set_tenants(db_tenants, known_tenants)
 		return self.all_tenants
 
+	def _set_tenants(self, db_tenants, known_tenants):
+		tenants = {}
+		object_ids = {}
+		for tenant in db_tenants:
+			object_ids[tenant["_id"]] = tenant["tenant_id"]
+			tenants[tenant["tenant_id"]] = Tenant(**tenant)
+		for tenant in known_tenants:
+			tenants.setdefault(tenant.tenant_id, tenant)
+		with self._lock:
+			self.tenants = tenants
+			self._tenant_object_ids = object_ids
+			self._missing_tenants = {}
+
 	def _load_known_tenants(self):
 		known_tenants = []
 		if self.tenant_files_dir:
@@ -84,57 +220,177 @@ class TenantCollections:
 		logger.info(f"Loaded {len(known_tenants)} known tenants: {known_tenants}")
 		return known_tenants
 
-	def _register_default_collections(self, collection_names = None):
-		default_db = self.mongo_client["default"]
-		if collection_names is None:
-			collection_names = self.collections.keys()
-		for collection_name in collection_names:
-			self.collections[collection_name]["default"] = getattr(default_db, collection_name)
+	def get_tenant(self, tenant_id: str):
+		# cache only, never blocks the event loop
+		return self.tenants.get(tenant_id)
 
-		for tenant in self.all_tenants:
-			self._register_tenant_collections(tenant.model_dump()['tenant_id'])
+	async def load_tenant(self, tenant_id: str):
+		tenant = self.tenants.get(tenant_id)
+		if tenant is not None:
+			return tenant
 
-	def _register_tenant_collections(self, tenant_id):
-		tenant_db = self.mongo_client[tenant_id]
-		for collection_name in self.collections.keys():
-			self.collections[collection_name][tenant_id] = getattr(tenant_db, collection_name)
+		# cache miss: the tenant may have been created by another worker. Failed lookups are remembered
+		# for miss_ttl seconds so unknown ids don't hit the db on every request, short enough that a new
+		# tenant isn't hidden for long when there's no change stream to announce it
+		with self._lock:
+			last_miss = self._missing_tenants.get(tenant_id)
+			if last_miss is not None and time.monotonic() - last_miss < self.miss_ttl:
+				return None
+
+		tenant_doc = await self.tenants_collection.find_one({"tenant_id": tenant_id})
+		with self._lock:
+			if tenant_doc is None:
+				self._missing_tenants[tenant_id] = time.monotonic()
+				return None
+			tenant = Tenant(**tenant_doc)
+			self.tenants[tenant_id] = tenant
+			self._tenant_object_ids[tenant_doc["_id"]] = tenant_id
+		logger.info(f"Loaded tenant {tenant_id} from db.")
+		return tenant
+
+	def _is_known_tenant(self, tenant_id: str):
+		return tenant_id == "default" or self.get_tenant(tenant_id) is not None
+
+	def _resolve_collection(self, tenant_id: str, collection_name: str):
+		collection = self.collections[collection_name].get(tenant_id)
+		if collection is None:
+			with self._lock:
+				collection = self.collections[collection_name].get(tenant_id)
+				if collection is None:
+					collection = getattr(self.mongo_client[tenant_id], collection_name)
+					self.collections[collection_name][tenant_id] = collection
+		return collection
 
 	def get_collection(self, tenant_id: str, collection_name: str, search_db=False):
-		if collection_name in self.collections and tenant_id in self.collections[collection_name]:
-			return self.collections[collection_name][tenant_id]
+		if collection_name in self.collections and self._is_known_tenant(tenant_id):
+			return self._resolve_collection(tenant_id, collection_name)
 		elif search_db:
 			tenant_db = self.mongo_client[tenant_id]
 			return getattr(tenant_db, collection_name)
 		else:
 			raise ValueError(f"Tenant data not found for tenant_id: {tenant_id}")
 	
+	def get_collections_dict(self, collection_name: str):
+		# tenant_id -> collection for the default tenant and every known tenant
+		tenant_ids = ["default"] + [t for t in self.tenants if t != "default"]
+		return {tenant_id: self._resolve_collection(tenant_id, collection_name) for tenant_id in tenant_ids}
+
 	def get_collections_list(self, collection_name: str):
-		return list(self.collections[collection_name].values())
+		return list(self.get_collections_dict(collection_name).values())
 
-	def add_new_tenant(self, tenant_data: dict):
+	async def ensure_indexes(self, tenant_ids: list[str] = None, collection_names: list[str] = None):
+		# apply TENANT_COLLECTION_INDEXES to the tenant collections; with no arguments also covers the system db
+		if collection_names is None:
+			collection_names = list(self.collection_types)
+			system_db = self.tenants_collection.database
+			for collection_name, indexes in SYSTEM_COLLECTION_INDEXES.items():
+				await create_collection_indexes(system_db[collection_name], indexes)
+
+		for collection_name in collection_names:
+			indexes = TENANT_COLLECTION_INDEXES.get(collection_name)
+			if not indexes:
+				continue
+			if tenant_ids is None:
+				collections = self.get_collections_list(collection_name)
+			else:
+				collections = [self._resolve_collection(tenant_id, collection_name) for tenant_id in tenant_ids]
+			for collection in collections:
+				await create_collection_indexes(collection, indexes)
+		logger.info(f"Ensured indexes for collections: {collection_names}")
+
+	async def get_index_stats(self, tenant_id: str):
+		# usage stats ($indexStats) for every collection in the tenant's db
+		tenant_db = self.mongo_client[tenant_id]
+		stats = {}
+		for collection_name in await tenant_db.list_collection_names():
+			index_stats = await tenant_db[collection_name].aggregate([{"$indexStats": {}}]).to_list(length=None)
+			stats[collection_name] = [
+				{
+					"name": index["name"],
+					"key": dict(index["key"]),
+					"ops": index["accesses"]["ops"],
+					"since": index["accesses"]["since"]
+				} for index in index_stats
+			]
+		return stats
+
+	def _apply_tenant_change(self, change: dict):
+		with self._lock:
+			if change["operationType"] == "delete":
+				tenant_id = self._tenant_object_ids.pop(change["documentKey"]["_id"], None)
+				if tenant_id is not None:
+					self._forget_tenant(tenant_id)
+			elif change.get("fullDocument"):
+				tenant_doc = change["fullDocument"]
+				self.tenants[tenant_doc["tenant_id"]] = Tenant(**tenant_doc)
+				self._tenant_object_ids[tenant_doc["_id"]] = tenant_doc["tenant_id"]
+				self._missing_tenants.pop(tenant_doc["tenant_id"], None)
+
+	def _forget_tenant(self, tenant_id: str):
+		with self._lock:
+			self.tenants.pop(tenant_id, None)
+			for collection_name in self.collections:
+				self.collections[collection_name].pop(tenant_id, None)
+
+	async def watch_tenants(self):
+		# keep the tenant cache in sync with other workers. Change streams need a replica set and can fail
+		# (network errors, failovers): without one the whole cache is refreshed every cache_ttl seconds
+		# and the stream is reopened, so the task never ends while the worker runs
+		stream_error = None
+		while True:
+			try:
+				async with self.tenants_collection.watch(full_document="updateLookup") as stream:
+					if stream_error is not None:
+						await self.refresh_tenants() # changes made while the stream was down
+					logger.info("Watching tenants collection for changes.")
+					stream_error = None
+					async for change in stream:
+						self._apply_tenant_change(change)
+			except PyMongoError as e:
+				if str(e) != str(stream_error):
+					logger.warning(f"Tenant change stream unavailable ({e}), refreshing tenants every {self.cache_ttl} seconds.")
+				stream_error = e
+			except Exception as e:
+				logger.error(f"Error applying tenant change: {e}")
+				stream_error = e
+
+			await asyncio.sleep(self.cache_ttl)
+			try:
+				await self.refresh_tenants()
+			except Exception as e:
+				logger.error(f"Error refreshing tenants: {e}")
+
+	async def add_new_tenant(self, tenant_data: dict):
 		tenant = Tenant(**tenant_data)
-		self.tenants_collection.insert_one(tenant.model_dump(exclude_none=True)) # insert into MongoDB
-		self.all_tenants.append(tenant) # add to the list of tenants
-		self._register_tenant_collections(tenant.tenant_id)  # Register collections for the new tenant in memory
+		tenant_doc = tenant.model_dump(exclude_none=True)
+		await self.tenants_collection.insert_one(tenant_doc) # insert into MongoDB
+		with self._lock:
+			self.tenants[tenant.tenant_id] = tenant # add to the tenant cache
+			self._tenant_object_ids[tenant_doc["_id"]] = tenant.tenant_id
+			self._missing_tenants.pop(tenant.tenant_id, None)
+		await self.ensure_indexes(tenant_ids=[tenant.tenant_id])
 		logger.info(f"Added new tenant: {tenant_data['tenant_id']}")
 
-	def remove_tenant(self, tenant_id: str):
-		for collection_name in self.collections:
-			self.collections[collection_name][tenant_id].drop()
-		self.tenants_collection.delete_one({"tenant_id": tenant_id})
-		self.all_tenants = [t for t in self.all_tenants if t.tenant_id != tenant_id]
+	async def remove_tenant(self, tenant_id: str):
+		tenant_db = self.mongo_client[tenant_id]
+		for collection_name in self.collection_types:
+			await tenant_db[collection_name].drop()
+		await self.tenants_collection.delete_one({"tenant_id": tenant_id})
+		self._forget_tenant(tenant_id)
 		logger.info(f"Removed tenant: {tenant_id}")
 
-	def add_collection_type(self, collection_name: str):
+	async def add_collection_type(self, collection_name: str, create_indexes: bool = True):
 		if collection_name in self.collections:
 			logger.warning(f"Collection {collection_name} already exists")
 			return
 			
-		# Add new empty dict for this collection type
-		self.collections[collection_name] = {}
-		
-		# Reuse existing registration methods
-		self._register_default_collections(collection_names=[collection_name])
+		# handles for the new type are resolved lazily like the others. Startup registers its types
+		# with create_indexes=False and then builds the indexes of all of them in one ensure_indexes()
+		with self._lock:
+			self.collection_types.append(collection_name)
+			self.collections[collection_name] = {}
+		if create_indexes:
+			await self.ensure_indexes(collection_names=[collection_name])
 		
 		logger.info(f"Added new collection type: {collection_name}")
 
@@ -143,13 +399,43 @@ tenant_collections = TenantCollections(
 	mongo_client=mongo_client,
 	tenant_files_dir="data/tenants/"
 )
-logger.info(f"Initialized collections for {len(tenant_collections.collections)} tenants.")
+logger.info(f"Initialized tenant registry with {len(tenant_collections.tenants)} tenants.")
+
+
+async def tenant_middleware(request, call_next):
+	# load the request's tenant (tenant_id query parameter) into the cache before the handler runs,
+	# the handlers then resolve it synchronously through get_tenant and get_collection. Routes taking
+	# the tenant from the path or the body (the tenants router) await load_tenant themselves
+	tenant_id = request.query_params.get("tenant_id")
+	if tenant_id and tenant_id != "default":
+		await tenant_collections.load_tenant(tenant_id)
+	return await call_next(request)
 
 # PostgreSQL connection
 DATABASE_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
-engine = create_engine(DATABASE_URL)
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+pool_settings = {
+	"pool_size": POSTGRES_POOL_SIZE,
+	"max_overflow": POSTGRES_MAX_OVERFLOW,
+	"pool_recycle": POSTGRES_POOL_RECYCLE,
+	"pool_timeout": POSTGRES_POOL_TIMEOUT,
+	"pool_pre_ping": True
+}
+
+# sync engine, still used for DDL (table and index creation) and startup tasks
+engine = create_engine(DATABASE_URL, **pool_settings)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# async engine for request and background task queries
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **pool_settings)
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+
+@event.listens_for(async_engine.sync_engine, "connect")
+def register_vector_type(dbapi_connection, connection_record):
+	# asyncpg needs a codec for the pgvector type
+	dbapi_connection.run_async(register_vector)
+
 
 def get_db():
 	db = SessionLocal()
@@ -159,11 +445,9 @@ def get_db():
 		db.close()
 
 
-logger.info("Connected to PostgreSQL and MongoDB.")
+async def get_async_db():
+	async with AsyncSessionLocal() as db:
+		yield db
 
 
-# Connect to OpenAI
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-if OPENAI_API_KEY is None:
-	raise ValueError("Missing OpenAI API key")
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
\ No newline at end of file
+logger.info("Connected to PostgreSQL and MongoDB.")
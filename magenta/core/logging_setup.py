@@ -0,0 +1,101 @@
+import os
+import sys
+import json
+import random
+import traceback
+from loguru import logger
+
+
+# Log sinks. Every sink writes through a queue (enqueue=True) drained by a background thread, so request
+# handlers don't wait on the disk. The file sink writes one JSON object per line (LOG_FORMAT=text for
+# loguru's plain format). Large payloads (tool schemas, completions, tool results) are truncated to
+# LOG_PAYLOAD_CHARS in the regular logs; with LOG_PAYLOADS set, they are written in full at DEBUG level
+# to a separate payload log, sampled at LOG_PAYLOAD_SAMPLE_RATE
+LOG_FILE = os.getenv("LOG_FILE", "logs/app.log")
+LOG_ROTATION = os.getenv("LOG_ROTATION", "500 MB")
+LOG_RETENTION = os.getenv("LOG_RETENTION", "10 days")
+LOG_COMPRESSION = os.getenv("LOG_COMPRESSION", "gz") # rotated files
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json") # or "text"
+LOG_PAYLOAD_CHARS = int(os.getenv("LOG_PAYLOAD_CHARS", 300))
+LOG_PAYLOADS = os.getenv("LOG_PAYLOADS", "").lower() in ("1", "true")
+LOG_PAYLOAD_FILE = os.getenv("LOG_PAYLOAD_FILE", "logs/payloads.log")
+LOG_PAYLOAD_RETENTION = os.getenv("LOG_PAYLOAD_RETENTION", "2 days")
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", 1.0))
+
+PAYLOAD_CHANNEL = "payload"
+TEXT_FORMAT = "{time:YYYY-MM-DD HH:mm:ss.SSS} | {level: <8} | {name}:{function}:{line} - {message}" # loguru appends the exception
+
+
+def json_format(record) -> str:
+  # loguru format function: the JSON line is stored on the record and referenced from the template
+  entry = {
+    "time": record["time"].isoformat(),
+    "level": record["level"].name,
+    "message": record["message"],
+    "module": record["name"],
+    "function": record["function"],
+    "line": record["line"]
+  }
+  extra = {key: value for key, value in record["extra"].items() if key not in ("channel", "json")}
+  if extra:
+    entry["extra"] = extra
+  if record["exception"] is not None:
+    exception = record["exception"]
+    entry["exception"] = "".join(traceback.format_exception(exception.type, exception.value, exception.traceback))
+  record["extra"]["json"] = json.dumps(entry, default=str)
+  return "{extra[json]}\n"
+
+
+def is_payload(record) -> bool:
+  return record["extra"].get("channel") == PAYLOAD_CHANNEL
+
+
+def setup_logging():
+  # this module can be imported twice in one process (as core.* and magenta.core.*), sinks are added once
+  if getattr(logger, "_sinks_configured", False):
+    return
+  logger._sinks_configured = True
+
+  logger.remove() # loguru's default stderr sink writes synchronously
+  logger.add(sys.stderr, level=LOG_LEVEL, format=TEXT_FORMAT, filter=lambda record: not is_payload(record), enqueue=True)
+  logger.add(
+    LOG_FILE,
+    rotation=LOG_ROTATION,
+    retention=LOG_RETENTION,
+    compression=LOG_COMPRESSION or None,
+    level=LOG_LEVEL,
+    format=json_format if LOG_FORMAT == "json" else TEXT_FORMAT,
+    filter=lambda record: not is_payload(record),
+    enqueue=True
+  )
+  if LOG_PAYLOADS:
+    logger.add(
+      LOG_PAYLOAD_FILE,
+      rotation=LOG_ROTATION,
+      retention=LOG_PAYLOAD_RETENTION,
+      compression=LOG_COMPRESSION or None,
+      level="DEBUG",
+      format=json_format,
+      filter=is_payload,
+      enqueue=True
+    )
+
+
+async def flush_logs():
+  # waits until the queued messages are written, call on shutdown
+  await logger.complete()
+
+
+def truncate(value, max_chars: int = LOG_PAYLOAD_CHARS) -> str:
+  text = value if isinstance(value, str) else str(value)
+  if len(text) <= max_chars:
+    return text
+  return f"{text[:max_chars]}... [{len(text) - max_chars} more chars]"
+
+
+def log_payload(label: str, payload, **context):
+  # full payload on the payload channel, only rendered when LOG_PAYLOADS is set and the call is sampled
+  if not LOG_PAYLOADS or random.random() >= LOG_PAYLOAD_SAMPLE_RATE:
+    return
+  logger.opt(depth=1).bind(channel=PAYLOAD_CHANNEL, **context).debug("{}: {}", label, payload)
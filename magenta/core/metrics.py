@@ -0,0 +1,141 @@
+import time
+import threading
+from contextlib import contextmanager
+from prometheus_client import (
+  REGISTRY, CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+)
+from prometheus_client.core import GaugeMetricFamily
+from starlette.requests import Request
+from starlette.responses import Response
+
+
+# Prometheus metrics of the HTTP layer and the agent loop, served on /metrics.
+# This module can be imported twice in one process (as core.metrics and magenta.core.metrics),
+# so every metric is looked up in the registry before it is created
+ACTIVE_SESSION_WINDOW_SECONDS = 300 # a session is active if it had a request in this window
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TURN_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+
+def get_or_create(metric_class, name: str, documentation: str, labelnames=(), **kwargs):
+  existing = REGISTRY._names_to_collectors.get(name)
+  if existing is not None:
+    return existing
+  return metric_class(name, documentation, labelnames, **kwargs)
+
+
+http_request_duration = get_or_create(
+  Histogram, "http_request_duration_seconds", "HTTP request latency by route", ("method", "route", "status")
+)
+agent_turn_duration = get_or_create(
+  Histogram, "agent_turn_duration_seconds", "Duration of a whole agent turn (process_chat)", ("status",), buckets=TURN_BUCKETS
+)
+agent_stage_duration = get_or_create(
+  Histogram, "agent_turn_stage_duration_seconds",
+  "Duration of the stages of an agent turn: history_load, sysprompt_tools, document_injection, rag, "
+  "context_window, llm_call, tool_call, persist",
+  ("stage",), buckets=STAGE_BUCKETS
+)
+tool_call_duration = get_or_create(
+  Histogram, "agent_tool_call_duration_seconds", "Duration of tool calls made by the agent", ("tool", "status"), buckets=STAGE_BUCKETS
+)
+llm_calls = get_or_create(Counter, "llm_calls_total", "LLM calls", ("model", "cached"))
+llm_tokens = get_or_create(Counter, "llm_tokens_total", "LLM tokens used", ("model", "type"))
+agent_turns_in_progress = get_or_create(
+  Gauge, "agent_turns_in_progress", "Agent turns accepted and not finished yet (queue depth)", ("tenant",)
+)
+llm_calls_in_flight = get_or_create(Gauge, "llm_calls_in_flight", "LLM calls waiting for or holding a worker thread")
+llm_calls_queued = get_or_create(Gauge, "llm_calls_queued", "LLM calls waiting for a concurrency slot", ("tenant",))
+llm_retries = get_or_create(Counter, "llm_retries_total", "LLM calls retried after a transient error", ("model", "cause"))
+llm_fallbacks = get_or_create(Counter, "llm_fallbacks_total", "LLM calls answered by a fallback model", ("model",))
+llm_circuit_open = get_or_create(Gauge, "llm_circuit_open", "1 while the circuit of an LLM model is open", ("model",))
+rate_limited_turns = get_or_create(
+  Counter, "rate_limited_turns_total", "Agent turns refused with 429, by limit (tenant, session or queue)", ("tenant", "limit")
+)
+
+
+@contextmanager
+def track_stage(stage: str):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    agent_stage_duration.labels(stage=stage).observe(time.perf_counter() - start)
+
+
+class StageTimer:
+  # times consecutive stages of a turn: mark(stage) records the time since the previous mark
+  def __init__(self):
+    self.last = time.perf_counter()
+
+  def mark(self, stage: str):
+    now = time.perf_counter()
+    agent_stage_duration.labels(stage=stage).observe(now - self.last)
+    self.last = now
+
+  def skip(self):
+    # for sections whose stages are recorded elsewhere (LLM and tool calls)
+    self.last = time.perf_counter()
+
+
+def record_llm_usage(model: str, usage: dict):
+  # usage as returned by the LLM functions: {"prompt_tokens": n, "completion_tokens": m}
+  for token_type in ("prompt_tokens", "completion_tokens"):
+    if usage.get(token_type):
+      llm_tokens.labels(model=model, type=token_type.split("_")[0]).inc(usage[token_type])
+
+
+class ActiveSessionsCollector:
+  """
+  active_sessions{tenant}: sessions (analysis sessions or chats) with a request in the last
+  ACTIVE_SESSION_WINDOW_SECONDS, counted when scraped
+  """
+  def __init__(self, window: int = ACTIVE_SESSION_WINDOW_SECONDS):
+    self.window = window
+    self.last_seen = {} # (tenant_id, session_id): monotonic time
+    self.lock = threading.Lock()
+
+  def mark(self, tenant_id: str, session_id: str):
+    with self.lock:
+      self.last_seen[(tenant_id, session_id)] = time.monotonic()
+
+  def collect(self):
+    cutoff = time.monotonic() - self.window
+    counts = {}
+    with self.lock:
+      self.last_seen = {key: seen for key, seen in self.last_seen.items() if seen >= cutoff}
+      for tenant_id, _ in self.last_seen:
+        counts[tenant_id] = counts.get(tenant_id, 0) + 1
+    family = GaugeMetricFamily("active_sessions", "Sessions with requests in the last few minutes", labels=["tenant"])
+    for tenant_id, count in counts.items():
+      family.add_metric([tenant_id], count)
+    yield family
+
+
+active_sessions = REGISTRY._names_to_collectors.get("active_sessions")
+if active_sessions is None:
+  active_sessions = ActiveSessionsCollector()
+  REGISTRY.register(active_sessions)
+
+
+async def metrics_middleware(request: Request, call_next):
+  start = time.perf_counter()
+  status = 500
+  try:
+    response = await call_next(request)
+    status = response.status_code
+    return response
+  finally:
+    # label by route template, not by path, to keep the number of series bounded
+    route = request.scope.get("route")
+    route_path = getattr(route, "path", None) or "unmatched"
+    if route_path != "/metrics":
+      http_request_duration.labels(method=request.method, route=route_path, status=str(status)).observe(time.perf_counter() - start)
+    path_params = request.scope.get("path_params") or {}
+    session_id = path_params.get("session_id") or path_params.get("chat_id")
+    if session_id:
+      active_sessions.mark(request.query_params.get("tenant_id", "default"), session_id)
+
+
+async def metrics_endpoint(request: Request) -> Response:
+  return Response(generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
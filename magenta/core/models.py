@@ -19,6 +19,8 @@ class Tenant(BaseModel):
   tenant_id: str
   name: Optional[str] = ""
   description: Optional[str] = ""
+  turns_per_minute: Optional[float] = None # overrides TENANT_TURNS_PER_MINUTE
+  llm_model: Optional[str] = None # "provider:model" for prompts without one, overrides LLM_DEFAULT_MODEL
 
 
 class Task(BaseModel):
@@ -26,6 +28,7 @@ class Task(BaseModel):
   status: TaskStatus
   type: Optional[str] = None
   result: Optional[dict] = None
+  error: Optional[str] = None # cause of a failed task
 
 
 class RagDocument(BaseModel):
@@ -48,6 +51,10 @@ class Prompt(BaseModel):
   prompt: str
   toolset: Optional[list[str]] = None # this is defined in terms of function.name, not tool_id
   documents: Optional[RagSpec] = None
+  context_token_budget: Optional[int] = None # overrides CONTEXT_TOKEN_BUDGET for chats using this prompt
+  cache_responses: Optional[bool] = False # reuse LLM responses for identical requests (tests, replays, fixed flows)
+  llm_model: Optional[str] = None # "provider:model" (openai, anthropic, local) or a model of LLM_PROVIDER
+  llm_params: Optional[dict] = None # passed to the model, e.g. {"temperature": 0.2, "max_tokens": 2000}
 
 
 class Document(BaseModel):
@@ -84,6 +91,31 @@ class HttpMethod(str, Enum):
   DELETE = "DELETE"
 
 
+class ChatSummary(BaseModel):
+  version: int
+  content: str
+  covered_messages: int # number of leading messages folded into the summary
+  last_message_id: Optional[str] = None # the last message folded in, the summary covers the history up to it
+  updated_at: datetime
+
+
+class LLMUsageRollup(BaseModel):
+  key: Optional[str] = None # what the rollup is grouped by (tenant, chat, prompt or model), None for totals
+  calls: int
+  cached_calls: int
+  turns: int # distinct agent turns with LLM calls
+  prompt_tokens: int
+  completion_tokens: int
+  total_tokens: int
+  max_prompt_tokens: int # largest single prompt, shows prompts that blow up the context
+  tool_calls: int
+  max_calls_per_turn: int # high values point at runaway tool loops
+  avg_latency_ms: float
+  max_latency_ms: float
+  first_call: datetime
+  last_call: datetime
+
+
 class Chat(BaseModel):
   chat_id: str
   agent: Optional[str] = None #even though the input is AgentType, we convert it to str so it can be stored in MongoDB
@@ -92,6 +124,7 @@ class Chat(BaseModel):
   description: Optional[str] = None
   messages: list[ChatMessage]
   statuses: list[dict]
+  summary: Optional[ChatSummary] = None
 
 
 class ToolParameter(BaseModel):
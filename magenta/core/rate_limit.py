@@ -0,0 +1,148 @@
+import math
+import time
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Optional
+from fastapi import HTTPException
+from .config import (
+  logger, tenant_collections,
+  TENANT_TURNS_PER_MINUTE, TENANT_TURN_BURST, SESSION_TURNS_PER_MINUTE, SESSION_TURN_BURST,
+  LLM_MAX_CONCURRENT_CALLS, LLM_MAX_QUEUED_CALLS
+)
+from .metrics import llm_calls_queued, rate_limited_turns
+
+
+# Admission control for agent turns: token buckets per tenant and per session on the endpoints that
+# start a turn, and a process-wide cap on LLM calls in flight with round-robin queuing across tenants.
+# The state is per process, and per module instance: the app reaches it through magenta.routes.chats
+# so the analysis and chat endpoints share it with chat_service
+MAX_BUCKETS = 10000 # least recently used buckets are dropped beyond this
+
+
+class TokenBucket:
+  def __init__(self, per_minute: float, burst: int):
+    self.rate = per_minute / 60
+    self.capacity = max(burst, 1)
+    self.tokens = float(self.capacity)
+    self.updated = time.monotonic()
+
+  def take(self) -> float:
+    # takes a token, returns 0 if there was one or else the seconds until the next one
+    now = time.monotonic()
+    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+    if self.tokens >= 1:
+      self.tokens -= 1
+      return 0.0
+    return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+  def __init__(self, per_minute: float, burst: int, max_buckets: int = MAX_BUCKETS):
+    self.per_minute = per_minute
+    self.burst = burst
+    self.max_buckets = max_buckets
+    self.buckets = OrderedDict() # key -> TokenBucket
+
+  def take(self, key: str, per_minute: Optional[float] = None) -> float:
+    per_minute = self.per_minute if per_minute is None else per_minute
+    if per_minute <= 0:
+      return 0.0
+    bucket = self.buckets.get(key)
+    if bucket is None or bucket.rate != per_minute / 60:
+      bucket = self.buckets[key] = TokenBucket(per_minute, self.burst)
+    self.buckets.move_to_end(key)
+    while len(self.buckets) > self.max_buckets:
+      self.buckets.popitem(last=False)
+    return bucket.take()
+
+
+class FairLLMSlots:
+  """
+  Caps the LLM calls in flight. Calls waiting for a slot are queued per tenant and freed slots go to the
+  tenants in turn, so a tenant with many queued calls delays its own calls and not everyone else's
+  """
+  def __init__(self, limit: int):
+    self.limit = limit
+    self.in_use = 0
+    self.queues = OrderedDict() # tenant_id -> deque of futures, in serving order
+
+  @property
+  def waiting(self) -> int:
+    return sum(len(queue) for queue in self.queues.values())
+
+  @asynccontextmanager
+  async def acquire(self, tenant_id: str = "default"):
+    if self.limit <= 0:
+      yield
+      return
+    if self.in_use < self.limit and not self.queues:
+      self.in_use += 1
+    else:
+      future = asyncio.get_running_loop().create_future()
+      self.queues.setdefault(tenant_id, deque()).append(future)
+      llm_calls_queued.labels(tenant=tenant_id).inc()
+      try:
+        await future # the slot is handed over by release
+      except asyncio.CancelledError:
+        if future.done() and not future.cancelled():
+          self.release() # handed over just before the cancellation, pass it on
+        else:
+          self.discard(tenant_id, future)
+        raise
+      finally:
+        llm_calls_queued.labels(tenant=tenant_id).dec()
+    try:
+      yield
+    finally:
+      self.release()
+
+  def release(self):
+    while self.queues:
+      tenant_id, queue = next(iter(self.queues.items()))
+      future = queue.popleft()
+      if queue:
+        self.queues.move_to_end(tenant_id) # the tenant's next call waits for the other tenants
+      else:
+        del self.queues[tenant_id]
+      if not future.done():
+        future.set_result(None)
+        return
+    self.in_use -= 1
+
+  def discard(self, tenant_id: str, future):
+    queue = self.queues.get(tenant_id)
+    if queue is not None and future in queue:
+      queue.remove(future)
+      if not queue:
+        del self.queues[tenant_id]
+
+
+tenant_turn_limiter = RateLimiter(TENANT_TURNS_PER_MINUTE, TENANT_TURN_BURST)
+session_turn_limiter = RateLimiter(SESSION_TURNS_PER_MINUTE, SESSION_TURN_BURST)
+llm_slots = FairLLMSlots(LLM_MAX_CONCURRENT_CALLS)
+
+
+def too_many_requests(tenant_id: str, limit: str, retry_after: float, detail: str):
+  rate_limited_turns.labels(tenant=tenant_id, limit=limit).inc()
+  logger.warning(f"Refused agent turn for tenant {tenant_id}: {detail}")
+  return HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+
+async def limit_agent_turn(tenant_id: str, session_id: str):
+  """
+  Admission check for an endpoint that starts an agent turn (process_chat).
+  Raises HTTPException 429 with a Retry-After header when the tenant or the session is over its rate,
+  or when the LLM queue is full
+  """
+  if LLM_MAX_QUEUED_CALLS > 0 and llm_slots.waiting >= LLM_MAX_QUEUED_CALLS:
+    raise too_many_requests(tenant_id, "queue", 5, "Too many LLM calls queued, try again shortly")
+
+  tenant = await tenant_collections.load_tenant(tenant_id)
+  wait = tenant_turn_limiter.take(tenant_id, getattr(tenant, "turns_per_minute", None))
+  if wait:
+    raise too_many_requests(tenant_id, "tenant", wait, "Tenant rate limit exceeded")
+  wait = session_turn_limiter.take(f"{tenant_id}/{session_id}")
+  if wait:
+    raise too_many_requests(tenant_id, "session", wait, "Session rate limit exceeded")
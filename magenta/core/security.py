@@ -8,8 +8,7 @@ from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from passlib.context import CryptContext
 from pydantic import BaseModel
 from jwt.exceptions import InvalidTokenError
-from pymongo import MongoClient
-from .config import SECRET_KEY, logger, MONGO_HOST, MONGO_PORT, MONGO_DB
+from .config import SECRET_KEY, logger, mongo_client, MONGO_DB
 
 # define env vars
 ALGORITHM = "HS256"
@@ -40,8 +39,7 @@ class UserInDB(User):
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-# connect to users db
-mongo_client = MongoClient(MONGO_HOST, MONGO_PORT)
+# users db (shares the client from config)
 db = mongo_client[MONGO_DB]
 users_collection = db.users
 
@@ -54,15 +52,15 @@ def get_password_hash(password):
   return pwd_context.hash(password)
 
 
-def get_user(db, username: str):
-  user_dict = db.find_one({"username": username})
+async def get_user(db, username: str):
+  user_dict = await db.find_one({"username": username})
   if not user_dict:
     return None
   return UserInDB(**user_dict)
   
 
-def authenticate_user(users_collection, username: str, password: str):
-  user = get_user(users_collection, username)
+async def authenticate_user(users_collection, username: str, password: str):
+  user = await get_user(users_collection, username)
   if not user:
     return False
   if not verify_password(password, user.hashed_password):
@@ -96,7 +94,7 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
     token_data = TokenData(username=username)
   except InvalidTokenError:
     raise credentials_exception
-  user = get_user(users_collection, username=token_data.username)
+  user = await get_user(users_collection, username=token_data.username)
   if user is None:
     raise credentials_exception
   return user
@@ -126,8 +124,8 @@ async def create_initial_users(collection, dir):
         del user['password']
         # validate user and insert into db
         userObj = UserInDB(**user)
-        if not get_user(collection, userObj.username):
-          collection.insert_one(user)
+        if not await get_user(collection, userObj.username):
+          await collection.insert_one(user)
           logger.info(f"Created user {userObj.username}")
           users_created += 1
         else:
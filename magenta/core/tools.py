@@ -1,4 +1,5 @@
 import random
+import asyncio
 import inspect
 import httpx
 import uuid
@@ -6,6 +7,7 @@ from datetime import datetime
 from typing import Callable, Dict, List, Any
 from .models import Tool, ToolWithContext, HttpMethod
 from .config import logger, tenant_collections
+from .tracing import traced, inject_trace_headers
 
 # helpers for validating definitions --------------------------------------------
 def validate_function_args(func: Callable, func_def: Dict[str, Any]) -> List[str]:
@@ -166,24 +168,25 @@ async def load_all_functions_in_db(
       
         # check if function already exists in the database
         if not overwrite:
-          existing_func = mongo_connection.find_one({"function.name": func_name}, {"_id": 0})
+          existing_func = await mongo_connection.find_one({"function.name": func_name}, {"_id": 0})
           if existing_func:
             logger.info(f"Function '{func_name}' already exists in the database.")
             continue
         else:
           # remove existing function
-          mongo_connection.delete_many({"function.name": func_name})
+          await mongo_connection.delete_many({"function.name": func_name})
 
         # insert function definition into the database
         tool = ToolWithContext(**func_def) if 'context_parameters' in func_def else Tool(**func_def)
-        mongo_connection.insert_one(tool.model_dump(exclude_none=True))
+        await mongo_connection.insert_one(tool.model_dump(exclude_none=True))
         logger.info(f"Function '{func_name}' inserted into the database.")
       else:
         logger.error(f"Function '{func_name}' not found in all_function_tool_definitions.")
         raise ValueError(f"Function '{func_name}' not found in all_function_tool_definitions.")
 
 
-def tool_handler(
+@traced(name="tool.name")
+async def tool_handler(
 		name: str, 
 		arguments: dict,
 		tools_collection,
@@ -191,7 +194,7 @@ def tool_handler(
 		context_arguments: dict = None
 	):
 	# find tool in database
-	tool = tools_collection.find_one({"function.name": name})
+	tool = await tools_collection.find_one({"function.name": name})
 	if not tool:
 		raise ValueError(f"Tool '{name}' not found in the database.")
 
@@ -207,15 +210,15 @@ def tool_handler(
 
 	if tool.type == "external":
 		# Handle external tool
-		with httpx.Client() as client:
+		async with httpx.AsyncClient(headers=inject_trace_headers()) as client: # continue the trace in the tool service
 			if tool.function.method == HttpMethod.GET:
-				response = client.get(str(tool.function.url), params=combined_arguments)
+				response = await client.get(str(tool.function.url), params=combined_arguments)
 			elif tool.function.method == HttpMethod.POST:
-				response = client.post(str(tool.function.url), json=combined_arguments)
+				response = await client.post(str(tool.function.url), json=combined_arguments)
 			elif tool.function.method == HttpMethod.PUT:
-				response = client.put(str(tool.function.url), json=combined_arguments)
+				response = await client.put(str(tool.function.url), json=combined_arguments)
 			elif tool.function.method == HttpMethod.DELETE:
-				response = client.delete(str(tool.function.url), params=combined_arguments)
+				response = await client.delete(str(tool.function.url), params=combined_arguments)
 			else:
 				raise ValueError(f"Unsupported HTTP method: {tool.function.method}")
 			response.raise_for_status()
@@ -228,7 +231,10 @@ def tool_handler(
 		function = function_dictionary[name]
 
 		try:
-			result = function(**combined_arguments)
+			if inspect.iscoroutinefunction(function):
+				result = await function(**combined_arguments)
+			else:
+				result = await asyncio.to_thread(function, **combined_arguments) # keep blocking tools off the event loop
 		except Exception as e:
 			logger.error(f"Error executing tool '{name}': {e}")
 			result = f"ERROR when executing tool '{name}': {e}" # return str error to LLM which can potentially make another call to try and correct it
@@ -0,0 +1,123 @@
+import os
+import inspect
+import functools
+from typing import Optional
+from opentelemetry import trace, propagate, context
+from opentelemetry.trace import SpanKind, Status, StatusCode
+from starlette.requests import Request
+from .config import logger
+
+
+# OpenTelemetry tracing. Spans are always created through the API, they are only recorded and exported
+# once setup_tracing installed a provider: when OTEL_EXPORTER_OTLP_ENDPOINT (or TRACING_ENABLED) is set.
+# The OTLP exporter reads the standard OTEL_EXPORTER_OTLP_* variables, e.g. http://localhost:4318 for a local collector
+TRACING_ENABLED = bool(os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")) or os.getenv("TRACING_ENABLED", "").lower() in ("1", "true")
+
+tracer = trace.get_tracer("magenta")
+
+
+def setup_tracing(service_name: str) -> bool:
+  if not TRACING_ENABLED:
+    return False
+  if not isinstance(trace.get_tracer_provider(), trace.ProxyTracerProvider):
+    return True # installed already (the module can be imported under two names)
+
+  from opentelemetry.sdk.resources import Resource
+  from opentelemetry.sdk.trace import TracerProvider
+  from opentelemetry.sdk.trace.export import BatchSpanProcessor
+  from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+  provider = TracerProvider(resource=Resource.create({"service.name": os.getenv("OTEL_SERVICE_NAME", service_name)}))
+  provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+  trace.set_tracer_provider(provider)
+  logger.info(f"Tracing enabled for {service_name}")
+  return True
+
+
+def shutdown_tracing():
+  provider = trace.get_tracer_provider()
+  if hasattr(provider, "shutdown"):
+    provider.shutdown() # flushes pending spans
+
+
+def set_span_attributes(**attributes):
+  # on the current span, None values are left out
+  span = trace.get_current_span()
+  for key, value in attributes.items():
+    if value is not None:
+      span.set_attribute(key, value)
+
+
+def inject_trace_headers(headers: Optional[dict] = None) -> dict:
+  # W3C traceparent headers for outgoing requests
+  headers = dict(headers or {})
+  propagate.inject(headers)
+  return headers
+
+
+def traced(span_name: Optional[str] = None, **attributes):
+  """
+  Run the decorated function (sync, async or async generator) in a span named after it.
+  Arguments whose names are in attributes are recorded, e.g. @traced(tenant_id="tenant.id")
+  """
+  def decorator(func):
+    name = span_name or func.__qualname__
+    signature = inspect.signature(func)
+
+    def span_attributes(args, kwargs) -> dict:
+      if not attributes:
+        return {}
+      bound = signature.bind_partial(*args, **kwargs)
+      return {
+        attribute: value for argument, attribute in attributes.items()
+        if isinstance(value := bound.arguments.get(argument, signature.parameters[argument].default), (str, int, float, bool))
+      }
+
+    if inspect.isasyncgenfunction(func):
+      # the span is not made current: a generator can be closed from another context than the one it started in
+      @functools.wraps(func)
+      async def async_gen_wrapper(*args, **kwargs):
+        span = tracer.start_span(name, attributes=span_attributes(args, kwargs))
+        try:
+          async for item in func(*args, **kwargs):
+            yield item
+        finally:
+          span.end()
+      return async_gen_wrapper
+
+    if inspect.iscoroutinefunction(func):
+      @functools.wraps(func)
+      async def async_wrapper(*args, **kwargs):
+        with tracer.start_as_current_span(name, attributes=span_attributes(args, kwargs)):
+          return await func(*args, **kwargs)
+      return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      with tracer.start_as_current_span(name, attributes=span_attributes(args, kwargs)):
+        return func(*args, **kwargs)
+    return wrapper
+
+  return decorator
+
+
+async def tracing_middleware(request: Request, call_next):
+  """
+  Server span per request, continuing the caller's trace (traceparent header). Background tasks run
+  in the request's context, so the spans of the work they do end up in the same trace
+  """
+  token = context.attach(propagate.extract(request.headers))
+  try:
+    with tracer.start_as_current_span(f"{request.method} {request.url.path}", kind=SpanKind.SERVER) as span:
+      span.set_attribute("http.request.method", request.method)
+      response = await call_next(request)
+      route = getattr(request.scope.get("route"), "path", None)
+      if route:
+        span.update_name(f"{request.method} {route}")
+        span.set_attribute("http.route", route)
+      span.set_attribute("http.response.status_code", response.status_code)
+      if response.status_code >= 500:
+        span.set_status(Status(StatusCode.ERROR))
+      return response
+  finally:
+    context.detach(token)
@@ -66,7 +66,7 @@ def embed_text_spacy(text, spacy_model = None):
 async def cleanup_mongo(collections, queries):
   for collection in collections:
     for query in queries:
-      collection.delete_many(query)
+      await collection.delete_many(query)
   return True
 
 
@@ -1,5 +1,6 @@
 from fastapi import FastAPI, HTTPException, status, Depends
 import os
+import asyncio
 import uvicorn
 import json
 from typing import Annotated
@@ -9,8 +10,8 @@ from sqlalchemy import text
 from sqlalchemy.orm import Session
 
 from core import (
-    logger, mongo_client, spacy_model, engine,
-    tenant_collections, get_db, SLACK_WEBHOOK_URL,
+    logger, mongo_client, spacy_model, engine, async_engine,
+    tenant_collections, tenant_middleware, get_db, SLACK_WEBHOOK_URL,
     Token, OAuth2PasswordRequestForm, ACCESS_TOKEN_EXPIRE_MINUTES,
     User, users_collection, authenticate_user, create_access_token,
     get_current_active_user, create_initial_users,
@@ -19,9 +20,12 @@ from core import (
 )
 from routes import (
     prompts_router, documents_router, chats_router,
-    tools_router, tenants_router
+    tools_router, tenants_router, usage_router
 )
 from services import load_prompts_from_files, load_documents_from_files
+from core.metrics import metrics_middleware, metrics_endpoint
+from core.tracing import setup_tracing, shutdown_tracing, tracing_middleware
+from core.logging_setup import flush_logs
 
 os.makedirs("temp", exist_ok=True) # create temp directory for file uploads
 
@@ -31,13 +35,16 @@ ENV = os.getenv('ENV', 'DEV')
 @asynccontextmanager
 async def lifespan(app: FastAPI):
 	logger.info("Application server started.")
+	await tenant_collections.refresh_tenants()
+	tenant_watcher = asyncio.create_task(tenant_collections.watch_tenants()) # pick up tenants created by other workers
 	# load default data from files
+	await tenant_collections.ensure_indexes()
 	await create_postgres_extensions(get_db)
 	await load_prompts_from_files(tenant_collections.get_collections_list("prompts"), dir="data/prompts")
 	await create_initial_users(users_collection, dir="data/users")
 	await load_all_functions_in_db(tenant_collections.get_collections_list("tools"))
 	await load_documents_from_files(
-		documents_collections=tenant_collections.collections["documents"], # dict tenant_id:collection_object
+		documents_collections=tenant_collections.get_collections_dict("documents"), # dict tenant_id:collection_object
 		dir="data/documents/instructions",
 		model=spacy_model
 	)
@@ -51,21 +58,31 @@ async def lifespan(app: FastAPI):
 	if ENV != "DEV":
 		await send_slack_message(SLACK_WEBHOOK_URL, "Application server started.")
 	yield
+	tenant_watcher.cancel()
 	# close all mongo connections
 	mongo_client.close()
-	# close SQLAlchemy engine
+	# close SQLAlchemy engines
 	engine.dispose()
+	await async_engine.dispose()
+	shutdown_tracing()
 	logger.info("Application server stopped.")
 	if ENV != "DEV":
 		await send_slack_message(SLACK_WEBHOOK_URL, "Application server stopped.")
+	await flush_logs()
 
 
+setup_tracing("magenta")
 app = FastAPI(lifespan=lifespan)
+app.middleware("http")(tenant_middleware) # innermost, loads the tenant of the request into the cache
+app.middleware("http")(metrics_middleware)
+app.middleware("http")(tracing_middleware) # outermost, so the request span covers everything
+app.add_route("/metrics", metrics_endpoint, include_in_schema=False)
 app.include_router(chats_router)
 app.include_router(prompts_router)
 app.include_router(tools_router)
 app.include_router(documents_router)
 app.include_router(tenants_router)
+app.include_router(usage_router)
 
 
 # some key routes
@@ -92,7 +109,7 @@ async def postgres_status(db: Session = Depends(get_db)):
 @app.get("/mongo_status")
 async def mongo_status():
 	try:
-		health = mongo_client.server_info()
+		health = await mongo_client.server_info()
 		return {"mongo": "healthy" if health else "unhealthy"}
 	except Exception as e:
 		logger.error(f"Error connecting to MongoDB: {e}")
@@ -104,7 +121,7 @@ async def mongo_status():
 async def login_for_access_token(
 	form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
 ) -> Token:
-	user = authenticate_user(users_collection, form_data.username, form_data.password)
+	user = await authenticate_user(users_collection, form_data.username, form_data.password)
 	if not user:
 		raise HTTPException(
 			status_code=status.HTTP_401_UNAUTHORIZED,
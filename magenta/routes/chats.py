@@ -4,8 +4,9 @@ from fastapi.exceptions import HTTPException
 from typing import Optional, List, Any, Dict
 from core.config import logger, tenant_collections, get_db
 from core.models import Task, Chat, ChatInternalMessage, ChatMessage, AgentType
-from services.chat_service import process_chat, call_gpt
-from services.document_service import perform_postgre_search
+from core.rate_limit import limit_agent_turn
+from services.chat_service import process_chat
+from services.document_service import perform_postgre_search_async
 from sqlalchemy.orm import Session
 
 # chats router --------------------------------------------------------
@@ -25,10 +26,10 @@ async def create_chat(
 		chats_collection = tenant_collections.get_collection(tenant_id, "chats")
 		prompts_collection = tenant_collections.get_collection(tenant_id, "prompts")
 
-		if sysprompt_id is not None and not prompts_collection.find_one({"prompt_id": sysprompt_id}): 
+		if sysprompt_id is not None and not await prompts_collection.find_one({"prompt_id": sysprompt_id}): 
 			raise HTTPException(status_code=400, detail="System prompt not found")
 
-		if chats_collection.count_documents({"chat_id": chat_id}) > 0:
+		if await chats_collection.count_documents({"chat_id": chat_id}) > 0:
 			raise HTTPException(status_code=400, detail="Chat already exists")
 
 		# assign system prompt
@@ -54,7 +55,7 @@ async def create_chat(
 		if description is not None:
 			chat["description"] = description
 
-		chats_collection.insert_one(chat)
+		await chats_collection.insert_one(chat)
 		logger.info(f"Created new chat {chat_id}, context {context_id}.")
 
 		return chat
@@ -70,9 +71,9 @@ async def send_chat(
 	message: str,
 	background_tasks: BackgroundTasks,
 	tenant_id: str = "default",
-	dry_run: Optional[bool] = False,
-	db: Session = Depends(get_db)
+	dry_run: Optional[bool] = False
 ):
+	await limit_agent_turn(tenant_id, chat_id) # 429 when the tenant or the chat is over its rate
 	try:
 		chats_collection = tenant_collections.get_collection(tenant_id, "chats")
 		prompts_collection = tenant_collections.get_collection(tenant_id, "prompts")
@@ -80,7 +81,7 @@ async def send_chat(
 		tools_collection = tenant_collections.get_collection(tenant_id, "tools")
 		
 		# find chat in db
-		chat = chats_collection.count_documents({"chat_id": chat_id})
+		chat = await chats_collection.count_documents({"chat_id": chat_id})
 		if chat == 0:
 			raise HTTPException(status_code=404, detail="Chat not found")
 
@@ -97,13 +98,13 @@ async def send_chat(
 			prompts_collection=prompts_collection,
 			documents_collection=documents_collection,
 			tools_collection=tools_collection,
+			usage_collection=tenant_collections.get_collection(tenant_id, "llm_usage"),
 			dry_run=dry_run,
-			call_llm_func=call_gpt,
-			rag_func=perform_postgre_search,
+			rag_func=perform_postgre_search_async, # opens a session per task
 			rag_table_name=tenant_id, # using tenant_id as table_name for now, later we might have separate schemas for different tenants
 			persist_rag_results=False,
-			db=db,
-			spacy_model=None
+			spacy_model=None,
+			tenant_id=tenant_id
 		)
 
 		return {"task_id": message_id, "status":"pending"}
@@ -130,7 +131,7 @@ async def list_chats(
 	if user_id:
 		query["user_id"] = user_id
 
-	chats = list(chats_collection.find(query, {"_id": 0}))
+	chats = await chats_collection.find(query, {"_id": 0}).to_list(length=None)
 	logger.info(f"Found {len(chats)} chats.")
 
 	# remove internal messages from the response
@@ -148,7 +149,7 @@ async def get_chat(
 	tenant_id: str = "default"
 ):
 	chats_collection = tenant_collections.get_collection(tenant_id, "chats")
-	chat = chats_collection.find_one({"chat_id": chat_id}, {"_id": 0})
+	chat = await chats_collection.find_one({"chat_id": chat_id}, {"_id": 0})
 	if not chat:
 		raise HTTPException(status_code=404, detail="Chat not found")
 	chat["messages"] = [m for m in chat["messages"] if "message_id" in m] # internal messages have no message_id
@@ -162,7 +163,7 @@ async def list_chat_messages(
 	no_internal: Optional[bool] = True
 ):
 	chats_collection = tenant_collections.get_collection(tenant_id, "chats")
-	chat = chats_collection.find_one({"chat_id": chat_id}, {"_id": 0})
+	chat = await chats_collection.find_one({"chat_id": chat_id}, {"_id": 0})
 	
 	if not chat:
 		raise HTTPException(status_code=404, detail="Chat not found")
@@ -191,7 +192,7 @@ async def get_chat_message(
 	tenant_id: str = "default"
 ):
 	chats_collection = tenant_collections.get_collection(tenant_id, "chats")
-	chat = chats_collection.find_one({"chat_id": chat_id}, {"_id": 0})
+	chat = await chats_collection.find_one({"chat_id": chat_id}, {"_id": 0})
 	if not chat:
 		raise HTTPException(status_code=404, detail="Chat not found")
 	messages = chat["messages"]
@@ -207,14 +208,55 @@ async def get_chat_message_status(
 	tenant_id: str = "default"
 ):
 	chats_collection = tenant_collections.get_collection(tenant_id, "chats")
-	chat = chats_collection.find_one({"chat_id": chat_id}, {"_id": 0})
+	chat = await chats_collection.find_one(
+		{"chat_id": chat_id}, 
+		{"_id": 0, "chat_id": 1, "statuses": {"$elemMatch": {"message_id": message_id}}}
+	)
 	if not chat:
 		raise HTTPException(status_code=404, detail="Chat not found")
-	statuses = chat["statuses"]
+	statuses = chat.get("statuses", [])
 	status = next((s for s in statuses if s["message_id"] == message_id), None)
 	if not status:
 		raise HTTPException(status_code=404, detail="Message not found")
-	return {"task_id": message_id, "status": status["status"]}
+	return {"task_id": message_id, "status": status["status"], "error": status.get("error")}
+
+
+@chats_router.get("/{chat_id}/statuses", response_model=Dict[str, Task])
+async def get_chat_message_statuses(
+	chat_id: str,
+	message_ids: List[str] = Query(..., description="Message IDs to look up"),
+	status: Optional[str] = Query(None, description="Filter by status (e.g., 'pending', 'completed')"),
+	tenant_id: str = "default"
+):
+	# batch version of get_chat_message_status: a single query that only projects the requested statuses
+	chats_collection = tenant_collections.get_collection(tenant_id, "chats")
+	chat = await chats_collection.find_one(
+		{"chat_id": chat_id},
+		{
+			"_id": 0,
+			"statuses": {
+				"$filter": {
+					"input": "$statuses",
+					"as": "s",
+					"cond": {"$in": ["$$s.message_id", message_ids]}
+				}
+			}
+		}
+	)
+	if not chat:
+		raise HTTPException(status_code=404, detail="Chat not found")
+
+	result = {}
+	for message_status in chat.get("statuses") or []:
+		message_id = message_status["message_id"]
+		if message_id in result:
+			continue # keep the first match, same as get_chat_message_status
+		result[message_id] = {"task_id": message_id, "status": message_status["status"], "error": message_status.get("error")}
+
+	if status is not None:
+		result = {k: v for k, v in result.items() if v["status"] == status}
+
+	return result
 
 
 @chats_router.get("/{chat_id}/status", response_model=Task)
@@ -224,14 +266,14 @@ async def get_chat_status(
 ):
 	# status of latest message
 	chats_collection = tenant_collections.get_collection(tenant_id, "chats")
-	chat = chats_collection.find_one({"chat_id": chat_id}, {"_id": 0})
+	chat = await chats_collection.find_one({"chat_id": chat_id}, {"_id": 0, "statuses": {"$slice": -1}, "chat_id": 1})
 	if not chat:
 		raise HTTPException(status_code=404, detail="Chat not found")
 	statuses = chat["statuses"]
 	if len(statuses) == 0:
 		raise HTTPException(status_code=404, detail="No messages found")
 	latest_status = statuses[-1]
-	return {"task_id": latest_status["message_id"], "status": latest_status["status"]}
+	return {"task_id": latest_status["message_id"], "status": latest_status["status"], "error": latest_status.get("error")}
 
 
 @chats_router.delete("/{chat_id}")
@@ -240,7 +282,7 @@ async def delete_chat(
 	tenant_id: str = "default"
 ):
 	chats_collection = tenant_collections.get_collection(tenant_id, "chats")
-	result = chats_collection.delete_one({"chat_id": chat_id})
+	result = await chats_collection.delete_one({"chat_id": chat_id})
 	if result.deleted_count == 0:
 		raise HTTPException(status_code=404, detail="Chat not found")
 	return {"message": "Chat deleted successfully"}
@@ -253,7 +295,7 @@ async def delete_chat_message(
 	tenant_id: str = "default"
 ):
 	chats_collection = tenant_collections.get_collection(tenant_id, "chats")
-	result = chats_collection.update_one(
+	result = await chats_collection.update_one(
 		{"chat_id": chat_id},
 		{"$pull": {"messages": {"message_id": message_id}}}
 	)
@@ -1,11 +1,12 @@
 import uuid
+import asyncio
 from typing import List, Dict, Optional
 from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, File, UploadFile
 from sqlalchemy import delete
-from core.config import logger, tenant_collections, get_db
+from core.config import logger, tenant_collections, engine, get_async_db
 from core.models import Document, Task
-from services.document_service import process_document, create_postgres_table, perform_postgre_search
-from sqlalchemy.orm import Session
+from services.document_service import process_document, create_postgres_table, perform_postgre_search_async
+from sqlalchemy.ext.asyncio import AsyncSession
 
 
 documents_router = APIRouter(prefix="/documents", tags=["documents"])
@@ -28,9 +29,9 @@ async def list_documents(
   if type:
     query["type"] = type
   
-  documents = documents_collection.find(query, {"_id": 0})
+  documents = await documents_collection.find(query, {"_id": 0}).to_list(length=None)
   
-  return list(documents)
+  return documents
 
 
 @documents_router.get("/ids", response_model=List[Dict[str, str]])
@@ -50,9 +51,9 @@ async def list_document_ids(
 	if type:
 		query["type"] = type
 	
-	documents = documents_collection.find(query, {"_id": 0, "document_id": 1, "name": 1, "description": 1})
+	documents = await documents_collection.find(query, {"_id": 0, "document_id": 1, "name": 1, "description": 1}).to_list(length=None)
 	
-	return list(documents)
+	return documents
 
 
 @documents_router.post("/upload", response_model=Task)
@@ -65,8 +66,7 @@ async def upload_document(
 	description: Optional[str] = None,
 	file: UploadFile = File(...), 
 	chunk_size: int = 1000,
-	metadata: dict = None,
-	db: Session = Depends(get_db)
+	metadata: dict = None
 ):
 	try:
 		documents_collection = tenant_collections.get_collection(tenant_id, "documents")
@@ -78,14 +78,14 @@ async def upload_document(
 		if not document_id:
 			document_id = str(uuid.uuid4())
 		else:
-			if documents_collection.find_one({"document_id": document_id}):
+			if await documents_collection.find_one({"document_id": document_id}):
 				raise HTTPException(status_code=400, detail="Document ID already exists")
 
 		file_location = f"temp/{file.filename}"
 		with open(file_location, "wb") as f:
 			f.write(file.file.read())
 		
-		documents_collection.insert_one(
+		await documents_collection.insert_one(
 			{
 				"document_id": document_id,
 				"name": name,
@@ -109,9 +109,8 @@ async def upload_document(
 			metadata = metadata,
 			spacy_model = None,
 			documents_collection = documents_collection,
-			table_name = tenant_id, # using tenant_id as table_name for now, later we might have separate schemas for different tenants
-			db = db
-		)
+			table_name = tenant_id # using tenant_id as table_name for now, later we might have separate schemas for different tenants
+		) # process_document opens its own db session, the request one is closed by the time it runs
 		return {"task_id": document_id, "status":"pending", "type":"document upload"}  
 		
 	except Exception as e:
@@ -125,11 +124,11 @@ async def search_documents(
 	tenant_id: str = "default",
 	min_cosine_similarity: Optional[float] = -1,
 	limit: Optional[int] = 10,
-	db: Session = Depends(get_db)
+	db: AsyncSession = Depends(get_async_db)
 ):  
 	try:
 		
-		search_results = perform_postgre_search(
+		search_results = await perform_postgre_search_async(
 			new_message=query,
 			rag_documents=[],
 			db=db,
@@ -147,10 +146,10 @@ async def search_documents(
 
 
 @documents_router.delete("/{document_id}")
-async def delete_document(document_id: str, tenant_id: str = "default", db: Session = Depends(get_db)):
+async def delete_document(document_id: str, tenant_id: str = "default", db: AsyncSession = Depends(get_async_db)):
 	# First, get the document to find out which collection it's in
 	documents_collection = tenant_collections.get_collection(tenant_id, "documents")
-	document = documents_collection.find_one({"document_id": document_id})
+	document = await documents_collection.find_one({"document_id": document_id})
 	if not document:
 		logger.warning(f"Document {document_id} not found.")
 		raise HTTPException(status_code=404, detail="Document not found")
@@ -159,9 +158,9 @@ async def delete_document(document_id: str, tenant_id: str = "default", db: Sess
 	
 	try:
 		# Delete from PostgreSQL
-		VectorModel = create_postgres_table(table_name, db.bind)
-		deleted = db.execute(delete(VectorModel).where(VectorModel.document_id == document_id))
-		db.commit()
+		VectorModel = await asyncio.to_thread(create_postgres_table, table_name, engine)
+		deleted = await db.execute(delete(VectorModel).where(VectorModel.document_id == document_id))
+		await db.commit()
 
 		if deleted.rowcount == 0:
 			logger.warning(f"No vectors found for document {document_id} in PostgreSQL.")
@@ -169,7 +168,7 @@ async def delete_document(document_id: str, tenant_id: str = "default", db: Sess
 			logger.info(f"Deleted {deleted.rowcount} vectors for document {document_id} from PostgreSQL table {table_name}")
 
 		# Delete from MongoDB
-		result = documents_collection.delete_one({"document_id": document_id})
+		result = await documents_collection.delete_one({"document_id": document_id})
 		if result.deleted_count == 0:
 			logger.warning(f"Document {document_id} not found in MongoDB when deleting.")
 		else:
@@ -185,7 +184,7 @@ async def delete_document(document_id: str, tenant_id: str = "default", db: Sess
 @documents_router.get("/{document_id}/status", response_model=Task)
 async def get_document_upload_status(document_id: str, tenant_id: str = "default"):
 	documents_collection = tenant_collections.get_collection(tenant_id, "documents")
-	document = documents_collection.find_one({"document_id": document_id}, {"_id": 0, "status": 1})
+	document = await documents_collection.find_one({"document_id": document_id}, {"_id": 0, "status": 1})
 	if not document:
 		logger.warning(f"Document {document_id} not found.")
 		raise HTTPException(status_code=404, detail="Document not found")
@@ -195,7 +194,7 @@ async def get_document_upload_status(document_id: str, tenant_id: str = "default
 @documents_router.get("/{document_id}", response_model=Document)
 async def get_document(document_id: str, tenant_id: str = "default"):
 	documents_collection = tenant_collections.get_collection(tenant_id, "documents")
-	document = documents_collection.find_one({"document_id": document_id}, {"_id": 0})
+	document = await documents_collection.find_one({"document_id": document_id}, {"_id": 0})
 	if not document:
 		logger.warning(f"Document {document_id} not found.")
 		raise HTTPException(status_code=404, detail="Document not found")
@@ -205,7 +204,7 @@ async def get_document(document_id: str, tenant_id: str = "default"):
 @documents_router.get("/{document_id}/text", response_model=dict)
 async def get_document_chunks(document_id: str, tenant_id: str = "default"):
 	documents_collection = tenant_collections.get_collection(tenant_id, "documents")
-	document = documents_collection.find_one({"document_id": document_id})
+	document = await documents_collection.find_one({"document_id": document_id})
 	if not document:
 		logger.warning(f"Document {document_id} not found.")
 		raise HTTPException(status_code=404, detail="Document not found")
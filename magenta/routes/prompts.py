@@ -16,13 +16,14 @@ async def create_prompt(
 	description: Optional[str] = None,
 	toolset: Optional[List[str]] = None,
 	documents: Optional[RagSpec] = None,
+	llm_model: Optional[str] = None,
 	tenant_id: str = "default"
 ):
 	prompts_collection = tenant_collections.get_collection(tenant_id, "prompts")
 	
 	# If prompt_id is provided, check if it already exists
 	if prompt_id:
-		existing_prompt = prompts_collection.find_one({"prompt_id": prompt_id})
+		existing_prompt = await prompts_collection.find_one({"prompt_id": prompt_id})
 		if existing_prompt:
 			raise HTTPException(status_code=400, detail=f"Prompt ID {prompt_id} already exists")
 	else:
@@ -30,7 +31,7 @@ async def create_prompt(
 		prompt_id = name.replace(" ", "").lower()
 
 	# Check if prompt name already exists
-	while prompts_collection.find_one({"name": name}):
+	while await prompts_collection.find_one({"name": name}):
 		raise HTTPException(status_code=400, detail=f"Prompt name {name} already exists")
 	
 	# validate prompt
@@ -42,7 +43,8 @@ async def create_prompt(
 			prompt=prompt,
 			description=description,
 			toolset=toolset,
-			documents=documents
+			documents=documents,
+			llm_model=llm_model
 		)
 	except Exception as e:
 		logger.error(f"Error creating prompt: {e}")
@@ -50,7 +52,7 @@ async def create_prompt(
 
 	# Insert new prompt
 	try:
-		prompts_collection.insert_one(prompt_obj.model_dump())
+		await prompts_collection.insert_one(prompt_obj.model_dump())
 	except Exception as e:
 		logger.error(f"Error inserting prompt into database: {e}")
 		raise HTTPException(status_code=500, detail="Error saving prompt to database")
@@ -76,9 +78,9 @@ async def list_prompts(
 	if type:
 		query["type"] = type
 	
-	prompts = prompts_collection.find(query, {"_id": 0})
+	prompts = await prompts_collection.find(query, {"_id": 0}).to_list(length=None)
 
-	return list(prompts)
+	return prompts
 
 
 @prompts_router.get("/{prompt_id}", response_model=Prompt)
@@ -87,7 +89,7 @@ async def get_prompt(
 	tenant_id: str = "default"
 ):
 	prompts_collection = tenant_collections.get_collection(tenant_id, "prompts")
-	prompt = prompts_collection.find_one({"prompt_id": prompt_id}, {"_id": 0})
+	prompt = await prompts_collection.find_one({"prompt_id": prompt_id}, {"_id": 0})
 	if not prompt:
 		logger.warning(f"Prompt {prompt_id} not found.")
 		raise HTTPException(status_code=404, detail="Prompt not found")
@@ -100,7 +102,7 @@ async def delete_prompt(
 	tenant_id: str = "default"
 ):
 	prompts_collection = tenant_collections.get_collection(tenant_id, "prompts")
-	result = prompts_collection.delete_one({"prompt_id": prompt_id})
+	result = await prompts_collection.delete_one({"prompt_id": prompt_id})
 	if result.deleted_count == 0:
 		logger.warning(f"Prompt {prompt_id} not found.")
 		raise HTTPException(status_code=404, detail="Prompt not found")
@@ -117,12 +119,13 @@ async def update_prompt(
 	description: Optional[str] = None,
 	toolset: Optional[List[str]] = None,
 	documents: Optional[RagSpec] = None,
+	llm_model: Optional[str] = None,
 	tenant_id: str = "default"
 ):
 	prompts_collection = tenant_collections.get_collection(tenant_id, "prompts")
 	
 	# Check if prompt exists
-	existing_prompt = prompts_collection.find_one({"prompt_id": prompt_id})
+	existing_prompt = await prompts_collection.find_one({"prompt_id": prompt_id})
 	if not existing_prompt:
 		raise HTTPException(status_code=404, detail=f"Prompt ID {prompt_id} not found")
 	
@@ -140,13 +143,15 @@ async def update_prompt(
 		update_data["toolset"] = toolset
 	if documents is not None:
 		update_data["documents"] = documents.model_dump()
+	if llm_model is not None:
+		update_data["llm_model"] = llm_model
 	
 	if not update_data:
 		raise HTTPException(status_code=400, detail="No update data provided")
 	
 	# Update prompt
 	try:
-		result = prompts_collection.update_one({"prompt_id": prompt_id}, {"$set": update_data})
+		result = await prompts_collection.update_one({"prompt_id": prompt_id}, {"$set": update_data})
 		if result.modified_count == 0:
 			logger.warning(f"No changes made when updating prompt {prompt_id}")
 	except Exception as e:
@@ -154,7 +159,7 @@ async def update_prompt(
 		raise HTTPException(status_code=500, detail="Error updating prompt in database")
 	
 	# Fetch and return updated prompt
-	updated_prompt = prompts_collection.find_one({"prompt_id": prompt_id}, {"_id": 0})
+	updated_prompt = await prompts_collection.find_one({"prompt_id": prompt_id}, {"_id": 0})
 	if not updated_prompt:
 		raise HTTPException(status_code=404, detail="Updated prompt not found")
 	logger.info(f"Updated prompt {prompt_id}. Changes: {update_data}")
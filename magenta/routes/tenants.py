@@ -1,5 +1,5 @@
 import uuid
-from typing import List, Optional
+from typing import List, Optional, Dict
 from fastapi import APIRouter, HTTPException
 from core.config import logger, tenant_collections
 from core.models import Tenant
@@ -18,11 +18,10 @@ async def create_tenant(
 	name: Optional[str] = None, 
 	description: Optional[str] = None
 ):
-	all_tenants = tenant_collections.all_tenants
-	if any(t.tenant_id == tenant_id for t in all_tenants):
+	if await tenant_collections.load_tenant(tenant_id) is not None:
 		raise HTTPException(status_code=400, detail="Tenant ID already exists")
 	tenant = Tenant(tenant_id=tenant_id, name=name, description=description)
-	tenant_collections.add_new_tenant(tenant.model_dump(exclude_none=True))
+	await tenant_collections.add_new_tenant(tenant.model_dump(exclude_none=True))
 	return tenant
 
 
@@ -30,8 +29,7 @@ async def create_tenant(
 async def get_tenant(
 	tenant_id: str,
 ):
-	all_tenants = tenant_collections.all_tenants
-	tenant = next((t for t in all_tenants if t.tenant_id == tenant_id), None)
+	tenant = await tenant_collections.load_tenant(tenant_id)
 	if not tenant:
 		raise HTTPException(status_code=404, detail="Tenant not found")
 	return tenant
@@ -41,7 +39,7 @@ async def get_tenant(
 async def delete_tenant(
 	tenant_id: str
 ):
-	tenant_collections.remove_tenant(tenant_id)
+	await tenant_collections.remove_tenant(tenant_id)
 	return {"message": "Tenant deleted successfully"}
 
 
@@ -51,8 +49,7 @@ async def update_tenant(
 	name: Optional[str] = None, 
 	description: Optional[str] = None
 ):
-	all_tenants = tenant_collections.all_tenants
-	tenant = next((t for t in all_tenants if t.tenant_id == tenant_id), None)
+	tenant = await tenant_collections.load_tenant(tenant_id)
 	if not tenant:
 		raise HTTPException(status_code=404, detail="Tenant not found")
 	if name:
@@ -60,8 +57,20 @@ async def update_tenant(
 	if description:
 		tenant.description = description
 	if name or description:
-		tenant_collections.tenants_collection.update_one(
+		await tenant_collections.tenants_collection.update_one(
 			{"tenant_id": tenant_id},
 			{"$set": tenant.model_dump(exclude_none=True)}
 		)
 	return tenant
+
+
+@tenants_router.get("/{tenant_id}/indexes", response_model=Dict[str, List[dict]])
+async def get_tenant_index_stats(
+	tenant_id: str
+):
+	# index usage stats per collection, for spotting unused indexes or collection scans
+	try:
+		return await tenant_collections.get_index_stats(tenant_id)
+	except Exception as e:
+		logger.error(f"Error getting index stats for tenant {tenant_id}: {e}")
+		raise HTTPException(status_code=500, detail="Error getting index stats")
@@ -19,7 +19,7 @@ async def list_tools(
 	if name:
 		query["function.name"] = name
 	
-	tool_documents = tools_collection.find(query, {"_id": 0})
+	tool_documents = await tools_collection.find(query, {"_id": 0}).to_list(length=None)
 
 	tools = [ToolWithContext(**tool) for tool in tool_documents]
 
@@ -38,10 +38,10 @@ async def list_tool_ids(
 		query["function.name"] = name
 	
 	# Only retrieve tool_id and function.name fields
-	tools = tools_collection.find(
+	tools = await tools_collection.find(
 		query, 
 		{"_id": 0, "tool_id": 1, "function.name": 1, "function.description": 1}
-	)
+	).to_list(length=None)
 	
 	# Reshape the nested structure to flat {tool_id, name} format
 	tool_ids = [
@@ -70,7 +70,7 @@ async def create_tool(
 	try:
 		tools_collection = tenant_collections.get_collection(tenant_id, "tools")
 		# check if name already exists
-		if tools_collection.find_one({"function.name": name}, {"_id": 0}):
+		if await tools_collection.find_one({"function.name": name}, {"_id": 0}):
 			raise HTTPException(status_code=400, detail="Tool name already exists")
 		
 		# check if required parameters are provided
@@ -116,7 +116,7 @@ async def create_tool(
 
 		# Insert new tool
 		logger.info(f"Inserting new tool {name}, ID {tool_id}.")
-		tools_collection.insert_one(tool.model_dump(exclude_none=True))
+		await tools_collection.insert_one(tool.model_dump(exclude_none=True))
 		logger.info(f"Created new tool {name}, ID {tool_id}.")
 		return tool
 	
@@ -131,7 +131,7 @@ async def get_tool(
 	tenant_id: str = "default"
 ):
 	tools_collection = tenant_collections.get_collection(tenant_id, "tools")
-	tool_document = tools_collection.find_one({"tool_id": tool_id}, {"_id": 0})
+	tool_document = await tools_collection.find_one({"tool_id": tool_id}, {"_id": 0})
 	if not tool_document:
 		logger.warning(f"Tool {tool_id} not found.")
 		raise HTTPException(status_code=404, detail="Tool not found")
@@ -153,7 +153,7 @@ async def update_tool(
 ):
 	try:
 		tools_collection = tenant_collections.get_collection(tenant_id, "tools")
-		tool = tools_collection.find_one({"tool_id": tool_id})
+		tool = await tools_collection.find_one({"tool_id": tool_id})
 		if not tool:
 			logger.warning(f"Tool {tool_id} not found.")
 			raise HTTPException(status_code=404, detail="Tool not found")
@@ -178,9 +178,9 @@ async def update_tool(
 		if context_parameters is not None:
 			update_data["context_parameters"] = [cp.model_dump(exclude_none=True) for cp in context_parameters]
 
-		tools_collection.update_one({"tool_id": tool_id}, {"$set": update_data})
+		await tools_collection.update_one({"tool_id": tool_id}, {"$set": update_data})
 
-		updated_tool = tools_collection.find_one({"tool_id": tool_id}, {"_id": 0})
+		updated_tool = await tools_collection.find_one({"tool_id": tool_id}, {"_id": 0})
 		logger.info(f"Updated tool {tool_id}.")
 		return ToolWithContext(**updated_tool).model_dump(exclude_none=True)
 	
@@ -195,7 +195,7 @@ async def delete_tool(
 	tenant_id: str = "default"
 ):
 	tools_collection = tenant_collections.get_collection(tenant_id, "tools")
-	result = tools_collection.delete_one({"tool_id": tool_id})
+	result = await tools_collection.delete_one({"tool_id": tool_id})
 	if result.deleted_count == 0:
 		logger.warning(f"Tool {tool_id} not found.")
 		raise HTTPException(status_code=404, detail="Tool not found")
@@ -0,0 +1,80 @@
+from datetime import datetime
+from typing import List, Optional, Literal
+from fastapi import APIRouter, HTTPException
+from core.config import logger, tenant_collections
+from core.models import LLMUsageRollup
+from services.usage_service import get_usage_rollups
+
+usage_router = APIRouter(prefix="/usage", tags=["usage"])
+
+@usage_router.get("/", response_model=List[LLMUsageRollup])
+async def get_tenant_usage(
+	tenant_id: str = "default",
+	group_by: Optional[Literal["model", "prompt_id", "purpose"]] = None,
+	since: Optional[datetime] = None,
+	until: Optional[datetime] = None
+):
+	# LLM usage of one tenant, in total or per model, prompt or purpose (chat or summary)
+	try:
+		usage_collection = tenant_collections.get_collection(tenant_id, "llm_usage")
+		return await get_usage_rollups(usage_collection, group_by=group_by, since=since, until=until)
+	except ValueError as e:
+		raise HTTPException(status_code=404, detail=str(e))
+	except Exception as e:
+		logger.error(f"Error getting LLM usage for tenant {tenant_id}: {e}")
+		raise HTTPException(status_code=500, detail="Error getting LLM usage")
+
+
+@usage_router.get("/tenants", response_model=List[LLMUsageRollup])
+async def get_usage_per_tenant(
+	since: Optional[datetime] = None,
+	until: Optional[datetime] = None
+):
+	# one rollup per tenant with LLM calls in the period, keyed by tenant_id, largest token use first
+	try:
+		rollups = []
+		for tenant_id, usage_collection in tenant_collections.get_collections_dict("llm_usage").items():
+			for rollup in await get_usage_rollups(usage_collection, since=since, until=until):
+				rollups.append({**rollup, "key": tenant_id})
+		return sorted(rollups, key=lambda rollup: rollup["total_tokens"], reverse=True)
+	except Exception as e:
+		logger.error(f"Error getting LLM usage per tenant: {e}")
+		raise HTTPException(status_code=500, detail="Error getting LLM usage")
+
+
+@usage_router.get("/sessions", response_model=List[LLMUsageRollup])
+async def get_usage_per_session(
+	tenant_id: str = "default",
+	since: Optional[datetime] = None,
+	until: Optional[datetime] = None,
+	limit: int = 50
+):
+	# sessions (chats) of a tenant with the largest token use, keyed by chat_id
+	try:
+		usage_collection = tenant_collections.get_collection(tenant_id, "llm_usage")
+		return await get_usage_rollups(usage_collection, group_by="chat_id", since=since, until=until, limit=limit)
+	except ValueError as e:
+		raise HTTPException(status_code=404, detail=str(e))
+	except Exception as e:
+		logger.error(f"Error getting LLM usage per session for tenant {tenant_id}: {e}")
+		raise HTTPException(status_code=500, detail="Error getting LLM usage")
+
+
+@usage_router.get("/sessions/{session_id}", response_model=List[LLMUsageRollup])
+async def get_session_usage(
+	session_id: str,
+	tenant_id: str = "default",
+	group_by: Optional[Literal["model", "prompt_id", "purpose"]] = None
+):
+	# LLM usage of one session (chat), in total or per model, prompt or purpose
+	try:
+		usage_collection = tenant_collections.get_collection(tenant_id, "llm_usage")
+		rollups = await get_usage_rollups(usage_collection, group_by=group_by, chat_id=session_id)
+	except ValueError as e:
+		raise HTTPException(status_code=404, detail=str(e))
+	except Exception as e:
+		logger.error(f"Error getting LLM usage for session {session_id}: {e}")
+		raise HTTPException(status_code=500, detail="Error getting LLM usage")
+	if not rollups:
+		raise HTTPException(status_code=404, detail="No LLM usage recorded for this session")
+	return rollups
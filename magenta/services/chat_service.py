@@ -1,107 +1,90 @@
 import json
+import time
+import functools
 from datetime import datetime
 from typing import Optional
-from sqlalchemy.orm import Session
-from fastapi import Depends
-from core.config import logger, openai_client, spacy_model, get_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from core.config import (
+  logger, spacy_model, tenant_collections, CONTEXT_TOKEN_BUDGET, LLM_PROVIDER, LLM_DEFAULT_MODEL, LLM_FALLBACK_MODELS
+)
 from core.models import ToolWithContext
+from core.metrics import StageTimer, track_stage, tool_call_duration, agent_turn_duration, agent_turns_in_progress
+from core.tracing import traced
+from core.logging_setup import truncate, log_payload
 from core.tools import tool_handler, default_function_dictionary
-from .document_service import perform_postgre_search, add_rag_results_to_message, add_documents_to_sysprompt
+from .document_service import perform_postgre_search_async, add_rag_results_to_message, add_documents_to_sysprompt
+from .context_service import build_context_window, messages_after_summary, schedule_chat_summary
+from .llm_cache import llm_cache as default_llm_cache
+from .fake_llm import load_fake_llm
+from .llm_gateway import ResilientLLM, LLMUnavailableError
+from .llm_providers import providers, parse_model
+from .llm_service import call_llm, tool_names
+from .usage_service import LLMUsageLedger
 
 
-def call_gpt(
-    messages, sysprompt=None, client=openai_client, 
-    json_mode=False, model = "gpt-4o", tools=None, tool_choice="auto"
-  ):
-  logger.info(f"Calling GPT")
-  if sysprompt is not None:
-    # add {role: "system", content: sysprompt} to the beginning of the messages list
-    messages.insert(0, {"role": "system", "content": sysprompt})
-
-  # make sure messages don't include message_id and timestamp
-  messages = [{k: v for k, v in d.items() if k != "message_id" and k != "timestamp"} for d in messages]
-
-  if not tools:
-    logger.info(f"No tools found.")
-    tools = []
-  else:
-    # remove tool_id from each tool
-    tools = [{k: v for k, v in d.items() if k != "tool_id"} for d in tools]
-    logger.info(f"Tools found: {tools}")
-
-  if json_mode:
-    if len(tools):
-      completion = client.chat.completions.create(
-        model=model,
-        response_format={ "type": "json_object" },
-        messages=messages,
-        tools=tools,
-        tool_choice=tool_choice
-      )
-    else:
-      completion = client.chat.completions.create(
-        model=model,
-        response_format={ "type": "json_object" },
-        messages=messages
-      )
-    
-    result = {
-      "message":json.loads(result.choices[0].message.content)
-    }
-  else:
-    if len(tools):
-      completion = client.chat.completions.create(
-        model=model,
-        messages=messages,
-        tools=tools,
-        tool_choice=tool_choice
-      )
-    else:
-      completion = client.chat.completions.create(
-        model=model,
-        messages=messages
-      )
-    
-    result = {
-      "message":completion.choices[0].message.content
-    }
+def message_content(message):
+  # json_mode replies are parsed objects, chat messages store their content as text
+  if message is None or isinstance(message, str):
+    return message
+  return json.dumps(message)
 
-  logger.info(f"Completion received: {completion.choices[0].message}")
 
-  if completion.choices[0].message.tool_calls:
-    logger.info(f"Tool calls detected.")
-    logger.info(f"Tool calls: {completion.choices[0].message.tool_calls}")
-    result["tool_calls"] = completion.choices[0].message.tool_calls
-  else:
-    logger.info(f"No tool calls detected.")
-    result["tool_calls"] = None
-
-  return result
+def call_gpt(
+    messages, sysprompt=None, json_mode=False, model="gpt-4o", tools=None, tool_choice="auto", **params
+  ):
+  # OpenAI chat completion, the other providers are in llm_providers
+  return providers["openai"](
+    messages, sysprompt=sysprompt, tools=tools, json_mode=json_mode, tool_choice=tool_choice, model=model, **params
+  )
 
 
 def call_gpt_single(
-    prompt, sysprompt=None, client=openai_client, 
-    json_mode=False, model="gpt-4o",
+    prompt, sysprompt=None, json_mode=False, model="gpt-4o",
     tools=[] # this is added for signature consistency with call_gpt
   ):
   # same as call_gpt but takes single prompt as input, no tools
-  logger.info(f"Calling GPT")
   messages = [{"role": "user", "content": prompt}]
-  
-  result = call_gpt(
-    messages=messages, sysprompt=sysprompt, client=client, json_mode=json_mode, model=model
-  )
-
-  return result
-
-
-def get_tools(sysprompt, tools_collection):
+  return call_gpt(messages=messages, sysprompt=sysprompt, json_mode=json_mode, model=model)
+
+
+def get_llm_func(model: Optional[str] = None, params: Optional[dict] = None):
+  """
+  The LLM function process_chat calls for a model ("provider:model" or a model of LLM_PROVIDER,
+  defaults to LLM_DEFAULT_MODEL) with the prompt's llm_params: the model with retries, then the
+  fallback models whose providers are configured. Built once per model and params
+  """
+  if LLM_PROVIDER == "fake":
+    global _fake_llm
+    if _fake_llm is None:
+      _fake_llm = load_fake_llm()
+    return _fake_llm
+
+  provider_name, model = parse_model(model or LLM_DEFAULT_MODEL, LLM_PROVIDER)
+  params = params or {}
+  key = f"{provider_name}:{model}" + (json.dumps(params, sort_keys=True) if params else "")
+  if key not in _llm_gateways:
+    candidates = [(provider_name, model)] + [parse_model(spec) for spec in LLM_FALLBACK_MODELS]
+    models = []
+    for candidate_provider, candidate_model in candidates:
+      name = f"{candidate_provider}:{candidate_model}"
+      if models and (name in dict(models) or not providers[candidate_provider].configured):
+        continue # fallbacks without credentials are left out
+      models.append((name, functools.partial(providers[candidate_provider], model=candidate_model, **params)))
+    _llm_gateways[key] = ResilientLLM(models, name=key)
+  return _llm_gateways[key]
+
+
+_fake_llm = None
+_llm_gateways = {} # "provider:model" and params -> ResilientLLM
+
+
+async def get_tools(sysprompt, tools_collection):
   if "toolset" in sysprompt:
     logger.info(f"Toolset found in sysprompt: {sysprompt['toolset']}")
     tools = []
     tools_names = sysprompt["toolset"]
     for tool_name in tools_names:
-      tool = tools_collection.find_one({"function.name": tool_name}, {"_id": 0})
+      tool = await tools_collection.find_one({"function.name": tool_name}, {"_id": 0})
       if not tool:
         raise ValueError(f"Tool {tool_name} not found.")      
       # Validate the tool using the ToolWithContext model
@@ -113,29 +96,37 @@ def get_tools(sysprompt, tools_collection):
       tools.append(tool_dict)
   else:
     tools = None
-  logger.info(f"Tools found in db: {tools}") 
+  logger.info(f"Tools found in db: {tool_names(tools) if tools else None}")
   return tools
 
 
-def call_llm_and_process_tools(
+@traced()
+async def call_llm_and_process_tools(
     new_messages, sysprompt, tools, call_llm_func, 
     tool_handler, tools_collection, 
     function_dictionary,
     json_mode=False,
     tool_choice="auto",
     context_arguments=None,
-    max_chained_tool_calls=10
+    max_chained_tool_calls=10,
+    llm_cache=None, # LLMResponseCache to reuse responses to identical requests, None calls the LLM every time
+    usage_ledger=None, # LLMUsageLedger recording every call, None records nothing
+    tenant_id="default" # LLM calls queue for concurrency slots per tenant
 ):
   logger.info("Calling LLM")
       
-  llm_result = call_llm_func(
+  llm_result = await call_llm(
+    call_llm_func,
+    llm_cache=llm_cache,
+    usage_ledger=usage_ledger,
+    tenant_id=tenant_id,
     messages=new_messages, 
     sysprompt=sysprompt["prompt"],
     tools=tools,
     json_mode=json_mode,
     tool_choice=tool_choice
   )
-  logger.info(f"LLM response received: {llm_result['message']}")
+  logger.info(f"LLM response received: {truncate(llm_result['message'])}")
   
   n_tries = 0
   while llm_result["tool_calls"] is not None:
@@ -157,14 +148,21 @@ def call_llm_and_process_tools(
     # iterate over tool calls and append it openai format
     for tool_call in llm_result["tool_calls"]:
       logger.info(f"Calling tool {tool_call.function.name}")
-      tool_result = tool_handler(
-        name = tool_call.function.name,
-        arguments = json.loads(tool_call.function.arguments),
-        tools_collection=tools_collection,
-        function_dictionary=function_dictionary,
-        context_arguments = context_arguments
-      )
-      logger.info(f"Tool {tool_call.function.name} returned: {tool_result}")
+      start, tool_status = time.perf_counter(), "error"
+      try:
+        with track_stage("tool_call"):
+          tool_result = await tool_handler(
+            name = tool_call.function.name,
+            arguments = json.loads(tool_call.function.arguments),
+            tools_collection=tools_collection,
+            function_dictionary=function_dictionary,
+            context_arguments = context_arguments
+          )
+        tool_status = "success"
+      finally:
+        tool_call_duration.labels(tool=tool_call.function.name, status=tool_status).observe(time.perf_counter() - start)
+      logger.info(f"Tool {tool_call.function.name} returned: {truncate(tool_result)}")
+      log_payload("Tool result", tool_result, tool=tool_call.function.name)
       new_messages.append(
         {
           "tool_call_id": tool_call.id,
@@ -176,7 +174,11 @@ def call_llm_and_process_tools(
 
     # new call with tool results
     logger.info("Calling LLM with tool results.")
-    llm_result = call_llm_func(
+    llm_result = await call_llm(
+      call_llm_func,
+      llm_cache=llm_cache,
+      usage_ledger=usage_ledger,
+      tenant_id=tenant_id,
       messages=new_messages, 
       sysprompt=sysprompt["prompt"],
       tools=tools,
@@ -188,7 +190,21 @@ def call_llm_and_process_tools(
   return result
 
 
-def process_chat(
+async def set_turn_failed(chats_collection, chat_id: str, message_id: str, cause: str):
+  # the turn's status entry is set to failed, or added when the turn failed before it was marked in_progress
+  updated = await chats_collection.update_one(
+    {"chat_id": chat_id, "statuses.message_id": message_id},
+    {"$set": {"statuses.$.status": "failed", "statuses.$.error": cause}}
+  )
+  if not updated.matched_count:
+    await chats_collection.update_one(
+      {"chat_id": chat_id},
+      {"$push": {"statuses": {"message_id": message_id, "status": "failed", "error": cause}}}
+    )
+
+
+@traced(chat_id="chat.id", message_id="message.id", tenant_id="tenant.id")
+async def process_chat(
     chat_id: str,
     message_id: str,
     new_message: str,
@@ -201,30 +217,39 @@ def process_chat(
     dry_run=False,
     json_mode=False,
     tool_choice="auto",
-    call_llm_func=call_gpt,
-    rag_func=perform_postgre_search,
+    call_llm_func=None, # defaults to get_llm_func() for llm_model, the prompt's or the tenant's llm_model
+    llm_model: Optional[str] = None, # "provider:model", e.g. a cheaper model for some turns
+    rag_func=perform_postgre_search_async,
     rag_table_name: str = None,
     persist_rag_results=False,
     context_arguments=None,
-    db: Session = Depends(get_db),
+    context_budget: Optional[int] = None, # prompt token budget, defaults to the prompt's context_token_budget
+    llm_cache=None, # response cache, defaults to the shared cache for prompts with cache_responses
+    usage_collection=None, # tenant's llm_usage collection, every LLM call of the turn is recorded there
+    db: Optional[AsyncSession] = None, # rag_func opens its own session when None
     spacy_model=spacy_model,
     function_dictionary=default_function_dictionary,
     skip_word=None, # e.g. "PASS" might mean "don't send message" depending on the prompt
-    sysprompt_suffix: Optional[str] = None # this will be added to the end of the sysprompt. Usefull for runtime modifications of the sysprompt
+    sysprompt_suffix: Optional[str] = None, # this will be added to the end of the sysprompt. Usefull for runtime modifications of the sysprompt
+    tenant_id: str = "default" # labels metrics and queues the LLM calls with the tenant's other calls
 ):
+  turn_start, turn_status = time.perf_counter(), "error"
+  stages = StageTimer()
+  agent_turns_in_progress.labels(tenant=tenant_id).inc()
   try:
 
     # Get the chat history
-    chat = chats_collection.find_one({"chat_id": chat_id})
+    chat = await chats_collection.find_one({"chat_id": chat_id})
     if not chat:
       raise ValueError(f"Chat {chat_id} not found.")
 
     # Update chat status to in_progress
     old_statuses = chat["statuses"]
     new_statuses = old_statuses + [{"message_id": message_id, "status": "in_progress"}]
-    chats_collection.update_one(
+    await chats_collection.update_one(
       {"chat_id": chat_id}, {"$set": {"statuses": new_statuses}}
     )
+    stages.mark("history_load")
 
     # Find the sysprompt
     if sysprompt_id is None:
@@ -233,21 +258,33 @@ def process_chat(
         logger.error(f"System prompt for chat {chat_id} not found.")
         raise ValueError(f"System prompt for chat {chat_id} not found.")
     
-    sysprompt = prompts_collection.find_one({"prompt_id": sysprompt_id})
+    sysprompt = await prompts_collection.find_one({"prompt_id": sysprompt_id})
     if not sysprompt:
       raise ValueError(f"Prompt {sysprompt_id} not found.")
     
     if sysprompt_suffix is not None:
       sysprompt["prompt"] = sysprompt["prompt"] + "\n\n" + sysprompt_suffix
 
+    if llm_cache is None and sysprompt.get("cache_responses"):
+      llm_cache = default_llm_cache
+
+    if call_llm_func is None:
+      tenant = await tenant_collections.load_tenant(tenant_id)
+      call_llm_func = get_llm_func(
+        llm_model or sysprompt.get("llm_model") or getattr(tenant, "llm_model", None),
+        sysprompt.get("llm_params")
+      )
+
     # check if prompt object includes "toolset"
-    tools = get_tools(sysprompt, tools_collection)
+    tools = await get_tools(sysprompt, tools_collection)
+    stages.mark("sysprompt_tools")
     
     # check if the prompt object includes documents that need to be injected to the system prompt
-    sysprompt = add_documents_to_sysprompt(sysprompt, documents_collection)
+    sysprompt = await add_documents_to_sysprompt(sysprompt, documents_collection)
+    stages.mark("document_injection")
     
     # Perform RAG
-    new_message, rag_result = add_rag_results_to_message(
+    new_message, rag_result = await add_rag_results_to_message(
       sysprompt=sysprompt, 
       new_message=new_message, 
       rag_func=rag_func, 
@@ -256,13 +293,14 @@ def process_chat(
       persist_rag_results=persist_rag_results,
       table_name=rag_table_name
     )
+    stages.mark("rag")
 
     # add new message and update collection
     old_messages = chat["messages"]
     new_messages = old_messages + [{"message_id":"q-"+message_id, "role": "user", "content": new_message, "timestamp": datetime.now()}]
     # note: we add 'q-' to the message_id to differentiate between user and assistant messages part of the same exchange
     
-    chats_collection.update_one(
+    await chats_collection.update_one(
       {"chat_id": chat_id}, {"$set": {"messages": new_messages}}
     )
 
@@ -283,8 +321,20 @@ def process_chat(
         "message": "This is a test message."
       }
     else:
-      result = call_llm_and_process_tools(
-        new_messages=new_messages, 
+      # only a window of the history that fits the token budget is sent, the full history stays stored.
+      # Messages already folded into the chat summary are replaced by it
+      summary = chat.get("summary") or {}
+      context_messages = build_context_window(
+        messages_after_summary(new_messages, summary),
+        budget=context_budget or sysprompt.get("context_token_budget") or CONTEXT_TOKEN_BUDGET,
+        sysprompt=sysprompt["prompt"],
+        tools=tools,
+        summary=summary.get("content")
+      )
+      n_context_messages = len(context_messages)
+      stages.mark("context_window")
+      result = await call_llm_and_process_tools(
+        new_messages=context_messages, 
         sysprompt=sysprompt, 
         tools=tools, 
         call_llm_func=call_llm_func, 
@@ -293,8 +343,13 @@ def process_chat(
         tool_handler=tool_handler,
         tools_collection=tools_collection,
         context_arguments=context_arguments,
-        function_dictionary=function_dictionary
+        function_dictionary=function_dictionary,
+        llm_cache=llm_cache,
+        usage_ledger=LLMUsageLedger(usage_collection, chat_id, message_id, sysprompt_id) if usage_collection is not None else None,
+        tenant_id=tenant_id
       )
+      new_messages = new_messages + context_messages[n_context_messages:] # tool calls made in this turn
+      stages.skip() # LLM and tool calls are timed where they are made
 
     if skip_word is not None: 
       # check if message is special value meaning "don't send message" was returned
@@ -306,30 +361,45 @@ def process_chat(
     new_messages = [dict(item) for item in new_messages]
     if new_messages[0]["role"] == "system":
       new_messages.pop(0) # don't save system prompt
-    new_messages = new_messages + [{"message_id": message_id, "role": "assistant", "content": result["message"], "timestamp": datetime.now()}]
-    chats_collection.update_one(
+    new_messages = new_messages + [{"message_id": message_id, "role": "assistant", "content": message_content(result["message"]), "timestamp": datetime.now()}]
+    await chats_collection.update_one(
       {"chat_id": chat_id}, 
       {"$set": {"statuses": new_statuses, "messages": new_messages}}
     )
+    stages.mark("persist")
     logger.info(f"Chat {chat_id} completed successfully.")
 
+    if not dry_run:
+      schedule_chat_summary(
+        chat_id, chats_collection, call_llm_func, usage_collection=usage_collection, tenant_id=tenant_id, llm_cache=llm_cache
+      )
+
     # send messages
     if callback_func is not None:
       logger.info(f"Sending messages for chat {chat_id}.")
       
-      session_id = chats_collection.find_one(
+      session_id = (await chats_collection.find_one(
         {"chat_id": chat_id}
-      )["context_id"]
+      ))["context_id"]
       
       callback_func(
         result["message"], 
         session_id
       )
 
-      logger.info(f"Message callback sent successfully: {result['message']}")
+      logger.info(f"Message callback sent successfully: {truncate(result['message'])}")
 
+    turn_status = "completed"
     return result
 
   except Exception as e:
-    logger.error(f"Error processing chat {chat_id}: {e}")  # TODO update status
+    logger.error(f"Error processing chat {chat_id}: {e}")
+    cause = str(e) if isinstance(e, LLMUnavailableError) else f"{type(e).__name__}: {e}"
+    try:
+      await set_turn_failed(chats_collection, chat_id, message_id, truncate(cause, 500))
+    except Exception as status_error:
+      logger.error(f"Could not set status of message {message_id} of chat {chat_id} to failed: {status_error}")
+  finally:
+    agent_turns_in_progress.labels(tenant=tenant_id).dec()
+    agent_turn_duration.labels(status=turn_status).observe(time.perf_counter() - turn_start)
 
@@ -0,0 +1,284 @@
+import json
+import asyncio
+import hashlib
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+from typing import List, Optional
+from core.config import (
+  logger, CONTEXT_TOKEN_BUDGET, CONTEXT_RECENT_TURNS, CONTEXT_SUMMARY_SHARE,
+  SUMMARY_KEEP_TURNS, SUMMARY_MIN_NEW_TURNS
+)
+from .llm_service import call_llm
+from .usage_service import LLMUsageLedger
+
+try:
+  import tiktoken
+except ImportError:
+  tiktoken = None
+
+
+MESSAGE_OVERHEAD_TOKENS = 4 # role and separators the API adds per message
+TOKEN_COUNT_CACHE_SIZE = 4096
+SUMMARY_LINE_CHARS = 200
+SUMMARY_HEADER = "Summary of the earlier conversation:"
+SUMMARY_MESSAGE_CHARS = 2000 # longer messages are cut when sent to the summarizer
+SUMMARY_MAX_WORDS = 400
+SUMMARIZER_PROMPT = (
+  "You maintain a running summary of a conversation between a user and an AI assistant. "
+  "Update the current summary with the new messages. Keep facts, decisions, names of datasets, variables and "
+  "documents, results and open questions. Leave out greetings and repetition. "
+  f"Reply with the updated summary only, at most {SUMMARY_MAX_WORDS} words."
+)
+
+
+@lru_cache(maxsize=1)
+def get_encoding():
+  # tiktoken needs its BPE files, which it downloads on first use. Without them we fall back to an estimate
+  if tiktoken is None:
+    return None
+  try:
+    return tiktoken.get_encoding("o200k_base")
+  except Exception as e:
+    logger.warning(f"Tokenizer not available, estimating token counts: {e}")
+    return None
+
+
+_token_counts = OrderedDict() # digest of a text -> its token count, the texts themselves are not kept
+
+
+def count_tokens(text: str) -> int:
+  if not text:
+    return 0
+  key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+  tokens = _token_counts.get(key)
+  if tokens is not None:
+    _token_counts.move_to_end(key)
+    return tokens
+
+  encoding = get_encoding()
+  tokens = len(text) // 4 + 1 if encoding is None else len(encoding.encode(text, disallowed_special=()))
+  _token_counts[key] = tokens
+  if len(_token_counts) > TOKEN_COUNT_CACHE_SIZE:
+    _token_counts.popitem(last=False)
+  return tokens
+
+
+def count_message_tokens(message: dict) -> int:
+  tokens = MESSAGE_OVERHEAD_TOKENS + count_tokens(message.get("content") or "")
+  if message.get("tool_calls"):
+    tokens += count_tokens(json.dumps(message["tool_calls"], default=str))
+  return tokens
+
+
+def count_messages_tokens(messages: List[dict]) -> int:
+  return sum(count_message_tokens(message) for message in messages)
+
+
+def is_tool_chatter(message: dict) -> bool:
+  # tool results and the assistant messages that only request them
+  if message.get("role") == "tool":
+    return True
+  return message.get("role") == "assistant" and bool(message.get("tool_calls")) and not message.get("content")
+
+
+def strip_tool_chatter(messages: List[dict]) -> List[dict]:
+  # older turns are sent without tool calls and results, assistant text written next to tool calls is kept
+  return [
+    {key: value for key, value in message.items() if key != "tool_calls"}
+    for message in messages if not is_tool_chatter(message)
+  ]
+
+
+def split_turns(messages: List[dict]) -> List[List[dict]]:
+  # a turn starts with a user message and holds everything up to the next one
+  turns = []
+  for message in messages:
+    if message.get("role") == "user" or not turns:
+      turns.append([])
+    turns[-1].append(message)
+  return turns
+
+
+def summarize_turns(turns: List[List[dict]], max_tokens: int) -> str:
+  """
+  Cheap extractive summary of dropped turns: the start of every user and assistant message,
+  most recent turns first to go in when the summary has to be cut
+  """
+  lines, used = [], 0
+  for turn in reversed(turns):
+    turn_lines = [
+      f"- {message['role']}: {' '.join(message['content'].split())[:SUMMARY_LINE_CHARS]}"
+      for message in turn
+      if message.get("content") and not is_tool_chatter(message)
+    ]
+    cost = count_tokens("\n".join(turn_lines))
+    if used + cost > max_tokens:
+      break
+    lines = turn_lines + lines
+    used += cost
+  return "\n".join(lines)
+
+
+def build_context_window(
+  messages: List[dict],
+  budget: int = CONTEXT_TOKEN_BUDGET,
+  sysprompt: str = "",
+  tools: Optional[list] = None,
+  recent_turns: int = CONTEXT_RECENT_TURNS,
+  summary: Optional[str] = None
+) -> List[dict]:
+  """
+  Select the chat messages to send to the LLM within a token budget
+  - the last recent_turns turns are kept verbatim (the last one always, even over budget)
+  - older turns are kept newest first without their tool calls and tool results, as long as they fit
+  - whatever doesn't fit is replaced by a summary message: the given summary (e.g. a stored summary of
+    the history before messages) followed by an extractive summary of the dropped turns
+  The system prompt and tool definitions count towards the budget but are not part of the result
+  Returns: A new list of messages, the input is not modified
+  """
+  used = count_tokens(sysprompt) + (count_tokens(json.dumps(tools, default=str)) if tools else 0)
+  turns = split_turns(messages)
+  older, recent = turns[:-recent_turns] if recent_turns else turns, turns[-recent_turns:] if recent_turns else []
+
+  recent_tokens = [count_messages_tokens(turn) for turn in recent]
+  while len(recent) > 1 and used + sum(recent_tokens) > budget:
+    older.append(recent.pop(0))
+    recent_tokens.pop(0)
+  used += sum(recent_tokens)
+
+  summary_budget = int(budget * CONTEXT_SUMMARY_SHARE) if (older or summary) else 0
+  kept_older = []
+  for turn in reversed(older):
+    stripped = strip_tool_chatter(turn)
+    cost = count_messages_tokens(stripped)
+    if used + cost > budget - summary_budget:
+      break
+    kept_older.insert(0, stripped)
+    used += cost
+  dropped = older[:len(older) - len(kept_older)]
+
+  window = []
+  if dropped or summary:
+    summary_tokens = max(min(summary_budget, budget - used), 0)
+    summary_parts = []
+    if summary:
+      summary_parts.append(summary)
+      summary_tokens -= count_tokens(summary)
+    if dropped and summary_tokens > 0:
+      summary_parts.append(summarize_turns(dropped, summary_tokens))
+    summary_text = "\n\n".join(part for part in summary_parts if part)
+    if summary_text:
+      window.append({"role": "system", "content": f"{SUMMARY_HEADER}\n{summary_text}"})
+
+  for turn in kept_older + recent:
+    window.extend(dict(message) for message in turn)
+
+  if dropped:
+    logger.info(f"Context window: dropped {len(dropped)} older turns, ~{used} tokens of {budget}")
+  return window
+
+
+def messages_after_summary(messages: List[dict], summary: Optional[dict]) -> List[dict]:
+  """
+  The messages a stored chat summary doesn't cover yet: those after the last message it folded in
+  (last_message_id). Summaries stored before the anchor existed fall back to their message count.
+  If the anchor message is gone (the history was edited) nothing is treated as covered, so no message is lost
+  """
+  if not summary:
+    return messages
+  last_message_id = summary.get("last_message_id")
+  if last_message_id is None:
+    return messages[summary.get("covered_messages", 0):]
+  for i in range(len(messages) - 1, -1, -1):
+    if messages[i].get("message_id") == last_message_id:
+      return messages[i + 1:]
+  logger.warning(f"Message {last_message_id} covered by the chat summary not found, sending the full history")
+  return messages
+
+
+def render_messages_for_summary(messages: List[dict]) -> str:
+  return "\n\n".join(
+    f"{message['role']}: {message['content'][:SUMMARY_MESSAGE_CHARS]}"
+    for message in messages
+    if message.get("content") and not is_tool_chatter(message)
+  )
+
+
+async def update_chat_summary(
+  chat_id: str,
+  chats_collection,
+  call_llm_func,
+  keep_turns: int = SUMMARY_KEEP_TURNS,
+  min_new_turns: int = SUMMARY_MIN_NEW_TURNS,
+  usage_ledger=None,
+  tenant_id: str = "default",
+  llm_cache=None
+) -> Optional[dict]:
+  """
+  Fold the turns that are older than the last keep_turns and not yet summarized into the stored chat summary.
+  Only that delta and the previous summary are sent to the LLM, through call_llm like the agent turns.
+  Each update bumps the summary version, an update racing another one for the same chat is dropped
+  Returns: The new summary, or None if there wasn't enough new history or the LLM returned no text
+  """
+  chat = await chats_collection.find_one({"chat_id": chat_id}, {"messages": 1, "summary": 1})
+  if not chat:
+    return None
+  summary = chat.get("summary") or {"version": 0, "content": "", "covered_messages": 0}
+  pending = messages_after_summary(chat["messages"], chat.get("summary"))
+  turns = split_turns(pending)
+  if len(turns) - keep_turns < min_new_turns:
+    return None
+
+  folded = [message for turn in turns[:len(turns) - keep_turns] for message in turn]
+  prompt = (
+    "Current summary:\n" + (summary["content"] or "(none)") +
+    "\n\nNew messages:\n" + render_messages_for_summary(folded)
+  )
+  result = await call_llm(
+    call_llm_func,
+    llm_cache=llm_cache,
+    usage_ledger=usage_ledger,
+    tenant_id=tenant_id,
+    messages=[{"role": "user", "content": prompt}],
+    sysprompt=SUMMARIZER_PROMPT
+  )
+  content = result.get("message")
+  if not isinstance(content, str) or not content.strip():
+    logger.warning(f"LLM returned no summary text for chat {chat_id}, keeping summary version {summary['version']}")
+    return None
+
+  new_summary = {
+    "version": summary["version"] + 1,
+    "content": content.strip(),
+    "covered_messages": len(chat["messages"]) - len(pending) + len(folded),
+    "last_message_id": next((message["message_id"] for message in reversed(folded) if message.get("message_id")), None),
+    "updated_at": datetime.now()
+  }
+  version_filter = {"summary.version": summary["version"]} if summary["version"] else {"summary": {"$exists": False}}
+  updated = await chats_collection.update_one({"chat_id": chat_id, **version_filter}, {"$set": {"summary": new_summary}})
+  if not updated.modified_count:
+    logger.info(f"Summary of chat {chat_id} was updated concurrently, dropping version {new_summary['version']}")
+    return None
+
+  logger.info(f"Summarized {len(folded)} messages of chat {chat_id} (summary version {new_summary['version']})")
+  return new_summary
+
+
+_summary_tasks = set() # keeps scheduled summaries referenced until they finish
+
+
+def schedule_chat_summary(chat_id: str, chats_collection, call_llm_func, usage_collection=None, tenant_id: str = "default", llm_cache=None):
+  # run update_chat_summary in the background, after the turn has been answered
+  async def run():
+    try:
+      usage_ledger = LLMUsageLedger(usage_collection, chat_id, purpose="summary") if usage_collection is not None else None
+      await update_chat_summary(
+        chat_id, chats_collection, call_llm_func, usage_ledger=usage_ledger, tenant_id=tenant_id, llm_cache=llm_cache
+      )
+    except Exception as e:
+      logger.error(f"Error summarizing chat {chat_id}: {e}")
+
+  task = asyncio.create_task(run())
+  _summary_tasks.add(task)
+  task.add_done_callback(_summary_tasks.discard)
@@ -1,10 +1,11 @@
 import os
 import json
 import uuid
+from typing import Optional
 from sqlalchemy.orm import Session
 from core import logger
 from core.models import Prompt
-from core.config import spacy_model, get_db
+from core.config import spacy_model, SessionLocal
 from core.utils import create_postgres_table, get_vector_table, drop_postgres_table
 from .document_service import process_document
 
@@ -12,7 +13,7 @@ from .document_service import process_document
 async def load_prompts_from_files(collections, dir = "data/prompts", drop_collection=False, drop_if_exists=True):
   for collection in collections:
     if drop_collection:
-      collection.drop()
+      await collection.drop()
     logger.info(f"Dropped prompts collection for tenant.")
   
     for file in os.listdir(dir):
@@ -31,9 +32,9 @@ async def load_prompts_from_files(collections, dir = "data/prompts", drop_collec
                 continue
               
               if drop_if_exists:
-                collection.delete_many({"prompt_id": prompt["prompt_id"]})
+                await collection.delete_many({"prompt_id": prompt["prompt_id"]})
               
-              collection.insert_one(prompt)
+              await collection.insert_one(prompt)
               logger.info(f"Loaded prompt {prompt['name']} from file {file}")
           else:
             # check if data matches Prompt class's attributes
@@ -44,9 +45,9 @@ async def load_prompts_from_files(collections, dir = "data/prompts", drop_collec
               continue
 
             if drop_if_exists:
-              collection.delete_many({"prompt_id": data["prompt_id"]})
+              await collection.delete_many({"prompt_id": data["prompt_id"]})
 
-            collection.insert_one(data)
+            await collection.insert_one(data)
             logger.info(f"Loaded prompt {data['name']} from file {file}")
   return True
 
@@ -57,15 +58,23 @@ async def load_documents_from_files(
   model=spacy_model,
 	drop_collection=False,
 	drop_if_exists=True,
-	db: Session = next(get_db())
+	db: Optional[Session] = None
 ):
+	if db is None:
+		# sync session for the table setup done here, process_document opens its own async one
+		with SessionLocal() as db:
+			return await load_documents_from_files(
+				documents_collections, dir=dir, model=model, drop_collection=drop_collection,
+				drop_if_exists=drop_if_exists, db=db
+			)
+
 	i = 0
 	for tenant_id, documents_collection in documents_collections.items():
 		i += 1
 		logger.info(f"Processing documents collection {i} of {len(documents_collections)}")
 		VectorModel = create_postgres_table(tenant_id, db.bind) # ensure table exists
 		if drop_collection:
-			documents_collection.drop()
+			await documents_collection.drop()
 			logger.info(f"Dropped documents collection {documents_collection.name}.")
 			# Drop the corresponding PostgreSQL table
 			drop_postgres_table(tenant_id, db.bind)
@@ -104,8 +113,8 @@ async def load_documents_from_files(
 			table_name = tenant_id # using tenant_id as table_name for now, later we might have separate schemas for different tenants
 
 			if drop_if_exists:
-				documents_collection.delete_many({"document_id": document_id})
-				documents_collection.delete_many({"name": name})
+				await documents_collection.delete_many({"document_id": document_id})
+				await documents_collection.delete_many({"name": name})
 				# Delete from PostgreSQL
 				VectorModel = get_vector_table(table_name, db.bind)
 				db.query(VectorModel).filter(
@@ -113,7 +122,7 @@ async def load_documents_from_files(
 				).delete(synchronize_session=False)
 				db.commit()
 
-			documents_collection.insert_one(
+			await documents_collection.insert_one(
         {
           "document_id": document_id,
           "name": name,
@@ -132,7 +141,6 @@ async def load_documents_from_files(
 				metadata=metadata,
 				spacy_model=model,
 				documents_collection=documents_collection,
-				db=db,
 				table_name=table_name,
 				chunk_size=chunk_size,
 				cleanup_file=False # don't delete this file as it's going to be used for other tenants
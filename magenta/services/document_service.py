@@ -1,20 +1,24 @@
 import os
 import uuid
-from typing import List
+import asyncio
+from contextlib import nullcontext
+from typing import List, Optional
 from sqlalchemy import select
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError
-from core.config import logger, get_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from core.config import logger, engine, AsyncSessionLocal
+from core.tracing import traced
 from core.utils import embed_text_spacy, get_vector_table, read_pdf_text, chunk_text_paragraphs, create_postgres_table
 
-def add_documents_to_sysprompt(sysprompt, documents_collection):
+async def add_documents_to_sysprompt(sysprompt, documents_collection):
   if "documents" in sysprompt and "context_documents" in sysprompt["documents"]:
     logger.info(f"Context documents found in sysprompt.")
     
     # read the full text of all documents
     context_docs = []
     for doc in sysprompt["documents"]["context_documents"]:
-      context_doc = documents_collection.find_one({"document_id": doc["document_id"]})
+      context_doc = await documents_collection.find_one({"document_id": doc["document_id"]})
       if not context_doc:
         raise ValueError(f"Document {doc['document_id']} not found.")
       context_docs.append(context_doc)
@@ -32,11 +36,11 @@ def add_documents_to_sysprompt(sysprompt, documents_collection):
   return sysprompt
 
 
-def add_rag_results_to_message(
+async def add_rag_results_to_message(
     sysprompt, 
     new_message, 
     rag_func, 
-    db: Session,
+    db,
     spacy_model,
     table_name,
     persist_rag_results=False
@@ -53,13 +57,17 @@ def add_rag_results_to_message(
       rag_connecting_prompt = ""
 
     rag_documents = [doc["document_id"] for doc in sysprompt["documents"]["rag_documents"]]
-    rag_result = rag_func(
-      new_message=new_message, 
-      rag_documents=rag_documents, 
-      db=db,
-      spacy_model=spacy_model,
-      table_name=table_name
-    )
+    rag_kwargs = {
+      "new_message": new_message, 
+      "rag_documents": rag_documents, 
+      "db": db,
+      "spacy_model": spacy_model,
+      "table_name": table_name
+    }
+    if asyncio.iscoroutinefunction(rag_func):
+      rag_result = await rag_func(**rag_kwargs)
+    else:
+      rag_result = await asyncio.to_thread(rag_func, **rag_kwargs) # sync search runs on a blocking SQLAlchemy session
     
     # Format the RAG results
     formatted_rag_result = "\n\n".join([f"Document: {r['name']}\nPotentially Relevant Text Excerpt: {r['text']}" for r in rag_result])
@@ -75,8 +83,9 @@ def add_rag_results_to_message(
 
 
 
+@traced(table_name="db.table")
 async def insert_into_postgres(
-	db: Session,
+	db: AsyncSession,
 	document_id: str,
 	name: str,
 	chunks: list,
@@ -85,7 +94,7 @@ async def insert_into_postgres(
 	table_name: str = "default"
 ):
 	logger.info(f"Inserting into PostgreSQL table {table_name}")
-	VectorModel = create_postgres_table(table_name, db.bind)
+	VectorModel = await asyncio.to_thread(create_postgres_table, table_name, engine) # DDL goes through the sync engine
    
 	inserted_count = 0
 	logger.info(f"{len(chunks)} chunks to insert")
@@ -101,20 +110,64 @@ async def insert_into_postgres(
 		)
 		try:
 			db.add(vector)
-			db.flush()  # This will assign the ID if it's auto-generated
+			await db.flush()  # This will assign the ID if it's auto-generated
 			inserted_count += 1
 		except IntegrityError:
-			db.rollback()  # Roll back the failed insertion
+			await db.rollback()  # Roll back the failed insertion
 			logger.warning(f"Duplicate vector ID {vector_id} encountered. Skipping.")
 		except Exception as e:
-			db.rollback()
+			await db.rollback()
 			logger.error(f"Error inserting vector: {str(e)}")
 	
-	db.commit()
+	await db.commit()
 	logger.info(f"Inserted {inserted_count} vectors into PostgreSQL table {table_name}")
 	return inserted_count
 
 
+def build_postgre_search_statement(
+    VectorModel,
+    query_vector,
+    rag_documents: List[str],
+    top_n: int,
+    similarity_threshold: float
+):
+  stmt = (
+    select(
+        VectorModel.id,
+        VectorModel.name,
+        VectorModel.document_id,
+        VectorModel.text,
+        VectorModel.embedding.cosine_distance(query_vector).label("distance")
+      )
+  )
+
+  if len(rag_documents):
+    stmt = stmt.filter(VectorModel.name.in_(rag_documents))
+
+  stmt = stmt.filter(VectorModel.embedding.cosine_distance(query_vector) <= (1-similarity_threshold))
+
+  stmt = stmt.order_by(VectorModel.embedding.cosine_distance(query_vector))
+
+  stmt = stmt.limit(top_n)
+  return stmt
+
+
+def format_postgre_search_results(results):
+  search_results = [
+    {
+      "id": result.id,
+      "name": result.name,
+      "document_id": result.document_id,
+      "text": result.text,
+      "similarity": 1-result.distance
+    }
+    for result in results
+  ]
+  logger.info(f"Found {len(search_results)} relevant chunks from {len(set(r['name'] for r in search_results))} documents.")
+  return search_results
+
+
+@traced(table_name="db.table")
 def perform_postgre_search(
     new_message: str,
     rag_documents: List[str],
@@ -133,44 +186,47 @@ def perform_postgre_search(
     logger.info(f"Searching PostgreSQL table {table_name}.")
     VectorModel = get_vector_table(table_name, db.bind)
 
-    # Construct the query
-    stmt = (
-      select(
-          VectorModel.id,
-          VectorModel.name,
-          VectorModel.document_id,
-          VectorModel.text,
-          VectorModel.embedding.cosine_distance(query_vector).label("distance")
-        )
-    )
+    # Construct and execute the query
+    stmt = build_postgre_search_statement(VectorModel, query_vector, rag_documents, top_n, similarity_threshold)
+    results = db.execute(stmt).all()
 
-    if len(rag_documents):
-      stmt = stmt.filter(VectorModel.name.in_(rag_documents))
+    return format_postgre_search_results(results)
 
-    stmt = stmt.filter(VectorModel.embedding.cosine_distance(query_vector) <= (1-similarity_threshold))
+  except Exception as e:
+    logger.error(f"Error performing PostgreSQL search: {str(e)}")
+    raise
 
-    stmt = stmt.order_by(VectorModel.embedding.cosine_distance(query_vector))
 
-    stmt = stmt.limit(top_n)
+@traced(table_name="db.table")
+async def perform_postgre_search_async(
+    new_message: str,
+    rag_documents: List[str],
+    db: Optional[AsyncSession] = None,
+    spacy_model=None,
+    table_name: str = "default",
+    top_n: int = 5,
+    similarity_threshold: float = 0.7
+):
+  # same as perform_postgre_search; opens its own session when none is passed so concurrent tasks never share one
+  if db is None:
+    async with AsyncSessionLocal() as db:
+      return await perform_postgre_search_async(
+        new_message=new_message, rag_documents=rag_documents, db=db, spacy_model=spacy_model,
+        table_name=table_name, top_n=top_n, similarity_threshold=similarity_threshold
+      )
 
-    # Execute the query
-    results = db.execute(stmt).all()
+  try:
+    # Embed the query text
+    query_vector = embed_text_spacy(new_message, spacy_model)
+    logger.info(f"Embedded query text.")
 
-    # Format the results
-    search_results = [
-      {
-        "id": result.id,
-				"name": result.name,
-				"document_id": result.document_id,
-				"text": result.text,
-				"similarity": 1-result.distance
-      }
-      for result in results
-    ]
+    logger.info(f"Searching PostgreSQL table {table_name}.")
+    VectorModel = get_vector_table(table_name, None)
 
-    logger.info(f"Found {len(search_results)} relevant chunks from {len(set(r['name'] for r in search_results))} documents.")
+    stmt = build_postgre_search_statement(VectorModel, query_vector, rag_documents, top_n, similarity_threshold)
+    results = (await db.execute(stmt)).all()
 
-    return search_results
+    return format_postgre_search_results(results)
 
   except Exception as e:
     logger.error(f"Error performing PostgreSQL search: {str(e)}")
@@ -186,7 +242,7 @@ async def process_document(
 	metadata: dict,
 	spacy_model,
 	documents_collection,
-	db: Session = next(get_db()),
+	db: Optional[AsyncSession] = None, # a new session is opened for this task when not provided
 	table_name: str = "default",
 	chunk_size: int = 1000,
   cleanup_file: bool = True
@@ -195,7 +251,7 @@ async def process_document(
 		# Check file type
 		if content_type == "application/pdf":
 			# Read the text from the pdf
-			text = read_pdf_text(file_location)
+			text = await asyncio.to_thread(read_pdf_text, file_location)
 		else:
 			raise ValueError("Unsupported file type.")
 
@@ -210,7 +266,7 @@ async def process_document(
 		logger.info(f"Document {name} embedded into {len(embeddings)} parts, each of dimension {len(embeddings[0])}")
 
 		# Insert each part into the database
-		documents_collection.update_one(
+		await documents_collection.update_one(
 			{"document_id": document_id},
 			{"$set": {
 				"text": text,
@@ -220,17 +276,19 @@ async def process_document(
 			}}
 		)
 		
-		inserted_count = await insert_into_postgres(
-			db=db,
-			document_id=document_id,
-			name=name,
-			chunks=chunks,
-			embeddings=embeddings,
-			metadata=metadata,
-			table_name=table_name
-		)
+		session_context = AsyncSessionLocal() if db is None else nullcontext(db)
+		async with session_context as task_db:
+			inserted_count = await insert_into_postgres(
+				db=task_db,
+				document_id=document_id,
+				name=name,
+				chunks=chunks,
+				embeddings=embeddings,
+				metadata=metadata,
+				table_name=table_name
+			)
 		
-		documents_collection.update_one(
+		await documents_collection.update_one(
 			{"document_id": document_id},
 			{"$set": {
 				"status": "completed",
@@ -240,7 +298,7 @@ async def process_document(
 
 	except Exception as e:
 		logger.error(f"Error processing document {document_id}: {e}")
-		documents_collection.update_one(
+		await documents_collection.update_one(
 			{"document_id": document_id},
 			{"$set": {"status": "failed", "error": str(e)}}
 		) 
@@ -0,0 +1,217 @@
+"""
+Scripted stand-in for the LLM, to load test and benchmark the full agent loop without calling OpenAI
+
+In process, a FakeLLM instance is used as call_llm_func (or set LLM_PROVIDER=fake to make it the default).
+As a server it speaks the OpenAI chat completions API, so call_gpt itself can be exercised:
+
+  python -m services.fake_llm --port 8900 --config fake_llm.json
+  OPENAI_BASE_URL=http://localhost:8900/v1 OPENAI_API_KEY=fake uvicorn main:app
+
+Only loguru and openai are imported, the server runs without the databases and API keys of the app
+"""
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+import hashlib
+import argparse
+from typing import List, Optional
+from loguru import logger
+from openai.types.chat import ChatCompletionMessageToolCall
+
+
+# what a notebook agent does for a message: run some code, tell the user about it, then finish the turn.
+# Every step is either tool calls or a final message, steps whose tools are not offered are skipped
+DEFAULT_SCRIPT = [
+  {"tool_calls": [{"name": "run_code", "arguments": {"code": "summary(cars)", "language": "R"}}]},
+  {"tool_calls": [{"name": "send_user_message", "arguments": {"message": "I ran a summary of the data, see the output above."}}]},
+  {"message": "Done."}
+]
+DEFAULT_LATENCY = {"distribution": "lognormal", "median": 0.8, "sigma": 0.5} # seconds, roughly a short gpt-4o reply
+
+
+def sample_latency(latency: Optional[dict], rng: random.Random) -> float:
+  """
+  Draw a delay in seconds from a latency spec:
+  {"distribution": "constant", "value": s} | "uniform" (min, max) | "normal" (mean, sd)
+  | "lognormal" (median, sigma) | "exponential" (mean), optionally capped with "max"
+  """
+  if not latency:
+    return 0.0
+  distribution = latency.get("distribution", "constant")
+  if distribution == "constant":
+    delay = latency.get("value", 0.0)
+  elif distribution == "uniform":
+    delay = rng.uniform(latency.get("min", 0.0), latency["max"])
+  elif distribution == "normal":
+    delay = rng.gauss(latency["mean"], latency.get("sd", 0.0))
+  elif distribution == "lognormal":
+    delay = latency["median"] * rng.lognormvariate(0, latency.get("sigma", 0.5))
+  elif distribution == "exponential":
+    delay = rng.expovariate(1 / latency["mean"])
+  else:
+    raise ValueError(f"Unknown latency distribution {distribution}")
+  return max(min(delay, latency.get("max", float("inf"))), 0.0)
+
+
+class FakeLLM:
+  """
+  Deterministic LLM with the signature and result format of call_gpt.
+  The step of the script to play is the number of tool-call rounds since the last user message,
+  so the same conversation always gets the same answer, also with concurrent chats.
+  Latencies are drawn from a random generator seeded by the request, they are reproducible too
+  """
+  def __init__(
+    self,
+    script: Optional[List[dict]] = None,
+    latency: Optional[dict] = None,
+    seed: int = 0,
+    model: str = "fake-llm"
+  ):
+    self.script = DEFAULT_SCRIPT if script is None else script
+    self.latency = latency
+    self.seed = seed
+    self.model = model
+    self.calls = 0
+
+  @classmethod
+  def from_file(cls, path: str) -> "FakeLLM":
+    # {"script": [...], "latency": {...}, "seed": 0}
+    with open(path) as f:
+      return cls(**json.load(f))
+
+  def select_step(self, messages: List[dict], tools: Optional[list]) -> dict:
+    last_user = max((i for i, message in enumerate(messages) if message.get("role") == "user"), default=-1)
+    rounds = sum(1 for message in messages[last_user + 1:] if message.get("role") == "assistant" and message.get("tool_calls"))
+    offered = {tool["function"]["name"] for tool in tools or []}
+    playable = [
+      step for step in self.script
+      if "tool_calls" not in step or all(tool_call["name"] in offered for tool_call in step["tool_calls"])
+    ]
+    if rounds < len(playable):
+      return playable[rounds]
+    return {"message": "Done."} # the script ran out, always end the turn
+
+  def __call__(
+    self,
+    messages,
+    sysprompt=None,
+    json_mode=False,
+    model=None,
+    tools=None,
+    tool_choice="auto",
+    **kwargs
+  ) -> dict:
+    self.calls += 1
+    step = self.select_step(messages, tools if tool_choice != "none" else None)
+
+    request_hash = hashlib.sha256(json.dumps([self.seed, sysprompt, messages], sort_keys=True, default=str).encode()).hexdigest()
+    rng = random.Random(request_hash)
+    time.sleep(sample_latency(self.latency, rng))
+
+    if "tool_calls" in step:
+      tool_calls = [
+        ChatCompletionMessageToolCall(
+          id=f"call_{request_hash[:8]}_{i}",
+          type="function",
+          function={"name": tool_call["name"], "arguments": json.dumps(tool_call.get("arguments", {}))}
+        )
+        for i, tool_call in enumerate(step["tool_calls"])
+      ]
+      return {"message": None, "tool_calls": tool_calls, "model": self.model, "usage": self.estimate_usage(messages, step)}
+
+    message = step["message"]
+    if json_mode:
+      message = message if isinstance(message, dict) else {"message": message}
+    return {"message": message, "tool_calls": None, "model": self.model, "usage": self.estimate_usage(messages, step)}
+
+  @staticmethod
+  def estimate_usage(messages: List[dict], step: dict) -> dict:
+    return {
+      "prompt_tokens": estimate_tokens(json.dumps(messages, default=str)),
+      "completion_tokens": estimate_tokens(json.dumps(step))
+    }
+
+
+def load_fake_llm() -> FakeLLM:
+  # FAKE_LLM_CONFIG points at a JSON file with script, latency and seed, without it the default script runs without delay
+  path = os.getenv("FAKE_LLM_CONFIG")
+  if path:
+    logger.info(f"Using fake LLM from {path}")
+    return FakeLLM.from_file(path)
+  return FakeLLM()
+
+
+def estimate_tokens(text: str) -> int:
+  return len(text) // 4 + 1
+
+
+def create_fake_openai_app(fake_llm: FakeLLM):
+  """
+  FastAPI app serving POST /v1/chat/completions (non-streaming) and GET /v1/models from fake_llm
+  """
+  from fastapi import FastAPI, Request
+
+  app = FastAPI(title="Fake LLM")
+
+  @app.get("/v1/models")
+  async def list_models():
+    return {"object": "list", "data": [{"id": fake_llm.model, "object": "model", "owned_by": "fake"}]}
+
+  @app.post("/v1/chat/completions")
+  async def chat_completions(request: Request):
+    body = await request.json()
+    messages = body["messages"]
+    sysprompt = None
+    if messages and messages[0].get("role") == "system":
+      sysprompt, messages = messages[0]["content"], messages[1:]
+    json_mode = (body.get("response_format") or {}).get("type") == "json_object"
+
+    result = await asyncio.to_thread(
+      fake_llm,
+      messages=messages,
+      sysprompt=sysprompt,
+      json_mode=json_mode,
+      tools=body.get("tools"),
+      tool_choice=body.get("tool_choice", "auto")
+    )
+
+    content = json.dumps(result["message"]) if json_mode else result["message"]
+    message = {"role": "assistant", "content": content}
+    if result["tool_calls"]:
+      message["tool_calls"] = [tool_call.model_dump() for tool_call in result["tool_calls"]]
+    prompt_tokens = estimate_tokens(json.dumps(body["messages"], default=str))
+    completion_tokens = estimate_tokens(json.dumps(message))
+    return {
+      "id": f"chatcmpl-{uuid.uuid4().hex}",
+      "object": "chat.completion",
+      "created": int(time.time()),
+      "model": body.get("model", fake_llm.model),
+      "choices": [{
+        "index": 0,
+        "message": message,
+        "finish_reason": "tool_calls" if result["tool_calls"] else "stop"
+      }],
+      "usage": {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+      }
+    }
+
+  return app
+
+
+if __name__ == "__main__":
+  import uvicorn
+
+  parser = argparse.ArgumentParser(description="OpenAI compatible fake LLM server")
+  parser.add_argument("--host", default="0.0.0.0")
+  parser.add_argument("--port", type=int, default=8900)
+  parser.add_argument("--config", default=os.getenv("FAKE_LLM_CONFIG"), help="JSON file with script, latency and seed")
+  args = parser.parse_args()
+
+  fake_llm = FakeLLM.from_file(args.config) if args.config else FakeLLM(latency=DEFAULT_LATENCY)
+  uvicorn.run(create_fake_openai_app(fake_llm), host=args.host, port=args.port)
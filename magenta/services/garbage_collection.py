@@ -0,0 +1,85 @@
+from typing import Iterable, Optional
+from sqlalchemy import text
+from core.config import logger, AsyncSessionLocal
+
+
+# vector tables are named after their tenant and have exactly these columns (core.utils.get_vector_table)
+VECTOR_TABLE_COLUMNS = ("id", "name", "document_id", "text", "embedding", "created_at")
+
+
+async def collect_orphaned_vectors(
+  tenant_id: str,
+  documents_collection,
+  dry_run: bool = False,
+  batch_size: int = 100,
+  after: Optional[str] = None
+) -> dict:
+  """
+  Delete the vector rows of a tenant whose document no longer exists in Mongo, one page at a time:
+  the next batch_size document ids in order (after the given one) are checked against Mongo
+  and their orphaned rows deleted in one transaction
+  Returns: {"count": rows, "bytes": approximate row bytes, "documents": orphaned document ids,
+  "after": document id to resume after, None when the table is done}
+  """
+  report = {"count": 0, "bytes": 0, "documents": [], "after": None}
+  async with AsyncSessionLocal() as db:
+    if (await db.execute(text("SELECT to_regclass(:table)"), {"table": f'"{tenant_id}"'})).scalar() is None:
+      return report
+
+    document_ids = (await db.execute(
+      text(f'SELECT DISTINCT document_id FROM "{tenant_id}" WHERE document_id > :after ORDER BY document_id LIMIT :batch_size'),
+      {"after": after or "", "batch_size": batch_size}
+    )).scalars().all()
+    if len(document_ids) == batch_size:
+      report["after"] = document_ids[-1]
+
+    known = set(await documents_collection.distinct("document_id", {"document_id": {"$in": document_ids}}))
+    orphaned = [document_id for document_id in document_ids if document_id not in known]
+    if orphaned:
+      count, size = (await db.execute(
+        text(f'SELECT count(*), coalesce(sum(pg_column_size(t.*)), 0) FROM "{tenant_id}" t WHERE document_id = ANY(:ids)'),
+        {"ids": orphaned}
+      )).one()
+      if not dry_run:
+        await db.execute(text(f'DELETE FROM "{tenant_id}" WHERE document_id = ANY(:ids)'), {"ids": orphaned})
+        await db.commit()
+      report.update(count=count, bytes=int(size), documents=orphaned)
+      logger.info(f"{'Found' if dry_run else 'Deleted'} {count} orphaned vector rows for tenant {tenant_id}")
+  return report
+
+
+async def drop_orphaned_vector_tables(known_tenant_ids: Iterable[str], tables: Optional[Iterable[str]] = None, dry_run: bool = True) -> dict:
+  """
+  Report the vector tables of tenants that no longer exist (remove_tenant only drops the Mongo collections).
+  Not part of the scheduled collection: known_tenant_ids must be read from the tenants collection right
+  before, and without dry_run only the listed tables (from an earlier report) are dropped
+  Returns: {"count": tables, "bytes": table + index bytes, "tables": table names}
+  """
+  known_tenant_ids = set(known_tenant_ids)
+  if not dry_run and tables is None:
+    raise ValueError("The tables to drop must be listed")
+  report = {"count": 0, "bytes": 0, "tables": []}
+  async with AsyncSessionLocal() as db:
+    candidates = (await db.execute(
+      text("""
+        SELECT table_name FROM information_schema.columns
+        WHERE table_schema = 'public'
+        GROUP BY table_name
+        HAVING count(*) = :n_columns AND count(*) FILTER (WHERE column_name = ANY(:columns)) = :n_columns
+      """),
+      {"columns": list(VECTOR_TABLE_COLUMNS), "n_columns": len(VECTOR_TABLE_COLUMNS)}
+    )).scalars().all()
+
+    for table_name in candidates:
+      if table_name in known_tenant_ids or (tables is not None and table_name not in tables):
+        continue
+      size = (await db.execute(text("SELECT pg_total_relation_size(:table)"), {"table": f'"{table_name}"'})).scalar()
+      if not dry_run:
+        await db.execute(text(f'DROP TABLE IF EXISTS "{table_name}"'))
+        await db.commit()
+      report["count"] += 1
+      report["bytes"] += int(size or 0)
+      report["tables"].append(table_name)
+      logger.info(f"{'Found' if dry_run else 'Dropped'} vector table {table_name} of a removed tenant")
+
+  return report
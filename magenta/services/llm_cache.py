@@ -0,0 +1,91 @@
+import json
+import hashlib
+import inspect
+from datetime import datetime
+from collections import OrderedDict
+from typing import Optional
+from pymongo.errors import DuplicateKeyError
+from openai.types.chat import ChatCompletionMessageToolCall
+from core.config import logger, system_db, LLM_CACHE_LRU_SIZE
+
+
+def get_llm_model(call_llm_func) -> Optional[str]:
+  # the model a call_llm_func uses by default, part of the cache key
+  parameter = inspect.signature(call_llm_func).parameters.get("model")
+  return parameter.default if parameter is not None and parameter.default is not inspect.Parameter.empty else None
+
+
+class LLMResponseCache:
+  """
+  Cache of LLM results keyed by a hash of the canonical request (function, model, system prompt,
+  messages, tools, options). Lookups go to an in-process LRU first, then to a Mongo collection
+  whose TTL index expires old entries. collection=None keeps the cache in process only
+  """
+  def __init__(self, collection=None, lru_size: int = LLM_CACHE_LRU_SIZE):
+    self.collection = collection
+    self.lru_size = lru_size
+    self.lru = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def make_key(self, call_llm_func, messages, sysprompt=None, tools=None, **options) -> str:
+    # ids and timestamps don't change what the model sees, leave them out like call_gpt does
+    request = {
+      "llm": getattr(call_llm_func, "llm_name", None) or f"{call_llm_func.__module__}.{getattr(call_llm_func, '__qualname__', type(call_llm_func).__qualname__)}",
+      "model": options.pop("model", None) or get_llm_model(call_llm_func),
+      "sysprompt": sysprompt,
+      "messages": [{k: v for k, v in message.items() if k not in ("message_id", "timestamp")} for message in messages],
+      "tools": [{k: v for k, v in tool.items() if k != "tool_id"} for tool in tools or []],
+      "options": options
+    }
+    canonical = json.dumps(request, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+  def _remember(self, key: str, result: dict):
+    self.lru[key] = result
+    self.lru.move_to_end(key)
+    while len(self.lru) > self.lru_size:
+      self.lru.popitem(last=False)
+
+  @staticmethod
+  def _serialize(result: dict) -> dict:
+    tool_calls = result.get("tool_calls")
+    return {**result, "tool_calls": [tool_call.model_dump() for tool_call in tool_calls] if tool_calls else None}
+
+  @staticmethod
+  def _deserialize(result: dict) -> dict:
+    tool_calls = result.get("tool_calls")
+    return {
+      **result,
+      "tool_calls": [ChatCompletionMessageToolCall.model_validate(tool_call) for tool_call in tool_calls] if tool_calls else None
+    }
+
+  async def get(self, key: str) -> Optional[dict]:
+    if key in self.lru:
+      self.lru.move_to_end(key)
+      self.hits += 1
+      return self._deserialize(self.lru[key])
+
+    if self.collection is not None:
+      entry = await self.collection.find_one({"key": key}, {"_id": 0, "result": 1})
+      if entry:
+        self._remember(key, entry["result"])
+        self.hits += 1
+        return self._deserialize(entry["result"])
+
+    self.misses += 1
+    return None
+
+  async def set(self, key: str, result: dict):
+    serialized = self._serialize(result)
+    self._remember(key, serialized)
+    if self.collection is not None:
+      try:
+        await self.collection.insert_one({"key": key, "result": serialized, "created_at": datetime.utcnow()})
+      except DuplicateKeyError:
+        pass # cached concurrently
+      except Exception as e:
+        logger.warning(f"Could not store LLM response in cache: {e}")
+
+
+llm_cache = LLMResponseCache(system_db["llm_cache"])
@@ -0,0 +1,227 @@
+import time
+import random
+import asyncio
+import threading
+from typing import Awaitable, Callable, List, Optional, Tuple
+import openai
+from core.config import (
+  logger, LLM_MAX_RETRIES, LLM_RETRY_BASE_DELAY, LLM_RETRY_MAX_DELAY,
+  LLM_CIRCUIT_FAILURES, LLM_CIRCUIT_RESET_SECONDS
+)
+from core.metrics import llm_retries, llm_fallbacks, llm_circuit_open
+
+try:
+  import anthropic
+except ImportError:
+  anthropic = None
+
+
+# the provider SDKs raise errors of the same shape
+TIMEOUT_ERRORS = (openai.APITimeoutError,) + ((anthropic.APITimeoutError,) if anthropic else ())
+CONNECTION_ERRORS = (openai.APIConnectionError,) + ((anthropic.APIConnectionError,) if anthropic else ())
+STATUS_ERRORS = (openai.APIStatusError,) + ((anthropic.APIStatusError,) if anthropic else ())
+
+
+class LLMUnavailableError(Exception):
+  """
+  Every model of a ResilientLLM failed or had its circuit open. The message lists the cause per model
+  """
+
+
+class LLMConfigurationError(ValueError):
+  """
+  The model can't be called as configured (no API key, SDK not installed), the gateway moves on to the next one
+  """
+
+
+class CircuitBreaker:
+  """
+  Opens after `failures` consecutive failures, calls are then skipped until reset_timeout has passed
+  and a single probe call is let through: it closes the circuit again or reopens it
+  """
+  def __init__(self, name: str, failures: int = LLM_CIRCUIT_FAILURES, reset_timeout: float = LLM_CIRCUIT_RESET_SECONDS):
+    self.name = name
+    self.failures = failures
+    self.reset_timeout = reset_timeout
+    self.consecutive_failures = 0
+    self.opened_at = None
+    self.probing = False
+    self.lock = threading.Lock() # LLM functions run in worker threads
+
+  @property
+  def state(self) -> str:
+    if self.opened_at is None:
+      return "closed"
+    return "half_open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+  def allow(self) -> Optional[str]:
+    # "closed", "probe" for the single call let through after reset_timeout, or None
+    with self.lock:
+      state = self.state
+      if state == "closed":
+        return "closed"
+      if state == "half_open" and not self.probing:
+        self.probing = True
+        return "probe"
+      return None
+
+  def end_probe(self):
+    # the probe ended without a verdict (a rejected request, a cancellation): the next call probes again
+    with self.lock:
+      self.probing = False
+
+  def record_success(self):
+    with self.lock:
+      self.consecutive_failures = 0
+      self.opened_at = None
+      self.probing = False
+    llm_circuit_open.labels(model=self.name).set(0)
+
+  def record_failure(self):
+    with self.lock:
+      self.consecutive_failures += 1
+      if self.probing or self.consecutive_failures >= self.failures:
+        if self.opened_at is None or self.probing:
+          logger.warning(f"Circuit of LLM model {self.name} opened after {self.consecutive_failures} failures")
+        self.opened_at = time.monotonic()
+        self.probing = False
+    if self.opened_at is not None:
+      llm_circuit_open.labels(model=self.name).set(1)
+
+
+_circuit_breakers = {} # model name -> CircuitBreaker, shared by all gateways of the process
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+  with _circuit_breakers_lock:
+    if name not in _circuit_breakers:
+      _circuit_breakers[name] = CircuitBreaker(name)
+    return _circuit_breakers[name]
+
+
+RETRY, NEXT_MODEL, RAISE = "retry", "next_model", "raise"
+
+
+def classify_error(e: Exception) -> Tuple[str, Optional[float], str]:
+  """
+  Returns: (RETRY, NEXT_MODEL or RAISE, seconds the provider asked to wait or None, short cause)
+  Rate limits, timeouts, connection errors and 5xx are transient and retried. Auth, not found (a retired
+  model) and configuration errors are the model's problem, the next model is tried. Other 4xx mean the
+  request itself is bad, no model will take it
+  """
+  if isinstance(e, TIMEOUT_ERRORS):
+    return RETRY, None, "timeout"
+  if isinstance(e, CONNECTION_ERRORS):
+    return RETRY, None, "connection error"
+  if isinstance(e, LLMConfigurationError):
+    return NEXT_MODEL, None, f"not configured ({e})"
+  if isinstance(e, STATUS_ERRORS):
+    status = e.status_code
+    retry_after = None
+    headers = e.response.headers if e.response is not None else {}
+    try:
+      if headers.get("retry-after-ms"):
+        retry_after = float(headers["retry-after-ms"]) / 1000
+      elif headers.get("retry-after"):
+        retry_after = float(headers["retry-after"])
+    except ValueError:
+      pass # an HTTP date, use the backoff instead
+    if status == 429:
+      return RETRY, retry_after, "rate limited (429)"
+    if status in (408, 409) or status >= 500:
+      return RETRY, retry_after, f"server error ({status})"
+    if status in (401, 403, 404):
+      return NEXT_MODEL, None, f"model unavailable ({status})"
+    return RAISE, None, f"request rejected ({status})"
+  if isinstance(e, (TimeoutError, ConnectionError)):
+    return RETRY, None, type(e).__name__
+  return RAISE, None, f"{type(e).__name__}: {e}"
+
+
+def backoff_delay(attempt: int, base_delay: float = LLM_RETRY_BASE_DELAY, max_delay: float = LLM_RETRY_MAX_DELAY) -> float:
+  # exponential backoff with full jitter, attempt counts from 0
+  return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+async def run_in_thread(llm_func: Callable, request: dict) -> dict:
+  return await asyncio.to_thread(llm_func, **request)
+
+
+class ResilientLLM:
+  """
+  LLM function (same signature and result as the providers) that calls a list of models in order:
+  each one is retried on transient errors with jittered exponential backoff, honoring Retry-After,
+  and skipped while its circuit is open. acall runs each attempt through `run` (call_llm holds an
+  LLM slot only for the attempt), so the backoff waits on the event loop and not in a worker thread
+  """
+  def __init__(
+    self,
+    models: List[Tuple[str, Callable]], # (name, LLM function), primary first
+    name: Optional[str] = None, # identifies the gateway in cache keys, defaults to the primary's name
+    max_retries: int = LLM_MAX_RETRIES,
+    base_delay: float = LLM_RETRY_BASE_DELAY,
+    max_delay: float = LLM_RETRY_MAX_DELAY,
+    sleep: Callable[[float], Awaitable] = asyncio.sleep
+  ):
+    self.models = models
+    self.max_retries = max_retries
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.sleep = sleep
+    self.llm_name = name or models[0][0] # responses are cached per gateway (see LLMResponseCache.make_key)
+
+  def __call__(self, **request) -> dict:
+    # blocking call, from a worker thread or a script without a running event loop
+    try:
+      asyncio.get_running_loop()
+    except RuntimeError:
+      async def run_here(llm_func, request):
+        return llm_func(**request)
+      return asyncio.run(self.acall(run_here, **request))
+    raise RuntimeError("ResilientLLM called from a running event loop, await acall() instead")
+
+  async def acall(self, run: Callable[[Callable, dict], Awaitable[dict]] = run_in_thread, **request) -> dict:
+    causes = []
+    for position, (name, llm_func) in enumerate(self.models):
+      breaker = get_circuit_breaker(name)
+      admitted = breaker.allow()
+      if not admitted:
+        causes.append(f"{name}: circuit open")
+        continue
+
+      try:
+        for attempt in range(self.max_retries + 1):
+          try:
+            result = await run(llm_func, request)
+          except Exception as e:
+            action, retry_after, cause = classify_error(e)
+            if action == RAISE:
+              raise # the request is the problem, another attempt or model won't help
+            breaker.record_failure()
+            if action == NEXT_MODEL:
+              causes.append(f"{name}: {cause}")
+              logger.warning(f"LLM model {name} can't be used ({cause}), trying the next model")
+              break
+            if attempt == self.max_retries or breaker.state != "closed":
+              causes.append(f"{name}: {cause} after {attempt + 1} attempts")
+              break
+            delay = max(retry_after or 0, backoff_delay(attempt, self.base_delay, self.max_delay))
+            if delay > self.max_delay:
+              causes.append(f"{name}: {cause}, asked to retry after {delay:.0f} s")
+              break
+            llm_retries.labels(model=name, cause=cause).inc()
+            logger.warning(f"LLM call to {name} failed ({cause}), retry {attempt + 1} in {delay:.1f} s")
+            await self.sleep(delay)
+            continue
+
+          breaker.record_success()
+          if position:
+            llm_fallbacks.labels(model=name).inc()
+            logger.warning(f"LLM call answered by fallback model {name} ({'; '.join(causes)})")
+          return result
+      finally:
+        if admitted == "probe":
+          breaker.end_probe() # no-op after record_success or record_failure
+
+    raise LLMUnavailableError("LLM unavailable: " + "; ".join(causes))
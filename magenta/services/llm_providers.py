@@ -0,0 +1,219 @@
+import json
+import threading
+from abc import ABC, abstractmethod
+from typing import List, Optional, Tuple
+from openai import OpenAI
+from openai.types.chat import ChatCompletionMessageToolCall
+from core.config import (
+  OPENAI_API_KEY, ANTHROPIC_API_KEY, LOCAL_LLM_BASE_URL, LOCAL_LLM_API_KEY, LOCAL_LLM_MODEL,
+  LLM_REQUEST_TIMEOUT_SECONDS
+)
+from .llm_gateway import LLMConfigurationError
+
+try:
+  import anthropic
+except ImportError:
+  anthropic = None
+
+
+ANTHROPIC_MAX_TOKENS = 4096 # the messages API requires a limit, llm_params can set max_tokens
+JSON_MODE_INSTRUCTION = "Reply with a single JSON object and nothing else."
+
+
+class LLMProvider(ABC):
+  """
+  An LLM API behind the LLM function contract of process_chat:
+  provider(messages, sysprompt, tools, json_mode, tool_choice, model, **params) returns
+  {"message", "tool_calls" (ChatCompletionMessageToolCall list or None), "model", "usage"},
+  in json_mode the message is the parsed object.
+  Messages and tools are in OpenAI format. Clients are created on first use,
+  so a provider without credentials only fails when it is called
+  """
+  def __init__(self, name: str, default_model: Optional[str]):
+    self.name = name
+    self.default_model = default_model
+    self._client = None
+    self._client_lock = threading.Lock()
+
+  @property
+  def configured(self) -> bool:
+    return True
+
+  @property
+  def client(self):
+    with self._client_lock:
+      if self._client is None:
+        if not self.configured:
+          raise LLMConfigurationError(f"LLM provider {self.name} is not configured")
+        self._client = self.create_client()
+      return self._client
+
+  @abstractmethod
+  def create_client(self):
+    ...
+
+  @abstractmethod
+  def __call__(self, messages, sysprompt=None, tools=None, json_mode=False, tool_choice="auto", model=None, **params) -> dict:
+    ...
+
+
+class OpenAIProvider(LLMProvider):
+  # the OpenAI API, or an OpenAI-compatible server (llama.cpp, vLLM) with base_url
+  def __init__(self, name: str, api_key: Optional[str], default_model: Optional[str], base_url: Optional[str] = None):
+    super().__init__(name, default_model)
+    self.api_key = api_key
+    self.base_url = base_url
+
+  @property
+  def configured(self) -> bool:
+    return bool(self.api_key) and (self.name == "openai" or bool(self.base_url))
+
+  def create_client(self):
+    # retries are done by the LLM gateway (services/llm_gateway.py), not by the client
+    return OpenAI(api_key=self.api_key, base_url=self.base_url, timeout=LLM_REQUEST_TIMEOUT_SECONDS, max_retries=0)
+
+  def __call__(self, messages, sysprompt=None, tools=None, json_mode=False, tool_choice="auto", model=None, **params) -> dict:
+    if sysprompt is not None:
+      # add {role: "system", content: sysprompt} to the beginning of the messages list (without modifying the caller's list)
+      messages = [{"role": "system", "content": sysprompt}] + messages
+    # make sure messages don't include message_id and timestamp
+    messages = [{k: v for k, v in d.items() if k != "message_id" and k != "timestamp"} for d in messages]
+
+    request = {"model": model or self.default_model, "messages": messages, **params}
+    if tools:
+      # remove tool_id from each tool
+      request["tools"] = [{k: v for k, v in d.items() if k != "tool_id"} for d in tools]
+      request["tool_choice"] = tool_choice
+    if json_mode:
+      request["response_format"] = {"type": "json_object"}
+
+    completion = self.client.chat.completions.create(**request)
+    message = completion.choices[0].message
+    return {
+      "message": json.loads(message.content) if json_mode and message.content else message.content,
+      "tool_calls": message.tool_calls or None,
+      "model": completion.model,
+      "usage": {
+        "prompt_tokens": completion.usage.prompt_tokens,
+        "completion_tokens": completion.usage.completion_tokens
+      } if completion.usage else None
+    }
+
+
+class AnthropicProvider(LLMProvider):
+  # the Anthropic messages API, messages and tools are converted from and to the OpenAI format
+  def __init__(self, name: str, api_key: Optional[str], default_model: Optional[str]):
+    super().__init__(name, default_model)
+    self.api_key = api_key
+
+  @property
+  def configured(self) -> bool:
+    return bool(self.api_key) and anthropic is not None
+
+  def create_client(self):
+    return anthropic.Anthropic(api_key=self.api_key, timeout=LLM_REQUEST_TIMEOUT_SECONDS, max_retries=0)
+
+  def __call__(self, messages, sysprompt=None, tools=None, json_mode=False, tool_choice="auto", model=None, **params) -> dict:
+    system, converted = to_anthropic_messages(messages)
+    system = [part for part in [sysprompt] + system if part]
+    if json_mode:
+      system.append(JSON_MODE_INSTRUCTION)
+
+    request = {"model": model or self.default_model, "max_tokens": ANTHROPIC_MAX_TOKENS, "messages": converted, **params}
+    if system:
+      request["system"] = "\n\n".join(system)
+    if tools and tool_choice != "none":
+      request["tools"] = [
+        {
+          "name": tool["function"]["name"],
+          "description": tool["function"].get("description", ""),
+          "input_schema": tool["function"].get("parameters") or {"type": "object", "properties": {}}
+        }
+        for tool in tools
+      ]
+      request["tool_choice"] = to_anthropic_tool_choice(tool_choice)
+
+    response = self.client.messages.create(**request)
+    text = "".join(block.text for block in response.content if block.type == "text")
+    tool_calls = [
+      ChatCompletionMessageToolCall(
+        id=block.id, type="function", function={"name": block.name, "arguments": json.dumps(block.input)}
+      )
+      for block in response.content if block.type == "tool_use"
+    ]
+    return {
+      "message": parse_json_reply(text) if json_mode and not tool_calls else (text or None),
+      "tool_calls": tool_calls or None,
+      "model": response.model,
+      "usage": {"prompt_tokens": response.usage.input_tokens, "completion_tokens": response.usage.output_tokens}
+    }
+
+
+def to_anthropic_messages(messages: List[dict]) -> Tuple[List[str], List[dict]]:
+  """
+  OpenAI chat messages to Anthropic messages: system messages (e.g. the history summary) are moved to
+  the system prompt, tool calls become tool_use blocks and tool results user tool_result blocks.
+  Consecutive messages of the same role are merged, the API expects alternating roles
+  Returns: (system texts, messages)
+  """
+  system, converted = [], []
+  for message in messages:
+    role = message["role"]
+    if role == "system":
+      system.append(message["content"])
+      continue
+    if role == "tool":
+      role, blocks = "user", [{"type": "tool_result", "tool_use_id": message["tool_call_id"], "content": str(message["content"])}]
+    else:
+      content = message.get("content")
+      blocks = [{"type": "text", "text": content if isinstance(content, str) else json.dumps(content)}] if content else []
+      for tool_call in message.get("tool_calls") or []:
+        blocks.append({
+          "type": "tool_use",
+          "id": tool_call["id"],
+          "name": tool_call["function"]["name"],
+          "input": json.loads(tool_call["function"]["arguments"] or "{}")
+        })
+    if not blocks:
+      continue
+    if converted and converted[-1]["role"] == role:
+      converted[-1]["content"].extend(blocks)
+    else:
+      converted.append({"role": role, "content": blocks})
+  return system, converted
+
+
+def to_anthropic_tool_choice(tool_choice) -> dict:
+  if isinstance(tool_choice, dict): # {"type": "function", "function": {"name": ...}}
+    return {"type": "tool", "name": tool_choice["function"]["name"]}
+  return {"type": "any"} if tool_choice == "required" else {"type": "auto"}
+
+
+def parse_json_reply(text: str):
+  # models without a JSON mode sometimes wrap the object in a code fence
+  text = text.strip()
+  if text.startswith("```"):
+    text = text.split("\n", 1)[1] if "\n" in text else ""
+    text = text.rsplit("```", 1)[0]
+  return json.loads(text)
+
+
+providers = {
+  "openai": OpenAIProvider("openai", OPENAI_API_KEY, default_model="gpt-4o"),
+  "anthropic": AnthropicProvider("anthropic", ANTHROPIC_API_KEY, default_model="claude-sonnet-4-5"),
+  "local": OpenAIProvider("local", LOCAL_LLM_API_KEY, default_model=LOCAL_LLM_MODEL, base_url=LOCAL_LLM_BASE_URL)
+}
+
+
+def parse_model(spec: Optional[str], default_provider: str = "openai") -> Tuple[str, Optional[str]]:
+  """
+  "provider:model" (e.g. "anthropic:claude-sonnet-4-5", "local:qwen2.5-coder"), a model of the default
+  provider, or None for the provider's default model. Model names can contain colons (llama3:8b)
+  Returns: (provider name, model)
+  """
+  provider_name, model = default_provider, spec or None
+  if spec and ":" in spec and spec.split(":", 1)[0] in providers:
+    provider_name, model = spec.split(":", 1)
+  if provider_name not in providers:
+    raise ValueError(f"Unknown LLM provider {provider_name}")
+  return provider_name, model or providers[provider_name].default_model
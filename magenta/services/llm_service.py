@@ -0,0 +1,73 @@
+import time
+import asyncio
+from core.config import logger
+from core.metrics import track_stage, record_llm_usage, llm_calls, llm_calls_in_flight
+from core.tracing import traced, set_span_attributes
+from core.logging_setup import truncate, log_payload
+from core.rate_limit import llm_slots
+from .llm_gateway import ResilientLLM
+
+
+# The one path every LLM call takes (agent turns and chat summaries): response cache, concurrency slot,
+# retries of the gateway, metrics, tracing and the usage ledger
+
+
+def tool_names(tools) -> list:
+  # tools are logged by name, the full schemas only go to the payload log
+  return [tool.get("function", {}).get("name") for tool in tools]
+
+
+@traced()
+async def call_llm(call_llm_func, llm_cache=None, usage_ledger=None, tenant_id="default", **request) -> dict:
+  start = time.perf_counter()
+  key = llm_cache.make_key(call_llm_func, **request) if llm_cache is not None else None
+  if key is not None:
+    cached = await llm_cache.get(key)
+    if cached is not None:
+      logger.info(f"LLM response served from cache ({key[:12]})")
+      llm_calls.labels(model=cached.get("model") or "unknown", cached="true").inc()
+      set_span_attributes(**{"llm.cached": True, "llm.model": cached.get("model")})
+      if usage_ledger is not None:
+        await usage_ledger.record(cached, (time.perf_counter() - start) * 1000, cached=True)
+      return cached
+
+  # LLM clients are blocking, keep them off the event loop. Calls beyond LLM_MAX_CONCURRENT_CALLS
+  # wait for a slot, taking turns with the calls of other tenants. A gateway takes the slot per
+  # attempt and gives it up during the retry backoff
+  async def run_llm(llm_func, request):
+    async with llm_slots.acquire(tenant_id):
+      llm_calls_in_flight.inc()
+      try:
+        with track_stage("llm_call"):
+          return await asyncio.to_thread(llm_func, **request)
+      finally:
+        llm_calls_in_flight.dec()
+
+  if request.get("tools"):
+    logger.info(f"Tools found: {tool_names(request['tools'])}")
+    log_payload("Tools", request["tools"])
+  if isinstance(call_llm_func, ResilientLLM):
+    llm_result = await call_llm_func.acall(run_llm, **request)
+  else:
+    llm_result = await run_llm(call_llm_func, request)
+  model = llm_result.get("model") or "unknown"
+  logger.info(f"Completion received from {model}: {truncate(llm_result.get('message'))}")
+  log_payload("Completion", llm_result)
+  if llm_result.get("tool_calls"):
+    logger.info(f"Tool calls detected: {[tool_call.function.name for tool_call in llm_result['tool_calls']]}")
+  llm_calls.labels(model=model, cached="false").inc()
+  usage = llm_result.get("usage") or {}
+  record_llm_usage(model, usage)
+  set_span_attributes(**{
+    "llm.cached": False,
+    "llm.model": model,
+    "llm.prompt_tokens": usage.get("prompt_tokens"),
+    "llm.completion_tokens": usage.get("completion_tokens"),
+    "llm.tool_calls": len(llm_result.get("tool_calls") or [])
+  })
+
+  if usage_ledger is not None:
+    await usage_ledger.record(llm_result, (time.perf_counter() - start) * 1000)
+  if key is not None:
+    await llm_cache.set(key, llm_result)
+  return llm_result
@@ -0,0 +1,128 @@
+from datetime import datetime, timezone
+from typing import List, Optional
+from core.config import logger
+
+
+class LLMUsageLedger:
+  """
+  Append-only ledger of the LLM calls of one agent turn: one small document per call in the tenant's
+  llm_usage collection (expired after LLM_USAGE_RETENTION_DAYS by a TTL index).
+  The tenant is the collection, the chat is the analysis session for analysis chats
+  """
+  def __init__(
+    self,
+    usage_collection,
+    chat_id: str,
+    message_id: Optional[str] = None,
+    prompt_id: Optional[str] = None,
+    purpose: str = "chat" # or "summary"
+  ):
+    self.usage_collection = usage_collection
+    self.chat_id = chat_id
+    self.message_id = message_id
+    self.prompt_id = prompt_id
+    self.purpose = purpose
+    self.calls = 0
+
+  async def record(self, llm_result: dict, latency_ms: float, cached: bool = False):
+    # never fails the turn, a lost entry only makes the rollups a little low
+    self.calls += 1
+    usage = llm_result.get("usage") or {}
+    entry = {
+      "created_at": datetime.now(timezone.utc),
+      "chat_id": self.chat_id,
+      "message_id": self.message_id,
+      "prompt_id": self.prompt_id,
+      "purpose": self.purpose,
+      "model": llm_result.get("model"),
+      "prompt_tokens": usage.get("prompt_tokens") or 0,
+      "completion_tokens": usage.get("completion_tokens") or 0,
+      "latency_ms": round(latency_ms),
+      "tool_calls": len(llm_result.get("tool_calls") or []),
+      "round": self.calls, # position of the call in the turn
+      "cached": cached
+    }
+    try:
+      await self.usage_collection.insert_one(entry)
+    except Exception as e:
+      logger.warning(f"Could not record LLM usage for chat {self.chat_id}: {e}")
+
+
+def usage_rollup_pipeline(match: dict, group_by: Optional[str] = None) -> List[dict]:
+  """
+  Aggregation of ledger entries into LLMUsageRollup documents, one per value of group_by
+  (or a single total). Entries are grouped per turn first to find the turns with the most calls
+  """
+  key = f"${group_by}" if group_by else None
+  return [
+    {"$match": match},
+    {"$group": {
+      "_id": {"key": key, "turn": {"$ifNull": ["$message_id", "$_id"]}},
+      "calls": {"$sum": 1},
+      "cached_calls": {"$sum": {"$cond": ["$cached", 1, 0]}},
+      "prompt_tokens": {"$sum": "$prompt_tokens"},
+      "completion_tokens": {"$sum": "$completion_tokens"},
+      "max_prompt_tokens": {"$max": "$prompt_tokens"},
+      "tool_calls": {"$sum": "$tool_calls"},
+      "latency_ms": {"$sum": "$latency_ms"},
+      "max_latency_ms": {"$max": "$latency_ms"},
+      "first_call": {"$min": "$created_at"},
+      "last_call": {"$max": "$created_at"}
+    }},
+    {"$group": {
+      "_id": "$_id.key",
+      "calls": {"$sum": "$calls"},
+      "cached_calls": {"$sum": "$cached_calls"},
+      "turns": {"$sum": 1},
+      "prompt_tokens": {"$sum": "$prompt_tokens"},
+      "completion_tokens": {"$sum": "$completion_tokens"},
+      "max_prompt_tokens": {"$max": "$max_prompt_tokens"},
+      "tool_calls": {"$sum": "$tool_calls"},
+      "max_calls_per_turn": {"$max": "$calls"},
+      "latency_ms": {"$sum": "$latency_ms"},
+      "max_latency_ms": {"$max": "$max_latency_ms"},
+      "first_call": {"$min": "$first_call"},
+      "last_call": {"$max": "$last_call"}
+    }},
+    {"$project": {
+      "_id": 0,
+      "key": {"$toString": "$_id"},
+      "calls": 1,
+      "cached_calls": 1,
+      "turns": 1,
+      "prompt_tokens": 1,
+      "completion_tokens": 1,
+      "total_tokens": {"$add": ["$prompt_tokens", "$completion_tokens"]},
+      "max_prompt_tokens": 1,
+      "tool_calls": 1,
+      "max_calls_per_turn": 1,
+      "avg_latency_ms": {"$divide": ["$latency_ms", "$calls"]},
+      "max_latency_ms": 1,
+      "first_call": 1,
+      "last_call": 1
+    }},
+    {"$sort": {"total_tokens": -1}}
+  ]
+
+
+async def get_usage_rollups(
+  usage_collection,
+  group_by: Optional[str] = None,
+  since: Optional[datetime] = None,
+  until: Optional[datetime] = None,
+  chat_id: Optional[str] = None,
+  limit: int = 100
+) -> List[dict]:
+  """
+  Returns: Rollups of the ledger of one tenant, largest token use first
+  """
+  match = {}
+  if since or until:
+    match["created_at"] = {**({"$gte": since} if since else {}), **({"$lt": until} if until else {})}
+  if chat_id:
+    match["chat_id"] = chat_id
+  rollups = await usage_collection.aggregate(usage_rollup_pipeline(match, group_by)).to_list(length=limit)
+  if not group_by:
+    for rollup in rollups:
+      rollup["key"] = None
+  return rollups
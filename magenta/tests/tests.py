@@ -215,6 +215,14 @@ def test_message_sending_endpoints():
   assert get_message_status_response.status_code == 200
   assert get_message_status_response.json()["task_id"] == message_id
 
+  # get several message statuses at once
+  get_statuses_response = client.get(f"/chats/{chat_id}/statuses", params={
+    "message_ids": [message_id, "non_existent_id"]
+  })
+  assert get_statuses_response.status_code == 200
+  assert list(get_statuses_response.json().keys()) == [message_id]
+  assert get_statuses_response.json()[message_id]["task_id"] == message_id
+
   # get a message
   get_message_response = client.get(f"/chats/{chat_id}/messages/{message_id}")
   assert get_message_response.status_code == 200
@@ -667,3 +675,463 @@ def test_tool_required_parameters():
       "required": []
     })
   assert create_response.status_code == 400
+
+
+# tenant endpoints -----------------------------------------------
+def test_tenant_index_stats():
+  import asyncio
+  from core.config import tenant_collections, TENANT_COLLECTION_INDEXES
+
+  # what the lifespan does on startup
+  asyncio.run(tenant_collections.ensure_indexes(tenant_ids=["default"]))
+
+  response = client.get("/tenants/default/indexes")
+  assert response.status_code == 200
+  index_stats = response.json()
+  for collection_name in tenant_collections.collection_types:
+    unique_indexes = [
+      index.document["name"] for index in TENANT_COLLECTION_INDEXES.get(collection_name, [])
+      if index.document.get("unique")
+    ]
+    if not unique_indexes:
+      continue
+    assert collection_name in index_stats
+    index_names = [index["name"] for index in index_stats[collection_name]]
+    assert all(name in index_names for name in unique_indexes)
+
+
+def test_tenant_cache():
+  from core.config import tenant_collections
+  tenant_id = f"cache_test_{int(time.time())}"
+  miss_ttl = tenant_collections.miss_ttl
+
+  # an unknown tenant is refused, the miss is remembered for miss_ttl
+  assert client.get("/usage/", params={"tenant_id": tenant_id}).status_code == 404
+  assert client.get(f"/tenants/{tenant_id}").status_code == 404
+
+  # another worker creates the tenant: this worker finds it once the remembered miss expires
+  tenant_collections.tenants_collection.delegate.insert_one({"tenant_id": tenant_id, "name": "cache test"})
+  try:
+    tenant_collections.miss_ttl = 3600
+    assert client.get("/usage/", params={"tenant_id": tenant_id}).status_code == 404
+    tenant_collections.miss_ttl = 0
+    assert tenant_collections.get_tenant(tenant_id) is None
+    assert client.get("/usage/", params={"tenant_id": tenant_id}).status_code == 200 # loaded by the middleware
+    assert tenant_collections.get_tenant(tenant_id).name == "cache test"
+    assert client.get(f"/tenants/{tenant_id}").json()["name"] == "cache test"
+  finally:
+    tenant_collections.miss_ttl = miss_ttl
+
+  # collection handles are resolved on first use and cached
+  assert tenant_id not in tenant_collections.collections["chats"]
+  chats_collection = tenant_collections.get_collection(tenant_id, "chats")
+  assert tenant_collections.get_collection(tenant_id, "chats") is chats_collection
+
+  # removing the tenant forgets it and its handles
+  assert client.delete(f"/tenants/{tenant_id}").status_code == 200
+  assert tenant_collections.get_tenant(tenant_id) is None
+  assert tenant_id not in tenant_collections.collections["chats"]
+  assert client.get(f"/tenants/{tenant_id}").status_code == 404
+
+
+def test_context_window():
+  from services.context_service import build_context_window, count_messages_tokens, SUMMARY_HEADER
+
+  messages = []
+  for i in range(40):
+    messages.append({"role": "user", "content": f"question {i} " + "word " * 50})
+    messages.append({"role": "assistant", "content": None, "tool_calls": [{"id": f"call_{i}", "type": "function"}]})
+    messages.append({"role": "tool", "tool_call_id": f"call_{i}", "content": "result " * 100})
+    messages.append({"role": "assistant", "content": f"answer {i} " + "ok " * 30})
+
+  window = build_context_window(messages, budget=2000, sysprompt="You are a test agent.", recent_turns=2)
+
+  # stays within budget, starts with a summary and ends with the last two turns verbatim
+  assert count_messages_tokens(window) <= 2000
+  assert window[0]["role"] == "system" and window[0]["content"].startswith(SUMMARY_HEADER)
+  assert window[-8:] == messages[-8:]
+  # older turns are kept without their tool chatter
+  assert all(message["role"] != "tool" for message in window[1:-8])
+
+  # a short history is sent unchanged
+  assert build_context_window(messages[:8], budget=2000) == messages[:8]
+
+  # text an assistant wrote next to its tool calls survives in older turns, without the tool calls
+  mixed = [
+    {"role": "user", "content": "load the data"},
+    {"role": "assistant", "content": "Loading it now.", "tool_calls": [{"id": "call_x", "type": "function"}]},
+    {"role": "tool", "tool_call_id": "call_x", "content": "loaded"},
+    {"role": "assistant", "content": "Done."}
+  ]
+  window = build_context_window(mixed + messages[-4:], budget=100000, recent_turns=1)
+  assert {"role": "assistant", "content": "Loading it now."} in window
+  assert all(message["role"] != "tool" for message in window[:-4])
+
+
+def test_rolling_chat_summary():
+  import asyncio
+  from core.config import tenant_collections
+  from services.context_service import update_chat_summary, messages_after_summary
+
+  chats_collection = tenant_collections.get_collection("default", "chats")
+  chat_id = f"test_summary_{int(time.time())}"
+  prompts_seen = []
+
+  def fake_llm(messages, sysprompt=None, **kwargs):
+    prompts_seen.append(messages[-1]["content"])
+    return {"message": f"summary v{len(prompts_seen)}", "tool_calls": None}
+
+  def turns(start, end):
+    return [
+      message for i in range(start, end) for message in [
+        {"message_id": f"q-{i}", "role": "user", "content": f"question {i}", "timestamp": datetime.now()},
+        {"message_id": f"{i}", "role": "assistant", "content": f"answer {i}", "timestamp": datetime.now()}
+      ]
+    ]
+
+  async def run():
+    await chats_collection.insert_one({
+      "chat_id": chat_id, "context_id": "test_context", "sysprompt_id": "test0",
+      "messages": turns(0, 40), "statuses": []
+    })
+    try:
+      # turns older than the last 5 are folded into the first summary
+      summary = await update_chat_summary(chat_id, chats_collection, fake_llm, keep_turns=5, min_new_turns=10)
+      assert summary["version"] == 1
+      assert summary["covered_messages"] == 70
+
+      # nothing new to fold
+      assert await update_chat_summary(chat_id, chats_collection, fake_llm, keep_turns=5, min_new_turns=10) is None
+
+      # only the delta and the previous summary are sent for the next version
+      await chats_collection.update_one({"chat_id": chat_id}, {"$push": {"messages": {"$each": turns(40, 52)}}})
+      summary = await update_chat_summary(chat_id, chats_collection, fake_llm, keep_turns=5, min_new_turns=10)
+      assert summary["version"] == 2
+      assert summary["covered_messages"] == 94
+      assert "summary v1" in prompts_seen[-1]
+      assert "question 34" not in prompts_seen[-1] and "question 35" in prompts_seen[-1]
+
+      # the summary is anchored on the last message it covers, removing earlier messages doesn't shift it
+      chat = await chats_collection.find_one({"chat_id": chat_id})
+      assert chat["summary"]["last_message_id"] == "46"
+      assert messages_after_summary(chat["messages"], chat["summary"])[0]["message_id"] == "q-47"
+      await chats_collection.update_one({"chat_id": chat_id}, {"$pull": {"messages": {"message_id": {"$in": ["q-0", "0"]}}}})
+      chat = await chats_collection.find_one({"chat_id": chat_id})
+      assert messages_after_summary(chat["messages"], chat["summary"])[0]["message_id"] == "q-47"
+
+      # a reply without text (e.g. only tool calls) keeps the stored summary
+      def empty_llm(messages, sysprompt=None, **kwargs):
+        return {"message": None, "tool_calls": None}
+
+      await chats_collection.update_one({"chat_id": chat_id}, {"$push": {"messages": {"$each": turns(52, 64)}}})
+      assert await update_chat_summary(chat_id, chats_collection, empty_llm, keep_turns=5, min_new_turns=10) is None
+      assert (await chats_collection.find_one({"chat_id": chat_id}))["summary"]["version"] == 2
+    finally:
+      await chats_collection.delete_one({"chat_id": chat_id})
+
+  asyncio.run(run())
+
+
+def test_llm_response_cache():
+  import asyncio
+  from openai.types.chat import ChatCompletionMessageToolCall
+  from services.llm_cache import LLMResponseCache
+  from services.chat_service import call_llm
+
+  calls = []
+
+  def fake_llm(messages, sysprompt=None, tools=None, json_mode=False, tool_choice="auto", model="test-model"):
+    calls.append(messages)
+    tool_call = ChatCompletionMessageToolCall(id="call_1", type="function", function={"name": "test_tool", "arguments": "{}"})
+    return {"message": f"answer {len(calls)}", "tool_calls": [tool_call]}
+
+  cache = LLMResponseCache(collection=None, lru_size=2)
+  request = {"sysprompt": "You are a test agent.", "tools": None, "json_mode": False, "tool_choice": "auto"}
+
+  async def run():
+    first = await call_llm(fake_llm, llm_cache=cache, messages=[{"role": "user", "content": "hi", "timestamp": datetime.now()}], **request)
+    # ids and timestamps are not part of the key
+    second = await call_llm(fake_llm, llm_cache=cache, messages=[{"role": "user", "content": "hi", "message_id": "q-1"}], **request)
+    assert len(calls) == 1
+    assert second["message"] == first["message"]
+    assert second["tool_calls"][0].function.name == "test_tool"
+
+    # a different request misses
+    await call_llm(fake_llm, llm_cache=cache, messages=[{"role": "user", "content": "hello"}], **request)
+    assert len(calls) == 2
+    assert cache.hits == 1 and cache.misses == 2
+
+  asyncio.run(run())
+
+
+def test_fake_llm():
+  from services.fake_llm import FakeLLM
+
+  tools = [{"type": "function", "function": {"name": name}} for name in ["run_code", "send_user_message"]]
+  llm = FakeLLM(latency={"distribution": "constant", "value": 0.01})
+  messages = [{"role": "user", "content": "Summarize the data"}]
+
+  # plays the script one tool-call round at a time, then ends the turn
+  names = []
+  result = llm(messages=messages, tools=tools)
+  while result["tool_calls"] is not None:
+    names += [tool_call.function.name for tool_call in result["tool_calls"]]
+    messages += [
+      {"role": "assistant", "tool_calls": [tool_call.model_dump() for tool_call in result["tool_calls"]]},
+      {"role": "tool", "tool_call_id": result["tool_calls"][0].id, "content": "ok"}
+    ]
+    result = llm(messages=messages, tools=tools)
+  assert names == ["run_code", "send_user_message"]
+  assert result["message"] == "Done."
+
+  # steps whose tools are not offered are skipped, the same request gets the same answer
+  assert llm(messages=messages[:1])["message"] == "Done."
+  assert llm(messages=messages[:1], tools=tools)["tool_calls"][0].id == llm(messages=messages[:1], tools=tools)["tool_calls"][0].id
+
+
+def test_llm_usage_ledger():
+  import asyncio
+  from core.config import tenant_collections
+  from services.usage_service import LLMUsageLedger, get_usage_rollups
+
+  usage_collection = tenant_collections.get_collection("default", "llm_usage")
+  chat_id = f"test_usage_{int(time.time())}"
+
+  def llm_result(prompt_tokens, n_tool_calls=0, model="test-model"):
+    return {
+      "message": "ok", "tool_calls": [object()] * n_tool_calls or None, "model": model,
+      "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 10}
+    }
+
+  async def run():
+    try:
+      # a turn with two tool-call rounds, then a turn answered from the cache
+      ledger = LLMUsageLedger(usage_collection, chat_id, "m1", "test0")
+      await ledger.record(llm_result(100, n_tool_calls=2), 200)
+      await ledger.record(llm_result(300, n_tool_calls=1), 300)
+      await ledger.record(llm_result(500), 400)
+      ledger = LLMUsageLedger(usage_collection, chat_id, "m2", "test0")
+      await ledger.record(llm_result(120, model="other-model"), 5, cached=True)
+
+      [total] = await get_usage_rollups(usage_collection, chat_id=chat_id)
+      assert total["key"] is None
+      assert total["calls"] == 4 and total["cached_calls"] == 1 and total["turns"] == 2
+      assert total["prompt_tokens"] == 1020 and total["total_tokens"] == 1060
+      assert total["max_prompt_tokens"] == 500 and total["max_calls_per_turn"] == 3
+      assert total["tool_calls"] == 3 and total["max_latency_ms"] == 400
+
+      by_model = await get_usage_rollups(usage_collection, group_by="model", chat_id=chat_id)
+      assert [rollup["key"] for rollup in by_model] == ["test-model", "other-model"]
+    finally:
+      await usage_collection.delete_many({"chat_id": chat_id})
+
+  asyncio.run(run())
+
+
+def test_structured_logging(tmp_path):
+  from loguru import logger
+  from core.logging_setup import json_format, truncate
+
+  # payloads are cut in the regular logs
+  assert truncate("x" * 1000, max_chars=10) == "xxxxxxxxxx... [990 more chars]"
+  assert truncate({"a": 1}) == "{'a': 1}"
+
+  log_file = tmp_path / "test.log"
+  sink_id = logger.add(log_file, format=json_format, enqueue=True, filter=lambda record: record["extra"].get("test_sink"))
+  try:
+    logger.bind(test_sink=True, chat_id="c1").info("Calling {}", "LLM")
+    logger.complete()
+  finally:
+    logger.remove(sink_id)
+  entry = json.loads(log_file.read_text().splitlines()[0])
+  assert entry["message"] == "Calling LLM" and entry["level"] == "INFO"
+  assert entry["extra"]["chat_id"] == "c1"
+
+
+def test_rate_limits():
+  import asyncio
+  from core.rate_limit import RateLimiter, FairLLMSlots
+
+  # a burst of 2, then one turn per second
+  limiter = RateLimiter(per_minute=60, burst=2)
+  assert limiter.take("tenant") == 0 and limiter.take("tenant") == 0
+  assert 0 < limiter.take("tenant") <= 1
+  assert limiter.take("other_tenant") == 0
+  assert RateLimiter(per_minute=0, burst=1).take("tenant") == 0 # disabled
+
+  # queued calls are served round-robin across tenants
+  slots = FairLLMSlots(limit=1)
+  order = []
+
+  async def call(tenant_id, i):
+    async with slots.acquire(tenant_id):
+      order.append(tenant_id)
+      await asyncio.sleep(0.01)
+
+  async def run():
+    calls = [asyncio.create_task(call("noisy", i)) for i in range(4)]
+    await asyncio.sleep(0)
+    calls += [asyncio.create_task(call("quiet", i)) for i in range(2)]
+    await asyncio.gather(*calls)
+
+  asyncio.run(run())
+  assert order == ["noisy", "noisy", "quiet", "noisy", "quiet", "noisy"]
+  assert slots.in_use == 0 and not slots.queues
+
+  # over the session rate the endpoints answer 429 with Retry-After
+  session_id = f"test_rate_limit_{int(time.time())}"
+  responses = [client.post(f"/chats/{session_id}/send", params={"message": "hi", "dry_run": True}) for _ in range(10)]
+  limited = [response for response in responses if response.status_code == 429]
+  assert limited and int(limited[0].headers["Retry-After"]) >= 1
+
+
+def test_llm_gateway():
+  import asyncio
+  import httpx
+  import openai
+  from services.llm_gateway import ResilientLLM, LLMUnavailableError, LLMConfigurationError, get_circuit_breaker
+
+  def api_error(status, headers=None):
+    response = httpx.Response(status, headers=headers or {}, request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+    return openai.APIStatusError("error", response=response, body=None)
+
+  calls, delays = [], []
+  suffix = int(time.time())
+
+  async def record_delay(delay):
+    delays.append(delay)
+
+  async def no_delay(delay):
+    pass
+
+  def rate_limited(**request):
+    calls.append("primary")
+    raise api_error(429, {"retry-after": "2"})
+
+  def fallback(**request):
+    calls.append("fallback")
+    return {"message": "ok", "tool_calls": None, "model": "fallback"}
+
+  # retries honor Retry-After, then the fallback model answers
+  llm = ResilientLLM([(f"primary_{suffix}", rate_limited), (f"fallback_{suffix}", fallback)], max_retries=2, sleep=record_delay)
+  assert llm(messages=[])["model"] == "fallback"
+  assert calls == ["primary", "primary", "primary", "fallback"]
+  assert len(delays) == 2 and all(delay >= 2 for delay in delays)
+
+  # bad requests are not retried
+  def bad_request(**request):
+    calls.append("bad")
+    raise api_error(400)
+
+  calls.clear()
+  with pytest.raises(openai.APIStatusError):
+    ResilientLLM([(f"bad_{suffix}", bad_request), (f"fallback_{suffix}", fallback)], sleep=record_delay)(messages=[])
+  assert calls == ["bad"]
+
+  # an unauthorized, retired or unconfigured model isn't retried, the next model answers
+  def unauthorized(**request):
+    calls.append("unauthorized")
+    raise api_error(401)
+
+  def not_configured(**request):
+    calls.append("not configured")
+    raise LLMConfigurationError("LLM provider anthropic is not configured")
+
+  calls.clear()
+  llm = ResilientLLM(
+    [(f"unauthorized_{suffix}", unauthorized), (f"unconfigured_{suffix}", not_configured), (f"fallback_{suffix}", fallback)],
+    sleep=record_delay
+  )
+  assert llm(messages=[])["model"] == "fallback"
+  assert calls == ["unauthorized", "not configured", "fallback"]
+
+  # consecutive failures open the circuit, the model is then skipped
+  def unavailable(**request):
+    calls.append("down")
+    raise api_error(503)
+
+  calls.clear()
+  llm = ResilientLLM([(f"down_{suffix}", unavailable)], max_retries=9, sleep=no_delay)
+  with pytest.raises(LLMUnavailableError):
+    llm(messages=[])
+  assert len(calls) == 5 # LLM_CIRCUIT_FAILURES
+  with pytest.raises(LLMUnavailableError, match="circuit open"):
+    llm(messages=[])
+  assert len(calls) == 5
+
+  # a probe rejected as a bad request settles the probe, the next call probes again
+  get_circuit_breaker(f"down_{suffix}").reset_timeout = 0.05
+  time.sleep(0.1)
+  calls.clear()
+  with pytest.raises(openai.APIStatusError):
+    ResilientLLM([(f"down_{suffix}", bad_request)], sleep=no_delay)(messages=[])
+  assert calls == ["bad"]
+  assert ResilientLLM([(f"down_{suffix}", fallback)], sleep=no_delay)(messages=[])["model"] == "fallback"
+  assert get_circuit_breaker(f"down_{suffix}").state == "closed"
+
+  # in an event loop the backoff is awaited between attempts, outside of run (which holds the LLM slot)
+  attempts = []
+  failures = iter([api_error(503), None])
+
+  def flaky(**request):
+    error = next(failures)
+    if error:
+      raise error
+    return {"message": "ok", "tool_calls": None, "model": "flaky"}
+
+  async def run(llm_func, request):
+    attempts.append(len(delays))
+    return llm_func(**request)
+
+  delays.clear()
+  llm = ResilientLLM([(f"flaky_{suffix}", flaky)], max_retries=2, sleep=record_delay)
+  assert asyncio.run(llm.acall(run, messages=[]))["model"] == "flaky"
+  assert attempts == [0, 1]
+
+  # the blocking entry point refuses to run inside an event loop
+  async def call_blocking():
+    return llm(messages=[])
+
+  with pytest.raises(RuntimeError, match="acall"):
+    asyncio.run(call_blocking())
+
+
+def test_llm_providers():
+  from services.llm_providers import parse_model, to_anthropic_messages, to_anthropic_tool_choice, parse_json_reply
+
+  assert parse_model("anthropic:claude-sonnet-4-5") == ("anthropic", "claude-sonnet-4-5")
+  assert parse_model("gpt-4o-mini") == ("openai", "gpt-4o-mini")
+  assert parse_model("llama3:8b", "local") == ("local", "llama3:8b") # not a provider prefix
+  assert parse_model(None, "openai") == ("openai", "gpt-4o")
+  with pytest.raises(ValueError):
+    parse_model("gpt-4o", "unknown")
+
+  messages = [
+    {"role": "system", "content": "Summary of the earlier messages"},
+    {"role": "user", "content": "Plot the data"},
+    {"role": "assistant", "content": None, "tool_calls": [
+      {"id": "call_1", "type": "function", "function": {"name": "run_code", "arguments": "{\"code\": \"plot()\"}"}}
+    ]},
+    {"role": "tool", "tool_call_id": "call_1", "content": "done"},
+    {"role": "user", "content": "Thanks"}
+  ]
+  system, converted = to_anthropic_messages(messages)
+  assert system == ["Summary of the earlier messages"]
+  assert [message["role"] for message in converted] == ["user", "assistant", "user"]
+  assert converted[1]["content"][0] == {"type": "tool_use", "id": "call_1", "name": "run_code", "input": {"code": "plot()"}}
+  # the tool result and the next user message share one turn
+  assert [block["type"] for block in converted[2]["content"]] == ["tool_result", "text"]
+
+  assert to_anthropic_tool_choice("required") == {"type": "any"}
+  assert to_anthropic_tool_choice({"type": "function", "function": {"name": "run_code"}}) == {"type": "tool", "name": "run_code"}
+  assert parse_json_reply("```json\n{\"a\": 1}\n```") == {"a": 1}
+
+  # providers implement the whole contract
+  from services.llm_providers import LLMProvider
+  with pytest.raises(TypeError):
+    LLMProvider("incomplete", None)
+
+  # json_mode replies are parsed objects, they are stored as text
+  from services.chat_service import message_content
+  assert message_content({"a": 1}) == "{\"a\": 1}"
+  assert message_content("plain") == "plain" and message_content(None) is None
@@ -1,9 +1,14 @@
 from fastapi.testclient import TestClient
 from app.main import app
+from app.core.utils import iter_content_defined_chunks, hash_chunk
 import requests
 import json
 import os
+import io
 import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import zstandard
 
 
 env = os.getenv('ENV', 'DEV')
@@ -240,6 +245,35 @@ def test_analysis_session_code():
 	client.delete(f"/analysis/{session_id}")
 
 
+def test_analysis_session_large_code_output():
+	session = client.post("/analysis/", params={
+		"context_id": "test_context",
+		"tenant_id": "default",
+		"sysprompt_id": "radian0"
+	}).json()
+	session_id = session["session_id"]
+
+	# ~600KB of output, e.g. print(df) of a large frame
+	large_output = "\n".join(f"{i}  {i * 0.5}  value_{i}" for i in range(30000))
+	code_pair = {
+		"input": {"type": "execution", "code_snippet": "print(df)", "language": "R"},
+		"output": {"response": large_output, "status": "success"}
+	}
+	send_response = client.post(f"/analysis/{session_id}/code", params={"dry_run": True}, json=code_pair)
+	assert send_response.status_code == 200
+	code_message_id = send_response.json()["task_id"]
+
+	# The code history keeps the full output, the message content only has the digest
+	code_message = client.get(f"/analysis/{session_id}/code/{code_message_id}").json()
+	assert code_message["code_pair"]["output"]["response"] == large_output
+	assert len(code_message["content"]) < 10000
+	assert "lines" in code_message["content"] and "omitted" in code_message["content"]
+	assert "29999  14999.5  value_29999" in code_message["content"]
+
+	# Clean up
+	client.delete(f"/analysis/{session_id}")
+
+
 def test_analysis_session_not_found():
 	non_existent_id = "non_existent_session"
 	
@@ -302,10 +336,8 @@ def test_environment_file_operations():
 	assert update_response.status_code == 200
 	assert update_response.json()["context_id"] == session["context_id"]
 	assert update_response.json()["tenant_id"] == "default"
-	# Don't check env_file immediately as it's processed in background
-	
-	# Add small delay to allow background task to complete
-	time.sleep(1)
+	# The file is stored before the response, which carries the new version
+	assert update_response.json()["version"] == get_response.json()["version"] + 1
 	
 	# Verify update
 	get_updated_response = client.get(f"/environments/{session_id}")
@@ -325,6 +357,283 @@ def test_environment_file_operations():
 	client.delete(f"/analysis/{session_id}")
 
 
+def test_environment_binary_file_operations():
+	# Create analysis session first
+	session = client.post("/analysis/", params={
+		"context_id": "test_context",
+		"tenant_id": "default",
+		"sysprompt_id": "radian0"
+	}).json()
+	session_id = session["session_id"]
+
+	# Upload raw bytes
+	content = b"Hello binary environment"
+	upload_response = client.put(
+		f"/environments/{session_id}/file",
+		data=content,
+		headers={"Content-Type": "application/octet-stream"}
+	)
+	assert upload_response.status_code == 200
+	assert upload_response.json()["snapshot_id"] is not None
+
+	# Download the whole file
+	download_response = client.get(f"/environments/{session_id}/file")
+	assert download_response.status_code == 200
+	assert download_response.content == content
+	assert download_response.headers["Accept-Ranges"] == "bytes"
+
+	# The JSON endpoint still returns the same content as base64
+	get_response = client.get(f"/environments/{session_id}")
+	assert get_response.status_code == 200
+	assert get_response.json()["env_file"] == "SGVsbG8gYmluYXJ5IGVudmlyb25tZW50"
+
+	# Download a byte range
+	range_response = client.get(f"/environments/{session_id}/file", headers={"Range": "bytes=6-11"})
+	assert range_response.status_code == 206
+	assert range_response.content == b"binary"
+	assert range_response.headers["Content-Range"] == f"bytes 6-11/{len(content)}"
+
+	# Unsatisfiable range
+	bad_range_response = client.get(f"/environments/{session_id}/file", headers={"Range": "bytes=1000-"})
+	assert bad_range_response.status_code == 416
+
+	# Clean up
+	client.delete(f"/environments/{session_id}")
+	client.delete(f"/analysis/{session_id}")
+
+
+def test_environment_chunked_snapshots():
+	# Create analysis session first
+	session = client.post("/analysis/", params={
+		"context_id": "test_context",
+		"tenant_id": "default",
+		"sysprompt_id": "radian0"
+	}).json()
+	session_id = session["session_id"]
+
+	# ~3MB of pseudo random data so it's cut into several chunks, plus an edited copy
+	content = os.urandom(3 * 1024 * 1024)
+	edited = content[:2 * 1024 * 1024] + b"edited" + content[2 * 1024 * 1024:]
+	chunks = list(iter_content_defined_chunks(content))
+	hashes = [hash_chunk(chunk) for chunk in chunks]
+	assert len(chunks) > 1
+
+	# Nothing is known yet, upload every chunk and commit the snapshot
+	missing = client.post(f"/environments/{session_id}/chunks/missing", json={"chunks": hashes}).json()["chunks"]
+	assert missing == hashes
+	for chunk, sha256 in zip(chunks, hashes):
+		chunk_response = client.put(
+			f"/environments/{session_id}/chunks/{sha256}",
+			data=chunk,
+			headers={"Content-Type": "application/octet-stream"}
+		)
+		assert chunk_response.status_code == 200
+
+	commit_response = client.put(f"/environments/{session_id}/snapshot", json={"chunks": hashes})
+	assert commit_response.status_code == 200
+	assert commit_response.json()["size"] == len(content)
+
+	download_response = client.get(f"/environments/{session_id}/file")
+	assert download_response.content == content
+
+	# Clients accepting zstd get the compressed chunks, everyone else the plain file
+	with client.stream("GET", f"/environments/{session_id}/file", headers={"Accept-Encoding": "zstd"}) as zstd_response:
+		assert zstd_response.headers["Content-Encoding"] == "zstd"
+		compressed = b"".join(zstd_response.iter_raw())
+	assert zstandard.ZstdDecompressor().stream_reader(io.BytesIO(compressed), read_across_frames=True).read() == content
+	plain_response = client.get(f"/environments/{session_id}/file", headers={"Accept-Encoding": "identity"})
+	assert "Content-Encoding" not in plain_response.headers
+	assert plain_response.content == content
+
+	# After the edit only the chunks around it are unknown
+	edited_hashes = [hash_chunk(chunk) for chunk in iter_content_defined_chunks(edited)]
+	missing = client.post(f"/environments/{session_id}/chunks/missing", json={"chunks": edited_hashes}).json()["chunks"]
+	assert 0 < len(missing) < len(edited_hashes)
+
+	# A chunk whose content doesn't match its hash is rejected
+	bad_chunk_response = client.put(
+		f"/environments/{session_id}/chunks/{hashes[0]}",
+		data=b"not the right content",
+		headers={"Content-Type": "application/octet-stream"}
+	)
+	assert bad_chunk_response.status_code == 400
+
+	# Committing a snapshot with unknown chunks fails
+	unknown_response = client.put(f"/environments/{session_id}/snapshot", json={"chunks": missing})
+	assert unknown_response.status_code == 400
+
+	# The binary upload is chunked on the server and stores only the new chunks
+	upload_response = client.put(
+		f"/environments/{session_id}/file",
+		data=edited,
+		headers={"Content-Type": "application/octet-stream"}
+	)
+	assert upload_response.status_code == 200
+	snapshot = client.get(f"/environments/{session_id}/snapshot").json()
+	assert [chunk["sha256"] for chunk in snapshot["chunks"]] == edited_hashes
+	assert client.get(f"/environments/{session_id}/file", headers={"Range": "bytes=2097152-2097157"}).content == b"edited"
+
+	# Clean up
+	client.delete(f"/environments/{session_id}")
+	client.delete(f"/analysis/{session_id}")
+
+
+def test_environment_snapshot_versions():
+	# Create analysis session first
+	session = client.post("/analysis/", params={
+		"context_id": "test_context",
+		"tenant_id": "default",
+		"sysprompt_id": "radian0"
+	}).json()
+	session_id = session["session_id"]
+	octet_stream = {"Content-Type": "application/octet-stream"}
+
+	# Two saves give two versions
+	first = client.put(f"/environments/{session_id}/file", data=b"first environment", headers=octet_stream).json()
+	second = client.put(f"/environments/{session_id}/file", data=b"second environment", headers=octet_stream).json()
+	assert second["version"] == first["version"] + 1
+
+	versions = client.get(f"/environments/{session_id}/versions").json()
+	assert [v["version"] for v in versions] == [second["version"], first["version"]]
+
+	# Earlier versions can be downloaded directly
+	old_response = client.get(f"/environments/{session_id}/file", params={"version": first["version"]})
+	assert old_response.content == b"first environment"
+
+	# Restoring makes the old snapshot current again as a new version
+	restore_response = client.post(f"/environments/{session_id}/restore", params={"version": first["version"]})
+	assert restore_response.status_code == 200
+	assert restore_response.json()["restored_from"] == first["version"]
+	assert restore_response.json()["version"] == second["version"] + 1
+	assert client.get(f"/environments/{session_id}/file").content == b"first environment"
+
+	# Restoring v1 after v3 moves the environment to v4, it doesn't take over the old version number
+	third = client.put(f"/environments/{session_id}/file", data=b"third environment", headers=octet_stream).json()
+	restore_response = client.post(f"/environments/{session_id}/restore", params={"version": first["version"]})
+	assert restore_response.json()["version"] == third["version"] + 1
+	current = client.get(f"/environments/{session_id}/snapshot").json()
+	assert current["version"] == third["version"] + 1
+	assert current["snapshot_id"] == first["snapshot_id"]
+
+	# A save after running code is attached to that code snippet and can be restored by it
+	code_response = client.post(
+		f"/analysis/{session_id}/code",
+		params={"dry_run": True},
+		json={"input": {"type": "execution", "code_snippet": "x <- 1", "language": "R"}}
+	)
+	code_message_id = code_response.json()["task_id"]
+	client.put(f"/environments/{session_id}/file", data=b"environment after code", headers=octet_stream)
+	client.put(f"/environments/{session_id}/file", data=b"later environment", headers=octet_stream, params={"code_snippet_id": "other"})
+
+	restore_response = client.post(f"/environments/{session_id}/restore", params={"code_snippet_id": code_message_id})
+	assert restore_response.status_code == 200
+	assert client.get(f"/environments/{session_id}/file").content == b"environment after code"
+
+	# Unknown versions
+	assert client.post(f"/environments/{session_id}/restore", params={"version": 1000}).status_code == 404
+	assert client.get(f"/environments/{session_id}/file", params={"version": 1000}).status_code == 404
+
+	# Clean up
+	client.delete(f"/environments/{session_id}")
+	assert client.get(f"/environments/{session_id}/versions").status_code == 404
+	client.delete(f"/analysis/{session_id}")
+
+
+def test_environment_resumable_upload():
+	# Create analysis session first
+	session = client.post("/analysis/", params={
+		"context_id": "test_context",
+		"tenant_id": "default",
+		"sysprompt_id": "radian0"
+	}).json()
+	session_id = session["session_id"]
+	octet_stream = {"Content-Type": "application/octet-stream"}
+
+	upload = client.post(f"/environments/{session_id}/uploads").json()
+	upload_id = upload["upload_id"]
+	assert upload["status"] == "open"
+
+	content = os.urandom(2 * 1024 * 1024 + 123)
+	part_size = 1024 * 1024
+	parts = [content[i:i + part_size] for i in range(0, len(content), part_size)]
+	part_hashes = [hashlib.sha256(part).hexdigest() for part in parts]
+
+	# A part that doesn't match its checksum is rejected
+	bad_response = client.put(
+		f"/environments/{session_id}/uploads/{upload_id}/parts/1",
+		params={"sha256": part_hashes[1]},
+		data=parts[0],
+		headers=octet_stream
+	)
+	assert bad_response.status_code == 400
+
+	# Parts can be sent in parallel and in any order
+	def put_part(part_number):
+		return client.put(
+			f"/environments/{session_id}/uploads/{upload_id}/parts/{part_number}",
+			params={"sha256": part_hashes[part_number - 1]},
+			data=parts[part_number - 1],
+			headers=octet_stream
+		)
+	with ThreadPoolExecutor(max_workers=3) as executor:
+		responses = list(executor.map(put_part, [3, 1]))
+	assert all(response.status_code == 200 for response in responses)
+
+	# Completing with a missing part fails, the upload shows what was received
+	assert client.post(f"/environments/{session_id}/uploads/{upload_id}/complete", json={"parts": part_hashes}).status_code == 400
+	received = client.get(f"/environments/{session_id}/uploads/{upload_id}").json()["parts"]
+	assert sorted(received.keys()) == ["1", "3"]
+
+	# Resume with the missing part and complete, retrying a part replaces it
+	assert put_part(2).status_code == 200
+	assert put_part(1).status_code == 200
+	assert sorted(client.get(f"/environments/{session_id}/uploads/{upload_id}").json()["parts"].keys()) == ["1", "2", "3"]
+	complete_response = client.post(f"/environments/{session_id}/uploads/{upload_id}/complete", json={"parts": part_hashes})
+	assert complete_response.status_code == 200
+	assert complete_response.json()["size"] == len(content)
+	assert client.get(f"/environments/{session_id}/file").content == content
+	assert client.get(f"/environments/{session_id}/uploads/{upload_id}").status_code == 404
+
+	# Clean up
+	client.delete(f"/environments/{session_id}")
+	client.delete(f"/analysis/{session_id}")
+
+
+def test_garbage_collection():
+	# An environment whose analysis session was deleted is garbage
+	session = client.post("/analysis/", params={
+		"context_id": "test_context",
+		"tenant_id": "default",
+		"sysprompt_id": "radian0"
+	}).json()
+	session_id = session["session_id"]
+	client.put(f"/environments/{session_id}/file", data=b"orphaned environment", headers={"Content-Type": "application/octet-stream"})
+	client.delete(f"/analysis/{session_id}")
+
+	# A dry run reports it without removing anything
+	dry_run_response = client.post("/maintenance/gc", params={"tenant_id": "default", "dry_run": True})
+	assert dry_run_response.status_code == 200
+	report = dry_run_response.json()
+	assert report["dry_run"] is True
+	assert report["tenants"]["default"]["environments"]["count"] >= 1
+	assert all(key in report["tenants"]["default"] for key in ["snapshots", "chunks", "upload_parts", "gridfs_chunks", "vectors"])
+	assert client.get(f"/environments/{session_id}/snapshot").status_code == 200
+
+	# A real run removes the environment and its history, in small batches
+	gc_response = client.post("/maintenance/gc", params={"tenant_id": "default", "dry_run": False, "batch_size": 2})
+	assert gc_response.status_code == 200
+	assert gc_response.json()["tenants"]["default"]["environments"]["count"] >= 1
+	assert client.get(f"/environments/{session_id}/snapshot").status_code == 404
+	assert client.get(f"/environments/{session_id}/versions").status_code == 404
+
+	# Vector tables of removed tenants are only reported, dropping them takes an explicit list
+	tables_response = client.post("/maintenance/gc/vector_tables")
+	assert tables_response.status_code == 200
+	assert tables_response.json()["dry_run"] is True
+	assert "default" not in tables_response.json()["tables"]
+	assert client.post("/maintenance/gc/vector_tables", params={"dry_run": False}).status_code == 400
+
+
 def test_environment_error_cases():
 	# Test with non-existent session
 	non_existent_id = "non_existent_session"
@@ -391,3 +700,28 @@ def test_environment_error_cases():
 	# Clean up
 	client.delete(f"/environments/{session_id}")
 	client.delete(f"/analysis/{session_id}")
+
+
+# metrics endpoint -------------------------------------------------
+def test_metrics():
+	session = client.post("/analysis/", params={
+		"context_id": "test_context",
+		"tenant_id": "default",
+		"sysprompt_id": "radian0"
+	}).json()
+	session_id = session["session_id"]
+	client.post(f"/analysis/{session_id}/messages", params={"message": "Hello", "dry_run": True})
+	client.get(f"/analysis/{session_id}/messages")
+	time.sleep(2)
+
+	metrics_response = client.get("/metrics")
+	assert metrics_response.status_code == 200
+	metrics = metrics_response.text
+	# latencies are labelled by route template, not by path
+	assert 'route="/analysis/{session_id}/messages"' in metrics
+	assert session_id not in metrics
+	assert 'agent_turn_stage_duration_seconds_count{stage="history_load"}' in metrics
+	assert 'active_sessions{tenant="default"}' in metrics
+
+	# Clean up
+	client.delete(f"/analysis/{session_id}")